@@ -8,11 +8,22 @@
 import httpx
 import json
 import asyncio
-import aiofiles
+import argparse
+import fnmatch
+import history
 import os
 import re
 import sys
-from repo_update import repo_build, enter_missing
+import locks
+import neighbors
+import plan
+import status
+import transfer
+import utils
+from utils import format_url
+import upstream
+from manifest_index import open_index
+from repo_update import repo_build, enter_missing, sparse_spec
 from color_logger import ColorLogger
 from urllib.parse import urljoin, urlparse
 from hashlib import sha256
@@ -20,6 +31,117 @@ from zlib import crc32
 from dataclasses import dataclass
 
 log = ColorLogger().logger
+parser = argparse.ArgumentParser(
+    description="Add patches to the mirror. Without arguments, asks for the URL and patches interactively."
+)
+parser.add_argument(
+    "urls",
+    metavar="URL",
+    nargs="*",
+    help="Repo or patch URLs to mirror without asking any question"
+    )
+parser.add_argument(
+    "-b","--batch",
+    metavar="file",
+    help="File listing one repo or patch URL per line, optionally followed by patch "
+         "patterns to select ('!pattern' excludes); '#' starts a comment",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "-s","--select",
+    metavar="pattern",
+    help="Only mirror the patches of the repo URLs given on the command line that match "
+         "this pattern (can be repeated, '!pattern' excludes)",
+    action="append",
+    default=[]
+    )
+parser.add_argument(
+    "--one-time",
+    metavar="pattern",
+    help="Patches matching this pattern are mirrored once and not kept in sync (can be repeated)",
+    action="append",
+    default=[]
+    )
+parser.add_argument(
+    "--crawl",
+    help="Also mirror every repo reachable through the neighbors of the given repos",
+    action="store_true"
+    )
+parser.add_argument(
+    "--depth",
+    metavar="N",
+    help="Only crawl repos at most N neighbors away from the given repos",
+    default=None,
+    type=int
+    )
+parser.add_argument(
+    "--allow",
+    metavar="pattern",
+    help="Only crawl repos whose id or URL matches this pattern (can be repeated)",
+    action="append",
+    default=[]
+    )
+parser.add_argument(
+    "--deny",
+    metavar="pattern",
+    help="Never crawl repos whose id or URL matches this pattern (can be repeated)",
+    action="append",
+    default=[]
+    )
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="Only resolve the batch and print what would be downloaded, with an estimated duration"
+    )
+parser.add_argument(
+    "--save-plan",
+    metavar="path",
+    help="Like --plan, and save the plan to this file",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--apply-plan",
+    metavar="path",
+    help="Mirror exactly the patches of a plan saved by --save-plan, without resolving the batch again",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--history",
+    metavar="path",
+    help="Append a record of the run to this file (default: <mirror>/.history.jsonl)",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--status",
+    metavar="path",
+    help="Where to write the live status of the run (default: <mirror>/.add-status.json)",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--progress",
+    metavar="seconds",
+    help="Print one progress line every N seconds instead of one line per file (the log file keeps every line)",
+    default=None,
+    type=float
+    )
+parser.add_argument(
+    "--log-format",
+    choices=["text", "json"],
+    help="Console output format, 'json' writes one JSON object per line",
+    default="text"
+    )
+parser.add_argument(
+    "-j","--jobs",
+    metavar="N",
+    help="Number of patches mirrored at the same time in batch mode",
+    default=4,
+    type=int
+    )
 
 @dataclass(frozen=True)
 class ADD_MODE:
@@ -28,6 +150,59 @@ class ADD_MODE:
 
 add_mode = ADD_MODE()
 
+class MetadataCache:
+    """Per-run single-flight cache of metadata files (repo.js, files.js...).
+    Each URL is requested once through one pooled client: concurrent
+    callers wait for the same request, and the parsed JSON and SHA-256 of
+    the body are computed once. Failed requests are not cached."""
+
+    def __init__(self):
+        self._client = None
+        self.requests = {}
+        self.parsed = {}
+        self.hashes = {}
+
+    def client(self):
+        if self._client is None:
+            self._client = transfer.new_client(timeout=10)
+        return self._client
+
+    async def _fetch(self, url: str):
+        try:
+            response = await self.client().get(url)
+        except Exception:
+            del self.requests[url]
+            raise
+        transfer.stats.record(response, len(response.content))
+        return response
+
+    async def get(self, url: str):
+        """Returns the response for [url], whatever its status."""
+        if url not in self.requests:
+            self.requests[url] = asyncio.ensure_future(self._fetch(url))
+        return await asyncio.shield(self.requests[url])
+
+    async def json(self, url: str):
+        response = await self.get(url)
+        response.raise_for_status()
+        if url not in self.parsed:
+            self.parsed[url] = response.json()
+        return self.parsed[url]
+
+    async def sha256(self, url: str):
+        response = await self.get(url)
+        response.raise_for_status()
+        if url not in self.hashes:
+            self.hashes[url] = sha256(response.content).hexdigest()
+        return self.hashes[url]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+metadata = MetadataCache()
+
 # 载入用户配置
 def load_config():
     config = None
@@ -72,12 +247,6 @@ def custom_config():
     
     return config
 
-# 对 URL 进行格式化
-def format_url(url: str):
-    if not url.endswith('/'):
-        return url + '/'
-    return url
-
 # 获取 URL 最后一级
 def get_last_path_segment(url: str):
     parsed_url = urlparse(url)
@@ -93,6 +262,8 @@ def get_last_path_segment(url: str):
 
 # 获取文件 CRC32 校验和
 async def calculate_crc32(file_path: str):
+    # 仅在恢复中断的下载时用到，延迟导入以加快启动
+    import aiofiles
     try:
         async with aiofiles.open(file_path, 'rb') as f:
             checksum = 0
@@ -126,212 +297,193 @@ async def fetch_patch_file_info(patch_url: str):
     files_js_url = urljoin(format_url(patch_url), "files.js?=2233")
 
     # 获取 JSON 数据
-    async with httpx.AsyncClient() as client:
-        response = await client.get(files_js_url)
-        response.raise_for_status()
-        json_data = response.json()
+    json_data = await metadata.json(files_js_url)
 
-        # 获取 patch 文件信息键值对，舍弃空值项（远端文件已删除）
-        file_info = {key: value for key, value in json_data.items() if value is not None}
-        return file_info
+    # 获取 patch 文件信息键值对，舍弃空值项（远端文件已删除）
+    file_info = {key: value for key, value in json_data.items() if value is not None}
+    return file_info
 
 # 获取 repo 信息（repo.js 内容）
 async def fetch_repo_info(url: str, am=add_mode.ADD_REPO):
-    async with httpx.AsyncClient() as client:
-        try:
-            if am == add_mode.ADD_REPO:
-                # Mode 1: Directly append 'repo.js' to the repo URL
-                repo_js_url = urljoin(url, 'repo.js')
-            elif am == add_mode.ADD_PATCH:
-                # Mode 2: Assume the URL is for a patch, go one level up to get 'repo.js'
-                repo_js_url = urljoin(url, '../repo.js')
-            else:
-                raise ValueError("Invalid mode. Mode should be 1 for repo or 2 for patch.")
-            
-            # Fetch the repo.js content
-            response = await client.get(repo_js_url)
-            response.raise_for_status()  # Raise an error for bad responses
+    try:
+        if am == add_mode.ADD_REPO:
+            # Mode 1: Directly append 'repo.js' to the repo URL
+            repo_js_url = urljoin(url, 'repo.js')
+        elif am == add_mode.ADD_PATCH:
+            # Mode 2: Assume the URL is for a patch, go one level up to get 'repo.js'
+            repo_js_url = urljoin(url, '../repo.js')
+        else:
+            raise ValueError("Invalid mode. Mode should be 1 for repo or 2 for patch.")
 
-            # Parse the JSON content
-            repo_info = response.json()
-            return repo_info
+        # Fetch and parse the repo.js content (shared with the other callers)
+        return await metadata.json(repo_js_url)
 
-        except httpx.HTTPStatusError as e:
-            log.error(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
-            sys.exit(1)
-        except json.JSONDecodeError:
-            log.error("Failed to decode JSON from the response.")
-            sys.exit(1)
-        except Exception as e:
-            log.error(f"An error occurred: {str(e)}")
-            sys.exit(1)
+    except httpx.HTTPStatusError as e:
+        log.error(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        log.error("Failed to decode JSON from the response.")
+        sys.exit(1)
+    except Exception as e:
+        log.error(f"An error occurred: {str(e)}")
+        sys.exit(1)
 
 # 生成镜像 patch 版本数据
 async def fetch_patch_ver(patch_ver: str):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(patch_ver)
-            response.raise_for_status()  # 如果请求失败则抛出异常
-            return sha256(response.content).hexdigest()
-        except Exception as e:
-            log.error(f"Error accessing {patch_ver}: {e}")
-            sys.exit(1)
+    try:
+        return await metadata.sha256(patch_ver)  # 如果请求失败则抛出异常
+    except Exception as e:
+        log.error(f"Error accessing {patch_ver}: {e}")
+        sys.exit(1)
 
 # 生成镜像站用 repo.js
-def generate_repo_js(repo_js, repo_dir: str, servers: str):
+# changed 为本次新增或更新的 patch，其余 patch 沿用已有的 repo.js 信息
+def generate_repo_js(repo_js, repo_dir: str, servers: str, changed=None):
+    index = open_index(os.path.dirname(repo_dir))
     if repo_js.get('id') == 'thpatch':
-        repo_build(repo_dir,repo_dir)
+        repo_build(repo_dir,repo_dir,index,changed)
     else:
         repo_js['servers'] = [servers]
         repo_js_path = os.path.join(repo_dir,"repo.js")
         try:
-            with open(repo_js_path,'w',encoding='utf-8') as f:
-                json.dump(repo_js,f,ensure_ascii=False,indent=4)
+            utils.json_store("repo.js", repo_js, dirs=[repo_dir])
         except IOError:
             log.error(f"Error writing to file {repo_js_path}.")
             return
-        repo_build(repo_dir,repo_dir)
+        repo_build(repo_dir,repo_dir,index,changed)
 
-# 下载 patch 文件
-async def download_patch(base_url: str, pfn: str, patch_dir: str, file_semaphore, rate_limit_kbps=1024, max_retries=5):
+# 下载 patch 文件（patch_urls 为提供相同文件的服务器，出错时依次切换）
+# 未传入 client 时使用本次运行共享的连接池；key 为运行状态中的 patch 名称（repo/patch）
+async def download_patch(patch_urls: list, pfn: str, patch_dir: str, file_semaphore, checksum=None, rate_limit_kbps=1024, max_retries=5, client=None, key=None):
     rate_limit_bps = rate_limit_kbps * 1024
+    file_path = os.path.normpath(os.path.join(patch_dir, pfn))  # 合成文件保存路径
     retry_count = 0
     success = False
     while retry_count < max_retries and not success:
         try:
+            base_url = patch_urls[retry_count % len(patch_urls)]
+            file_url = urljoin(format_url(base_url), f"{pfn}?=2233") # 合成文件的完整URL
             async with file_semaphore:
-                file_url = urljoin(format_url(base_url), f"{pfn}?=2233") # 合成文件的完整URL
-                file_path = os.path.normpath(os.path.join(patch_dir, pfn))  # 合成文件保存路径
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)  # 创建目录
-                file_name = os.path.basename(file_path)
-                file_dir = os.path.dirname(file_path)
-                temp_file_path = os.path.join(file_dir, f"{file_name}.downloading")
-                
-                async with httpx.AsyncClient() as client:
-
-                    async with client.stream("GET", file_url) as response:
-                        response.raise_for_status()
-                        with open(temp_file_path, "wb") as temp_file:
-                            async for chunk in response.aiter_bytes():
-                                temp_file.write(chunk)
-
-                                # Calculate sleep time to enforce rate limit
-                                time_to_sleep = len(chunk) / rate_limit_bps
-                                await asyncio.sleep(time_to_sleep)
-
-
-                # 如果目标文件已存在，先删除
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-                # 重命名文件为最终名称
-                os.rename(temp_file_path, file_path)
+                if retry_count == 0:
+                    status.current.begin(key)
+                # 下载并校验解码后的文件内容
+                size, _ = await transfer.download(client or metadata.client(), file_url, file_path, checksum, rate_limit_bps)
                 log.get(file_path)
                 success = True
+                status.current.end(key, size)
         
-        except (httpx.HTTPStatusError, httpx.RequestError, OSError) as e:
+        except (httpx.HTTPStatusError, httpx.RequestError, OSError, transfer.ChecksumMismatch) as e:
             retry_count += 1
+            status.current.retry()
             log.info(f"Error downloading: {file_path}    Retry {retry_count}/{max_retries}")
             if retry_count >= max_retries:
-                log.error(f"Failed to download {file_path} after {max_retries} retries.")
+                log.error(f"Failed to download {file_path} after {max_retries} retries: {e}")
+                status.current.end(key)
 
 # 从远端 repo 镜像指定 patch
-async def mirror_patch_from_repo(base_url: str, repo_dir: str, repo_id: str, ipatch=""):
+# 批量模式下传入共享的 client 与 semaphore；此时不写入 __files.js，而是跳过已下载且校验通过的文件
+async def mirror_patch_from_repo(base_url: str, repo_dir: str, repo_id: str, ipatch="", client=None, semaphore=None):
 
     # 获取 patch 文件列表
     patch_url = urljoin(format_url(base_url), ipatch)
     pn = get_last_path_segment(patch_url)
-    log.info(f"Mirroring {pn} ...")
-    file_info = await fetch_patch_file_info(patch_url)
-    flist = list(file_info.keys())
+    repo_url = urljoin(format_url(patch_url),'..')
     mirror_dir = os.path.dirname(repo_dir)
+    log.info(f"Mirroring {pn} ...")
 
-# 将ldpf数据转换为JSON数据并写入__files.js文件
-    ldpf_path = os.path.join(mirror_dir, "__files.js")
-    with open(ldpf_path, 'w', encoding='utf-8') as ldpf_file:
-        json.dump(file_info, ldpf_file, ensure_ascii=False, indent=4)
+    # 选择最快的上游服务器，并找出提供相同 files.js 的服务器
+    servers = await upstream.rank_servers(open_index(mirror_dir), repo_id, repo_url, log, metadata.get)
+    patch_urls = await upstream.patch_sources(servers, pn, digest=metadata.sha256)
+    file_info = await fetch_patch_file_info(patch_urls[0])
+
+    # 跳过稀疏镜像规则（thcrap_sparse.txt）排除的文件
+    spec = sparse_spec(repo_dir, pn)
+    if spec is not None:
+        skipped = [pfn for pfn in file_info if spec.match_file(pfn)]
+        for pfn in skipped:
+            del file_info[pfn]
+        if skipped:
+            log.info(f"{pn}: {len(skipped)} files skipped by sparse rules")
+    flist = list(file_info.keys())
 
     # 生成补丁路径
     patch_dir = os.path.join(repo_dir, pn)
 
-    # 设置最大并发数
-    semaphore = asyncio.Semaphore(10)
-    tasks = [download_patch(patch_url, pfn, patch_dir, semaphore) for pfn in flist]
+    if semaphore is None:
+        # 将ldpf数据转换为JSON数据并写入__files.js文件
+        ldpf_path = os.path.join(mirror_dir, "__files.js")
+        with open(ldpf_path, 'w', encoding='utf-8') as ldpf_file:
+            json.dump(file_info, ldpf_file, ensure_ascii=False, indent=4)
+
+        # 设置最大并发数
+        semaphore = asyncio.Semaphore(10)
+    else:
+        # 批量模式：重新运行时跳过已完成的文件
+        done = await asyncio.gather(*[check_file(pfn, file_info[pfn], patch_dir) for pfn in flist])
+        flist = [pfn for pfn, ok in zip(flist, done) if not ok]
+
+    key = f"{repo_id}/{pn}"
+    status.current.queue(key, len(flist))
+    tasks = [download_patch(upstream.stripe(patch_urls, i), pfn, patch_dir, semaphore, file_info[pfn], client=client, key=key) for i, pfn in enumerate(flist)]
     await asyncio.gather(*tasks)
 
-    # 生成 patch 版本文件
-    repo_url = urljoin(format_url(patch_url),'..')
-    await generate_mirror_info(mirror_dir, repo_url, repo_id, pn)
+    # 生成 patch 版本文件（files.js 与上面获取的为同一份，直接使用缓存计算散列值）
+    await generate_mirror_info(mirror_dir, repo_url, repo_id, pn, urljoin(format_url(patch_urls[0]), "files.js?=2233"))
 
 # 生成镜像 repo 版本信息
-async def generate_mirror_info(mirror_dir: str, repo_origin: str, repo_id: str, patch: str):
-
-    # 创建 JSON 文件的路径
-    json_file_path = os.path.join(mirror_dir, ".version", f"{repo_id}.json")
-    os.makedirs(os.path.dirname(json_file_path), exist_ok=True)
+# patch_ver 为用于计算版本散列值的 files.js 地址，默认取源地址
+async def generate_mirror_info(mirror_dir: str, repo_origin: str, repo_id: str, patch: str, patch_ver=None):
+    index = open_index(mirror_dir)
 
     # 生成 patch_ver URL
-    patch_ver = urljoin(format_url(repo_origin), f"{patch}/files.js?=2233")
+    if patch_ver is None:
+        patch_ver = urljoin(format_url(repo_origin), f"{patch}/files.js?=2233")
 
     # 使用异步方式访问 URL 并计算 SHA256 值
     hash_ver = await fetch_patch_ver(patch_ver)
     if hash_ver == None:
         return
 
-    # 检查文件是否存在以及是否需要更新
-    if os.path.exists(json_file_path):
-        # 读取现有文件内容
-        with open(json_file_path, 'r') as f:
-            existing_data = json.load(f)
-        try:
-            if isinstance(existing_data, dict) and 'origin' in existing_data and 'patches' in existing_data:
-                # 更新 patches
-                existing_data["patches"][patch] = hash_ver
-                with open(json_file_path, 'w') as f:
-                    json.dump(existing_data, f, indent=4)
-                return
-        except json.JSONDecodeError:
-            pass    # 文件内容不符合要求，继续到清空并重写
+    # 写入索引（已有 repo 则保留原有的源地址），并重新生成 .version 文件
+    if index.origin(repo_id) is None:
+        index.set_origin(repo_id, repo_origin)
+    index.set_patch_version(repo_id, patch, hash_ver)
+    await transfer.run_io(index.export_version, repo_id)
 
-    # 如果文件内容不符合要求，写入完整的 data 结构
-    data = {
-            "origin": repo_origin,
-            "patches": {patch: hash_ver}
-        }
-    with open(json_file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    # 记录 patch.js 中列出的上游服务器
+    patch_js_path = os.path.join(mirror_dir, repo_id, patch, "patch.js")
+    upstream.record_servers(index, repo_id, upstream.patch_js_servers(patch_js_path))
 
 # 判断 URL 指向为 repo 还是 patch
-def IsRepoOrServer(url: str):
+async def IsRepoOrServer(url: str):
     try:
-            # 创建一个 HTTP 客户端 
-            with httpx.Client() as client:
-
-                # 检查基本 URL 是否可访问
-                response = client.get(url,timeout=10)
-                if response.status_code == 200:
-                    log.succ(f"{url} is accessible.")
-                else:
-                    log.error(f"{url} is not accessible. Status code: {response.status_code}")
-                    sys.exit(1)
-
-                # 检查 base_url + repo.js 是否可访问
-                repo_js_url = url.rstrip('/') + '/repo.js'
-                response = client.get(repo_js_url, timeout=10)
-                if response.status_code == 200:
-                    log.succ("Find repo.js. This Repo contains:")
-                    print("- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -")
-                    return add_mode.ADD_REPO
-                else:
-
-                    # 检查 base_url + files.js 是否可访问
-                    files_js_url = url.rstrip('/') + '/files.js'
-                    response = client.get(files_js_url, timeout=10)
-                    if response.status_code == 200:
-                        log.succ("Find files.js. Downloading...")
-                        return add_mode.ADD_PATCH
-                    else:
-                        raise ValueError("Invalid URL, please check it to make sure is correct.")
+            # 同时请求基本 URL、repo.js 与 files.js，结果缓存供后续步骤使用
+            repo_js_url = url.rstrip('/') + '/repo.js'
+            files_js_url = url.rstrip('/') + '/files.js?=2233'
+            response, repo_response, files_response = await asyncio.gather(
+                metadata.get(url), metadata.get(repo_js_url), metadata.get(files_js_url)
+            )
+
+            # 检查基本 URL 是否可访问
+            if response.status_code == 200:
+                log.succ(f"{url} is accessible.")
+            else:
+                log.error(f"{url} is not accessible. Status code: {response.status_code}")
+                sys.exit(1)
+
+            # 检查 base_url + repo.js 是否可访问
+            if repo_response.status_code == 200:
+                log.succ("Find repo.js. This Repo contains:")
+                log.drain()
+                print("- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -")
+                return add_mode.ADD_REPO
+
+            # 检查 base_url + files.js 是否可访问
+            elif files_response.status_code == 200:
+                log.succ("Find files.js. Downloading...")
+                return add_mode.ADD_PATCH
+            else:
+                raise ValueError("Invalid URL, please check it to make sure is correct.")
     except httpx.RequestError as exc:
         log.error(f"An error occurred while requesting {url}: {exc}")
         sys.exit(1)
@@ -340,24 +492,21 @@ def IsRepoOrServer(url: str):
         sys.exit(1)
 
 # 枚举 repo 包含的 patch ，并返回 patch 列表
-def enumerate_patch(url: str):
+async def enumerate_patch(url: str):
     """
     从指定URL获取JSON数据并解析，输出其中所包含的补丁(patch)，并返回补丁列表
     """
     # 得到repo.js的URL
     repo_js_url = url.rstrip('/') + '/repo.js'
 
-    # 从URL获取JSON数据
-    response = httpx.get(repo_js_url)
-    response.raise_for_status()  # 收集错误访问代码
-
-    # 解析JSON数据
-    parsed_data = response.json()
+    # 从URL获取JSON数据（收集错误访问代码）
+    parsed_data = await metadata.json(repo_js_url)
 
     # 获取patch列表
     patches = parsed_data.get("patches", {})
 
-    # 格式化输出patch列表
+    # 格式化输出patch列表（先写出队列中的日志，保持输出顺序）
+    log.drain()
     for i, (patch, description) in enumerate(patches.items(), start=1):
         print(f"{i}: {patch} - {description}")
     print("- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -")
@@ -365,34 +514,18 @@ def enumerate_patch(url: str):
 
 # 将不需要定期镜像的 patch 从镜像列表删除，以减少镜像开销。
 def delete_mirror_item(mirror_dir: str, repo_id: str, patch: str):
-    # 构造出 version_dir 路径
-    version_dir = os.path.join(mirror_dir, '.version')
-    
-    # 构造出 repo_id.json 的完整路径
-    fv_path = os.path.join(version_dir, f'{repo_id}.json')
-    
-    # 检查 repo_id.json 文件是否存在
-    if os.path.exists(fv_path):
-        with open(fv_path, 'r') as file:
-            data = json.load(file)
-        
-        # 检查并删除 patches 中的对应项
-        if 'patches' in data and patch in data['patches']:
-            del data['patches'][patch]
-        
-        # 如果 patches 为空，则删除整个 repo_id.json 文件
-        if not data.get('patches'):
-            os.remove(fv_path)
-        else:
-            # 如果有其它内容，写回文件
-            with open(fv_path, 'w') as file:
-                json.dump(data, file, indent=4)
-    
+    # 从索引中移除该 patch，并重新生成 repo_id.json（patches 为空时删除该文件）
+    index = open_index(mirror_dir)
+    index.untrack_patch(repo_id, patch)
+    index.export_version(repo_id)
+
     # 检查 .version 文件夹是否为空
+    version_dir = os.path.join(mirror_dir, '.version')
     if os.path.isdir(version_dir) and not os.listdir(version_dir):
         os.rmdir(version_dir)
 
 def remove_mirror_list(mirror_dir: str, repo_id: str, patch_data: list):
+    log.drain()
     print("Which patches are one-time (no updates required):")
     print("- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -")
     for i, patch in enumerate(patch_data, start=1):
@@ -515,6 +648,15 @@ def clean_add_info(mirror_dir: str):
     if os.path.exists(file_js_path):
         os.remove(file_js_path)
 
+# 获取 repo 锁，若该 repo 正在被同步则在工作线程中等待（不阻塞状态文件的写出）
+async def wait_repo_lock(mirror_dir: str, repo_id: str):
+    lock = locks.repo_lock(mirror_dir, repo_id)
+    try:
+        return lock.acquire()
+    except locks.LockHeld:
+        log.info(f"{repo_id} is being synced by another run, waiting...")
+        return await asyncio.to_thread(lock.acquire, True)
+
 # 恢复上次因意外退出而中断的下载任务
 async def backup_task(config: dict):
     mirror_dir = config['mirror_dir']
@@ -526,9 +668,12 @@ async def backup_task(config: dict):
     else:
         repo_id, repo_url, lp, dp, pf = load_add_info(mirror_dir)
     log.info("Interrupted download detected! Recovering...")
+    status.current.set_phase("resuming interrupted download")
     repo_dir = os.path.join(mirror_dir, repo_id)
+    lock = await wait_repo_lock(mirror_dir, repo_id)
     dp_dir = os.path.join(mirror_dir, dp)
-    patch_url = urljoin(format_url(repo_url), dp)
+    servers = await upstream.rank_servers(open_index(mirror_dir), repo_id, repo_url, log, metadata.get)
+    patch_urls = await upstream.patch_sources(servers, dp, digest=metadata.sha256)
     file_semaphore = asyncio.Semaphore(10)
 
     # 创建文件检查任务
@@ -536,10 +681,12 @@ async def backup_task(config: dict):
     check_res = await asyncio.gather(*check_tasks)
 
     # 创建下载任务
+    key = f"{repo_id}/{os.path.basename(os.path.normpath(dp))}"
     download_tasks = []
     for i, (pfn, checksum) in enumerate(pf.items()):
         if not check_res[i]:  # 只有在文件不存在或校验失败时才下载
-            download_tasks.append(download_patch(patch_url, pfn, dp_dir, file_semaphore))
+            download_tasks.append(download_patch(upstream.stripe(patch_urls, i), pfn, dp_dir, file_semaphore, checksum, key=key))
+    status.current.queue(key, len(download_tasks))
     await asyncio.gather(*download_tasks)
 
     await generate_mirror_info(mirror_dir, repo_url, repo_id, dp)
@@ -556,7 +703,7 @@ async def backup_task(config: dict):
     # 生成镜像站用 repo.js
     mirror_repo_url = format_url(urljoin(format_url(config['site_url']), repo_id))
     repo_js = await fetch_repo_info(repo_url)
-    generate_repo_js(repo_js, repo_dir, repo_url)
+    await asyncio.to_thread(generate_repo_js, repo_js, repo_dir, repo_url, set(lp) | {dp})
 
     # 构建镜像站索引
     if repo_id != 'thpatch':
@@ -565,14 +712,189 @@ async def backup_task(config: dict):
 
     # 清理状态记录文件
     clean_add_info(mirror_dir)
+    lock.release()
 
+    log.drain()
     user_option = input("Download Completed! Continue to add? (Y/n):")
     if user_option.upper() == 'Y':
         pass
     else:
         sys.exit(0)
 
+# 按选择规则筛选 patch：无规则时全选，'!pattern' 排除
+def select_patches(patches: list, rules: list):
+    include = [rule for rule in rules if not rule.startswith('!')]
+    exclude = [rule[1:] for rule in rules if rule.startswith('!')]
+    return [
+        patch for patch in patches
+        if (not include or any(fnmatch.fnmatchcase(patch, rule) for rule in include))
+        and not any(fnmatch.fnmatchcase(patch, rule) for rule in exclude)
+    ]
+
+# 读取批量添加列表：每行为 URL 以及可选的 patch 选择规则
+def load_batch(args):
+    entries = [(url, args.select) for url in args.urls]
+    if args.batch:
+        with open(args.batch, 'r', encoding='utf-8') as f:
+            for line in f:
+                words = line.split('#', 1)[0].split()
+                if words:
+                    entries.append((words[0], words[1:]))
+    return entries
+
+# 解析批量添加的所有 URL（并按需沿 neighbors 爬取），返回 {repo: {"url", "js", "patches", "failed"}}
+async def resolve_batch(config: dict, args):
+    mirror_dir = config['mirror_dir']
+    repos = {}
+
+    def add_entry(repo_url, repo_js, patches):
+        repo_id = config['thpatch'] if repo_js['id'] == 'thpatch' else repo_js['id']
+        entry = repos.setdefault(repo_id, {"url": repo_url, "js": repo_js, "patches": [], "failed": []})
+        entry["patches"] += [patch for patch in patches if patch not in entry["patches"]]
+
+    # 先解析全部 URL，任何一个无效都会在下载开始前退出
+    status.current.set_phase("resolving URLs")
+    for url, rules in load_batch(args):
+        base_url = format_url(url)
+        am = await IsRepoOrServer(base_url)
+        repo_js = await fetch_repo_info(base_url, am)
+        if am == add_mode.ADD_REPO:
+            add_entry(base_url, repo_js, select_patches(list(repo_js.get('patches', {})), rules))
+        else:
+            add_entry(urljoin(base_url, ".."), repo_js, [get_last_path_segment(base_url)])
+
+    # 沿 neighbors 爬取 repo 网络；已镜像的 repo 由 mirror_repo.py 同步，不再重复添加
+    if args.crawl:
+        status.current.set_phase("crawling neighbors")
+        mirrored = open_index(mirror_dir).repos()
+        seeds = [entry["url"] for entry in repos.values()]
+        for repo_url, repo_js in await neighbors.crawl(metadata.json, seeds, log, args.allow, args.deny, args.depth):
+            repo_id = config['thpatch'] if repo_js['id'] == 'thpatch' else repo_js['id']
+            if repo_id in repos:
+                continue
+            if repo_id in mirrored:
+                log.info(f"{repo_id} is already mirrored, skipping.")
+                continue
+            patches = select_patches(list(repo_js.get('patches', {})), args.select)
+            if patches:
+                add_entry(repo_url, repo_js, patches)
+    return repos
+
+# 估计 patch 的下载：跳过稀疏镜像规则排除的文件与已下载且校验通过的文件，文件大小取自 HEAD 请求
+async def plan_patch(mirror_dir: str, repo_id: str, entry: dict, patch: str):
+    repo_dir = os.path.join(mirror_dir, repo_id)
+    servers = await upstream.rank_servers(open_index(mirror_dir), repo_id, entry["url"], log, metadata.get)
+    patch_urls = await upstream.patch_sources(servers, patch, digest=metadata.sha256)
+    file_info = await fetch_patch_file_info(patch_urls[0])
+    spec = sparse_spec(repo_dir, patch)
+    flist = [pfn for pfn in file_info if spec is None or not spec.match_file(pfn)]
+    done = await asyncio.gather(*[check_file(pfn, file_info[pfn], os.path.join(repo_dir, patch)) for pfn in flist])
+    flist = [pfn for pfn, ok in zip(flist, done) if not ok]
+    sizes = await transfer.head_sizes(metadata.client(), [
+        urljoin(format_url(upstream.stripe(patch_urls, i)[0]), f"{pfn}?=2233") for i, pfn in enumerate(flist)
+    ])
+    return {
+        "repo": repo_id,
+        "patch": patch,
+        "update": len(flist),
+        "remove": 0,
+        "bytes": sum(size for size in sizes if size is not None),
+        "unknown": sizes.count(None),
+    }
+
+# 生成批量添加计划：输出各 patch 需要下载的文件及预计耗时，并按需保存供 --apply-plan 执行
+async def plan_batch(config: dict, args):
+    mirror_dir = config['mirror_dir']
+    repos = await resolve_batch(config, args)
+    saved = plan.new_plan()
+    saved["repos"] = {
+        repo_id: {"url": entry["url"], "js": entry["js"], "patches": entry["patches"]}
+        for repo_id, entry in repos.items()
+    }
+    saved["patches"] = await asyncio.gather(*[
+        plan_patch(mirror_dir, repo_id, entry, patch) for repo_id, entry in repos.items() for patch in entry["patches"]
+    ])
+    history_path = args.history or os.path.join(mirror_dir, history.HISTORY_FN)
+    saved["eta"] = plan.estimate(saved, await asyncio.to_thread(plan.throughput, history_path, saved["script"]))
+    plan.report(saved, log)
+    if args.save_plan:
+        await asyncio.to_thread(plan.save, args.save_plan, saved)
+        log.succ(f"Plan written to {args.save_plan}, add the patches with --apply-plan {args.save_plan}")
+
+# 批量添加：解析所有 URL，按 repo 分组后并发镜像，最后每个 repo 只生成一次 repo.js 与索引
+# repos 为 --apply-plan 载入的计划中的 repo，给出时不再解析 URL
+async def batch_add(config: dict, args, repos=None):
+    mirror_dir = config['mirror_dir']
+    if repos is None:
+        repos = await resolve_batch(config, args)
+    client = metadata.client()
+
+    for repo_id, entry in repos.items():
+        log.info(f"{repo_id}: {len(entry['patches'])} patches to mirror ({', '.join(entry['patches'])})")
+
+    # 获取所有 repo 的锁（出错时也释放已获取的锁），并预先选择各 repo 的上游服务器
+    held = []
+    try:
+        for repo_id in sorted(repos):
+            held.append(await wait_repo_lock(mirror_dir, repo_id))
+        for repo_id, entry in repos.items():
+            await upstream.rank_servers(open_index(mirror_dir), repo_id, entry["url"], log, metadata.get)
+
+        # 所有 patch 共用一个连接池与下载队列
+        jobs = asyncio.Semaphore(max(args.jobs, 1))
+        file_semaphore = asyncio.Semaphore(10)
+        async def mirror(repo_id, entry, patch):
+            async with jobs:
+                repo_dir = os.path.join(mirror_dir, repo_id)
+                try:
+                    await mirror_patch_from_repo(entry["url"], repo_dir, repo_id, patch, client, file_semaphore)
+                except Exception as e:
+                    # 单个 patch 失败不影响其他 patch，重新运行同一批量任务即可继续
+                    log.error(f"Failed to mirror {repo_id}/{patch}: {str(e)}")
+                    entry["failed"].append(patch)
+
+        status.current.set_phase(f"mirroring {sum(len(entry['patches']) for entry in repos.values())} patches")
+        await asyncio.gather(*[
+            mirror(repo_id, entry, patch) for repo_id, entry in repos.items() for patch in entry["patches"]
+        ])
+
+        # 每个 repo 只生成一次镜像站用 repo.js 与索引
+        status.current.set_phase("building repo.js and index")
+        for repo_id, entry in repos.items():
+            entry["patches"] = [patch for patch in entry["patches"] if patch not in entry["failed"]]
+            repo_dir = os.path.join(mirror_dir, repo_id)
+            if repo_id != config['thpatch']:
+                for patch in select_patches(entry["patches"], args.one_time) if args.one_time else []:
+                    delete_mirror_item(mirror_dir, repo_id, patch)
+            mirror_repo_url = format_url(urljoin(format_url(config['site_url']), repo_id))
+            await asyncio.to_thread(generate_repo_js, entry["js"], repo_dir, mirror_repo_url, set(entry["patches"]))
+            if repo_id != 'thpatch':
+                thpatch_dir = os.path.join(config['mirror_dir'], config['thpatch'])
+                build_index(thpatch_dir, repo_id, mirror_repo_url)
+    finally:
+        for lock in held:
+            lock.release()
+    log.succ(f"Mirrored {sum(len(entry['patches']) for entry in repos.values())} patches from {len(repos)} repos.")
+    failed = [f"{repo_id}/{patch}" for repo_id, entry in repos.items() for patch in entry["failed"]]
+    if failed:
+        log.error(f"Failed: {', '.join(failed)}")
+    transfer.stats.report(log)
+
 async def main():
+    args = parser.parse_args()
+    log.configure(args.progress, args.log_format)
+    args.plan = args.plan or args.save_plan is not None
+    batch = bool(args.urls or args.batch)
+    if args.plan and not batch:
+        parser.error("--plan needs repo or patch URLs, or a batch file")
+    if args.apply_plan and (batch or args.plan):
+        parser.error("--apply-plan cannot be used with URLs, --batch or --plan")
+
+    # 批量模式不会询问配置
+    if (batch or args.apply_plan) and not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')):
+        log.error("Missing configuration file, run the script once without arguments to create it.")
+        sys.exit(1)
+
     # 载入用户设置
     try:
         config = load_config()
@@ -585,13 +907,37 @@ async def main():
     # 用户配置预处理
     mirror_dir = config['mirror_dir']
 
+    # 只生成计划，不写出运行状态，也不记录运行历史
+    if args.plan:
+        await plan_batch(config, args)
+        return
+    status.current.path = args.status or os.path.join(mirror_dir, status.ADD_STATUS_FN)
+    global history_path
+    history_path = args.history or os.path.join(mirror_dir, history.HISTORY_FN)
+
+    # 批量模式：不进行任何交互
+    if args.apply_plan:
+        try:
+            saved = plan.load(args.apply_plan)
+        except (OSError, ValueError) as e:
+            log.error(f"Could not load the plan: {e}")
+            sys.exit(1)
+        repos = {repo_id: dict(entry, failed=[]) for repo_id, entry in saved["repos"].items()}
+        await batch_add(config, args, repos)
+        return
+    if batch:
+        await batch_add(config, args)
+        return
+
     # 恢复未完成的下载任务（若存在）
     await backup_task(config)
 
     # 用户输入 repo 或 patch 公共 URL
+    status.current.set_phase("waiting for input")
+    log.drain()
     base_url = input("Please input URL(Repo or Patch):")
     base_url = format_url(base_url)
-    am = IsRepoOrServer(base_url)
+    am = await IsRepoOrServer(base_url)
 
     repo_js = await fetch_repo_info(base_url, am)
     repo_id = repo_js['id']
@@ -602,12 +948,13 @@ async def main():
 
     # 合成镜像站 repo 地址
     repo_dir = os.path.join(mirror_dir, repo_id)
+    lock = await wait_repo_lock(mirror_dir, repo_id)
 
     # 检测到输入的 URL 为 repo 地址
     try:
         lrmp = []
         if am == add_mode.ADD_REPO:
-            lp = enumerate_patch(base_url)
+            lp = await enumerate_patch(base_url)
             patch_input = input(f"Select the appropriate patch numbers(1-{len(lp)}) separated by commas and/or spaces, or leave input blank to select all options shown (Enter 'c' to cancel):")
             lu = re.split(r'[,\s]+',patch_input.strip())
             # 用户一次加入多个 patch
@@ -630,6 +977,7 @@ async def main():
                         if i in lap:
                             lap.remove(i)
                         save_add_info(mirror_dir, repo_id, base_url, lap, i)
+                        status.current.set_phase(f"mirroring {repo_id}/{i}")
                         await mirror_patch_from_repo(base_url, repo_dir, repo_id, i)
 
                     lrmp = lmp
@@ -639,6 +987,7 @@ async def main():
             repo_url = urljoin(base_url, "..")
             pn = get_last_path_segment(base_url)
             save_add_info(mirror_dir, repo_id, repo_url, [], pn)
+            status.current.set_phase(f"mirroring {repo_id}/{pn}")
             await mirror_patch_from_repo(base_url, repo_dir, repo_id)
             lrmp = [pn]
 
@@ -653,8 +1002,9 @@ async def main():
         sys.exit(1)
 
     # 生成镜像站用 repo.js
+    status.current.set_phase("building repo.js and index")
     mirror_repo_url = format_url(urljoin(format_url(config['site_url']), repo_id))
-    generate_repo_js(repo_js,repo_dir,mirror_repo_url)
+    await asyncio.to_thread(generate_repo_js, repo_js, repo_dir, mirror_repo_url, set(lrmp))
 
     # 构建镜像站索引
     if repo_id != 'thpatch':
@@ -663,5 +1013,34 @@ async def main():
 
     # 清理状态记录文件
     clean_add_info(mirror_dir)
+    lock.release()
+
+    # 输出各主机的传输量与压缩率
+    transfer.stats.report(log)
 
-asyncio.run(main())
\ No newline at end of file
+# 运行历史记录文件，载入配置后设置
+history_path = None
+
+# 运行期间定时写出状态文件，结束时关闭共享的连接池，并记录本次运行（已载入配置时）
+async def run():
+    writer = asyncio.create_task(status.current.write_loop(transfer.stats.hosts))
+    outcome = "failed"
+    try:
+        await main()
+        outcome = "ok"
+    except SystemExit as e:
+        # 用户选择不再继续添加时以状态码 0 退出
+        if e.code in (0, None):
+            outcome = "ok"
+        raise
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        outcome = "stopped"
+        raise
+    finally:
+        writer.cancel()
+        status.current.finish(transfer.stats.hosts, outcome)
+        await metadata.close()
+        if history_path:
+            history.append(history_path, history.record(status.current, transfer.stats.hosts, outcome))
+
+asyncio.run(run())
\ No newline at end of file
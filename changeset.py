@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# changeset.py
+# 主节点与边缘节点之间的增量同步
+# 功能：
+# 1.主节点每次同步后导出变更集：各 patch 更新与删除的文件、重新生成的 files.js/patch.js/repo.js 以及 .version 信息
+# 2.可选地将变更文件打包为 .tar.gz 归档
+# 3.边缘节点使用 apply 命令导入变更集：先暂存并校验全部文件，再统一替换，中断后可重新执行
+# 用法：
+#   python changeset.py apply <manifest.json|archive.tar.gz> [-m mirror_dir] [--source path_or_url] [--force]
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+from urllib.parse import urljoin
+from zlib import crc32
+
+import locks
+import transfer
+from manifest_index import open_index
+from utils import format_url
+
+STAGING_DIR = '.changeset-staging'
+STATE_FN = '.changeset.json'
+
+
+class Changeset:
+    """Collects the files updated and removed in every patch during a
+    mirror run."""
+
+    def __init__(self):
+        self.patches = {}
+
+    def __bool__(self):
+        return bool(self.patches)
+
+    def touch(self, repo_id: str, patch: str):
+        """Records that the metadata of [patch] was regenerated, even if
+        none of its files changed."""
+        self.patches.setdefault(repo_id, {}).setdefault(patch, (set(), set()))
+
+    def record(self, repo_id: str, patch: str, updated, removed):
+        if not updated and not removed:
+            return
+        entry = self.patches.setdefault(repo_id, {}).setdefault(patch, (set(), set()))
+        entry[0].update(updated)
+        entry[0].difference_update(removed)
+        entry[1].update(removed)
+        entry[1].difference_update(updated)
+
+
+# 计算文件 CRC32 与大小
+def file_crc32(path: str):
+    checksum = 0
+    size = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            checksum = crc32(chunk, checksum)
+            size += len(chunk)
+    return [checksum & 0xFFFFFFFF, size]
+
+
+# 导出变更集，返回清单文件路径
+def export(changes: Changeset, mirror_dir: str, out_dir: str, pack=False):
+    """Writes the manifest of [changes] to [out_dir]/<id>.json and, if
+    [pack] is set, every listed file to [out_dir]/<id>.tar.gz. File
+    checksums are taken from the files as they are now in [mirror_dir]."""
+    index = open_index(mirror_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    latest_path = os.path.join(out_dir, 'latest.json')
+    previous = None
+    if os.path.exists(latest_path):
+        with open(latest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f).get('id')
+
+    changeset_id = time.strftime('%Y%m%dT%H%M%S', time.gmtime()) + f"-{time.time_ns() % 1000000:06d}"
+    manifest = {
+        "id": changeset_id,
+        "previous": previous,
+        "patches": {},
+        "metadata": {},
+        "versions": {},
+    }
+    for repo_id, patches in sorted(changes.patches.items()):
+        repo_dir = os.path.join(mirror_dir, repo_id)
+        manifest["patches"][repo_id] = {}
+        for patch, (updated, removed) in sorted(patches.items()):
+            patch_dir = os.path.join(repo_dir, patch)
+            manifest["patches"][repo_id][patch] = {
+                "updated": {
+                    pfn: file_crc32(os.path.join(patch_dir, pfn))
+                    for pfn in sorted(updated) if os.path.isfile(os.path.join(patch_dir, pfn))
+                },
+                "removed": sorted(removed),
+            }
+            for fn in ('files.js', 'patch.js'):
+                if os.path.isfile(os.path.join(patch_dir, fn)):
+                    manifest["metadata"][f"{repo_id}/{patch}/{fn}"] = file_crc32(os.path.join(patch_dir, fn))
+        if os.path.isfile(os.path.join(repo_dir, 'repo.js')):
+            manifest["metadata"][f"{repo_id}/repo.js"] = file_crc32(os.path.join(repo_dir, 'repo.js'))
+        manifest["versions"][repo_id] = {
+            "origin": index.origin(repo_id),
+            "patches": index.patches(repo_id),
+        }
+
+    manifest_path = os.path.join(out_dir, f"{changeset_id}.json")
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+    if pack:
+        with tarfile.open(os.path.join(out_dir, f"{changeset_id}.tar.gz"), 'w:gz') as tar:
+            tar.add(manifest_path, arcname='manifest.json')
+            for rel in changed_files(manifest):
+                tar.add(os.path.join(mirror_dir, rel), arcname=f"files/{rel}")
+
+    with open(latest_path, 'w', encoding='utf-8') as f:
+        json.dump({"id": changeset_id}, f, indent=4)
+    return manifest_path
+
+
+# 检查变更集中的相对路径：不能是绝对路径，也不能离开镜像站目录（如 ../x）
+def check_path(rel: str):
+    norm = os.path.normpath(rel)
+    if os.path.isabs(rel) or os.path.splitdrive(rel)[0] or norm == os.curdir or norm.split(os.sep)[0] == os.pardir:
+        raise ValueError(f"Invalid path in changeset: {rel!r}")
+    return rel
+
+
+# 列出变更集中需要写入的全部文件 {相对路径: [crc32, size]}
+def changed_files(manifest: dict):
+    files = {}
+    for repo_id, patches in manifest["patches"].items():
+        for patch, entry in patches.items():
+            for pfn, info in entry["updated"].items():
+                files[check_path(f"{repo_id}/{patch}/{pfn}")] = info
+            for pfn in entry["removed"]:
+                check_path(f"{repo_id}/{patch}/{pfn}")
+    for rel, info in manifest["metadata"].items():
+        files[check_path(rel)] = info
+    for repo_id in manifest["versions"]:
+        check_path(repo_id)
+    return files
+
+
+# 将变更集中的文件暂存到 staging 目录并校验
+async def stage(files: dict, staging: str, archive=None, source=None):
+    if archive:
+        with tarfile.open(archive, 'r:*') as tar:
+            for rel in files:
+                member = tar.extractfile(f"files/{rel}")
+                if member is None:
+                    raise ValueError(f"{rel} is missing from {archive}.")
+                path = os.path.join(staging, rel)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(member, f)
+    elif source and source.startswith(('http://', 'https://')):
+        async with transfer.new_client() as client:
+            semaphore = asyncio.Semaphore(10)
+
+            async def fetch(rel, crc):
+                async with semaphore:
+                    await transfer.download(client, urljoin(format_url(source), rel), os.path.join(staging, rel), crc)
+            await asyncio.gather(*[fetch(rel, info[0]) for rel, info in files.items()])
+    elif source:
+        for rel in files:
+            path = os.path.join(staging, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(os.path.join(source, rel), path)
+    else:
+        raise ValueError("A manifest without archive needs --source.")
+
+    for rel, (crc, size) in files.items():
+        if file_crc32(os.path.join(staging, rel)) != [crc, size]:
+            raise transfer.ChecksumMismatch(f"{rel} does not match the changeset.")
+
+
+# 删除文件，并向上清理空文件夹
+def remove_file(mirror_dir: str, rel: str):
+    path = os.path.join(mirror_dir, rel)
+    if os.path.isfile(path):
+        os.remove(path)
+    current_dir = os.path.dirname(path)
+    while os.path.normpath(current_dir) != os.path.normpath(mirror_dir):
+        try:
+            os.rmdir(current_dir)
+            current_dir = os.path.dirname(current_dir)
+        except OSError:
+            break
+
+
+# 导入变更集
+async def apply(path: str, mirror_dir: str, source=None, force=False):
+    """Applies a changeset manifest or archive to [mirror_dir].
+
+    Every file is first staged and verified. Only then are the files moved
+    into place, removed files deleted, and the index and `.version` files
+    updated. If the commit is interrupted, running the same apply again
+    finishes it."""
+    archive = None
+    if tarfile.is_tarfile(path):
+        archive = path
+        with tarfile.open(path, 'r:*') as tar:
+            manifest = json.load(tar.extractfile('manifest.json'))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+    # 导入期间持有变更集锁，垃圾清理不会删除暂存中的文件
+    with locks.changeset_lock(mirror_dir):
+        state_path = os.path.join(mirror_dir, STATE_FN)
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        if state.get('last') == manifest['id']:
+            print(f"Changeset {manifest['id']} is already applied.")
+            return
+        if not force and state.get('last') != manifest['previous'] and state.get('pending') != manifest['id']:
+            raise ValueError(
+                f"Changeset {manifest['id']} follows {manifest['previous']}, "
+                f"but the last applied one is {state.get('last')}. Use --force to apply it anyway."
+            )
+
+        files = changed_files(manifest)
+        staging = os.path.join(mirror_dir, STAGING_DIR, check_path(manifest['id']))
+        if state.get('pending') != manifest['id']:
+            await stage(files, staging, archive, source)
+            state['pending'] = manifest['id']
+            with open(state_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=4)
+
+        # 提交：替换文件、删除文件、更新索引与版本信息
+        for rel, info in files.items():
+            staged = os.path.join(staging, rel)
+            target = os.path.join(mirror_dir, rel)
+            if os.path.exists(staged):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(staged, target)
+            elif not os.path.exists(target) or file_crc32(target) != info:
+                raise ValueError(f"{rel} is neither staged nor in place, the changeset has to be staged again.")
+
+        index = open_index(mirror_dir)
+        for repo_id, patches in manifest["patches"].items():
+            for patch, entry in patches.items():
+                for pfn in entry["removed"]:
+                    remove_file(mirror_dir, f"{repo_id}/{patch}/{pfn}")
+                index.remove_files(repo_id, patch, entry["removed"])
+                rows = []
+                for pfn, (crc, size) in entry["updated"].items():
+                    rows.append((pfn, crc, size, os.stat(os.path.join(mirror_dir, repo_id, patch, pfn)).st_mtime, None))
+                if f"{repo_id}/{patch}/patch.js" in manifest["metadata"]:
+                    crc, size = manifest["metadata"][f"{repo_id}/{patch}/patch.js"]
+                    rows.append(('patch.js', crc, size, os.stat(os.path.join(mirror_dir, repo_id, patch, 'patch.js')).st_mtime, None))
+                index.record_files(repo_id, patch, rows)
+
+        for repo_id, version in manifest["versions"].items():
+            if version["origin"]:
+                index.set_origin(repo_id, version["origin"])
+            for patch in index.patches(repo_id):
+                if patch not in version["patches"]:
+                    index.untrack_patch(repo_id, patch)
+            for patch, patch_hash in version["patches"].items():
+                index.set_patch_version(repo_id, patch, patch_hash)
+            index.export_version(repo_id)
+
+        shutil.rmtree(staging, ignore_errors=True)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({"last": manifest['id']}, f, indent=4)
+    print(f"Applied changeset {manifest['id']}: {len(files)} files written.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply a changeset exported by mirror_repo.py --changeset.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    apply_parser = subparsers.add_parser('apply', help='Import a changeset into this mirror')
+    apply_parser.add_argument('changeset', help='Manifest (.json) or archive (.tar.gz) of the changeset')
+    apply_parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                              help='The mirror directory')
+    apply_parser.add_argument('--source', metavar='path_or_url', default=None, type=str,
+                              help='Primary mirror tree (directory or public URL) to read files from '
+                                   'when applying a manifest without archive')
+    apply_parser.add_argument('--force', action='store_true',
+                              help='Apply even if the previous changeset was not applied here')
+    arg = parser.parse_args()
+    try:
+        asyncio.run(apply(arg.changeset, arg.m, arg.source, arg.force))
+    except (ValueError, OSError, transfer.ChecksumMismatch, locks.LockHeld) as e:
+        print(f"Failed to apply changeset: {e}", file=sys.stderr)
+        sys.exit(1)
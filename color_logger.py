@@ -1,6 +1,10 @@
 # color_logger.py
+import atexit
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from colorama import Fore, Style, init
 import os
 from datetime import datetime
@@ -21,16 +25,27 @@ logging.addLevelName(GET_LEVEL_NUM, "GET")
 logging.addLevelName(UPDATE_LEVEL_NUM, "UPDATE")
 logging.addLevelName(REMOVE_LEVEL_NUM, "REMOVE")
 
+# Levels logged once per file, which the console can aggregate
+FILE_LEVELS = {
+    GET_LEVEL_NUM: "downloaded",
+    UPDATE_LEVEL_NUM: "updated",
+    REMOVE_LEVEL_NUM: "removed",
+}
+
 class ColorLogger:
+    """Logger whose records are handed to a queue and written to the
+    console (and, if [log_to_file] is set, to a daily rotating log file)
+    by a listener thread, so that logging never blocks the caller."""
+
     def __init__(self, name=__name__, log_to_file=False, log_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")):
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.DEBUG)
 
         # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(self.CustomFormatter())
-        self.logger.addHandler(console_handler)
-        
+        self.console_handler = self.AggregatingHandler()
+        self.console_handler.setFormatter(self.CustomFormatter())
+        handlers = [self.console_handler]
+
         # File handler
         if log_to_file:
             if not os.path.exists(log_dir):
@@ -39,13 +54,42 @@ class ColorLogger:
             file_handler = TimedRotatingFileHandler(log_filename, when='midnight', interval=1, backupCount=7)
             file_handler.suffix = "%Y-%m-%d"
             file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-            self.logger.addHandler(file_handler)
-        
+            handlers.append(file_handler)
+
+        # Records are written by the listener thread
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(log_queue))
+        self.listener = QueueListener(log_queue, *handlers)
+        self.listener.start()
+        atexit.register(self.close)
+
         # Add custom logging methods
         self.logger.succ = self.succ
         self.logger.get = self.get
         self.logger.update = self.update
         self.logger.remove = self.remove
+        self.logger.configure = self.configure
+        self.logger.drain = self.drain
+
+    def configure(self, progress=None, log_format='text'):
+        """Collapses the per-file console lines into one progress line every
+        [progress] seconds (the log file keeps every line), and writes the
+        console output as JSON lines if [log_format] is 'json'."""
+        self.console_handler.interval = progress
+        if log_format == 'json':
+            self.console_handler.setFormatter(self.JsonFormatter())
+        else:
+            self.console_handler.setFormatter(self.CustomFormatter())
+
+    def drain(self):
+        """Waits until every queued record is written. Logging can go on
+        afterwards."""
+        self.close()
+        self.listener.start()
+
+    def close(self):
+        self.listener.stop()
+        self.console_handler.flush_progress()
 
     # Define custom logging functions
     def succ(self, message, *args, **kws):
@@ -64,10 +108,38 @@ class ColorLogger:
         if self.logger.isEnabledFor(REMOVE_LEVEL_NUM):
             self.logger._log(REMOVE_LEVEL_NUM, message, args, **kws)
 
-    class CustomFormatter(logging.Formatter):
-        # Define format string
-        format_str = "%(levelname)s: %(message)s"
+    class AggregatingHandler(logging.StreamHandler):
+        """Console handler that, once [interval] is set, counts the per-file
+        records instead of writing them, and writes the counts at most
+        once every [interval] seconds."""
+
+        def __init__(self):
+            super().__init__()
+            self.interval = None
+            self.counts = dict.fromkeys(FILE_LEVELS.values(), 0)
+            self.pending = 0
+            self.last = time.monotonic()
+
+        def emit(self, record):
+            if self.interval is None or record.levelno not in FILE_LEVELS:
+                # Pending counts are written before the next regular line
+                self.flush_progress()
+                super().emit(record)
+                return
+            self.counts[FILE_LEVELS[record.levelno]] += 1
+            self.pending += 1
+            if time.monotonic() - self.last >= self.interval:
+                self.flush_progress()
+
+        def flush_progress(self):
+            if not self.pending:
+                return
+            message = "Progress: " + ", ".join(f"{count} files {action}" for action, count in self.counts.items() if count)
+            super().emit(logging.LogRecord("progress", logging.INFO, "", 0, message, None, None))
+            self.pending = 0
+            self.last = time.monotonic()
 
+    class CustomFormatter(logging.Formatter):
         # Define colors for different levels
         LEVEL_COLORS = {
             logging.DEBUG: Fore.CYAN,
@@ -81,13 +153,27 @@ class ColorLogger:
             REMOVE_LEVEL_NUM: Fore.RED,
         }
 
+        def __init__(self):
+            super().__init__()
+            self.formatters = {}
+
         def format(self, record):
-            levelname = record.levelname
-            level_color = self.LEVEL_COLORS.get(record.levelno, "")
-            format_str = f"[{level_color}%(levelname)s{Style.RESET_ALL}]   \t%(message)s"
-            formatter = logging.Formatter(format_str)
+            # One formatter per level, built on first use
+            formatter = self.formatters.get(record.levelno)
+            if formatter is None:
+                level_color = self.LEVEL_COLORS.get(record.levelno, "")
+                formatter = logging.Formatter(f"[{level_color}%(levelname)s{Style.RESET_ALL}]   \t%(message)s")
+                self.formatters[record.levelno] = formatter
             return formatter.format(record)
 
+    class JsonFormatter(logging.Formatter):
+        def format(self, record):
+            return json.dumps({
+                "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                "level": record.levelname,
+                "message": record.getMessage(),
+            }, ensure_ascii=False)
+
 # Example usage within the module itself, can be removed
 if __name__ == "__main__":
     logger = ColorLogger().logger
@@ -97,4 +183,4 @@ if __name__ == "__main__":
     logger.error("This is an error message.")
     logger.critical("This is a critical message.")
     logger.succ("This is a success message.")
-    logger.get("This is a get message.")
\ No newline at end of file
+    logger.get("This is a get message.")
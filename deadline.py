@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# deadline.py
+# 同步运行时间限制
+# 功能：
+# 1.按 --deadline（截止时刻）或 --max-duration（最长运行时间）限制同步，在截止前 GRACE 秒停止安排新的下载
+# 2.收到 SIGTERM/SIGINT 时同样停止安排新的下载，进行中的下载完成后保存剩余文件并正常退出
+# 3.多进程同步时将信号转发给工作进程
+import argparse
+import multiprocessing
+import os
+import re
+import signal
+import time
+from datetime import datetime, timedelta
+
+# 截止时间前停止安排新文件的提前量（秒），留给进行中的下载完成；不超过可用时间的 1/10
+GRACE = 30
+
+DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1}
+
+
+class Deadline:
+    """Tells the sync when to stop scheduling new files: [stop_at] is the
+    time.time() after which no new file is started (None for no limit),
+    [reason] is set once the run has to stop."""
+
+    def __init__(self):
+        self.stop_at = None
+        self.reason = None
+
+    def set(self, at: float):
+        """Sets the deadline to [at], keeping the earlier one if any."""
+        stop_at = at - min(GRACE, max(at - time.time(), 0) / 10)
+        if self.stop_at is None or stop_at < self.stop_at:
+            self.stop_at = stop_at
+
+    def stop(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    def stopping(self):
+        if self.reason is None and self.stop_at is not None and time.time() >= self.stop_at:
+            self.reason = "deadline reached"
+        return self.reason is not None
+
+
+current = Deadline()
+
+
+# 解析运行时长：90、90s、30m、1h30m
+def parse_duration(value: str):
+    value = value.strip().lower()
+    if re.fullmatch(r'\d+(\.\d+)?', value):
+        return float(value)
+    parts = re.findall(r'(\d+(?:\.\d+)?)([hms])', value)
+    if not parts or ''.join(n + u for n, u in parts) != value:
+        raise argparse.ArgumentTypeError(f"invalid duration: {value!r} (use e.g. 90, 30m or 1h30m)")
+    return sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+
+# 解析截止时刻：HH:MM[:SS]（今天或明天的该时刻）或 ISO 8601 日期时间，返回 time.time() 形式的时间
+def parse_deadline(value: str):
+    now = datetime.now()
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            at = datetime.combine(now.date(), datetime.strptime(value, fmt).time())
+        except ValueError:
+            continue
+        if at <= now:
+            at += timedelta(days=1)
+        return at.timestamp()
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid deadline: {value!r} (use HH:MM or an ISO 8601 date and time)")
+
+
+def install_signal_handlers(worker=False):
+    """Makes SIGTERM and SIGINT stop the run gracefully. In the main
+    process the first signal is passed on to the worker processes, and a
+    second SIGINT interrupts the process at once. Repeated SIGTERMs are
+    ignored: wrappers such as timeout(1) signal both the process and its
+    group, so the same signal often arrives twice."""
+    received = []
+
+    def handler(signum, frame):
+        if received:
+            if signum == signal.SIGINT and not worker:
+                # 再次按下 Ctrl-C：立即中断
+                signal.default_int_handler(signum, frame)
+            return
+        received.append(signum)
+        if not worker:
+            for child in multiprocessing.active_children():
+                try:
+                    os.kill(child.pid, signum)
+                except OSError:
+                    pass
+        current.stop(f"received {signal.Signals(signum).name}")
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# feed.py
+# 变动 URL 列表
+# 功能：
+# 1.根据本次同步的变动，列出镜像站上更新与删除的公开 URL，包括重新生成的 files.js、patch.js 与 repo.js
+# 2.写入 JSON（.json）或 JSON Lines（其他扩展名）文件，供 CDN 清除缓存与预热使用
+# 3.可选地调用外部命令处理该文件
+import json
+import os
+import shlex
+import subprocess
+import time
+from urllib.parse import quote, urljoin
+
+import utils
+from utils import format_url
+
+
+# 获取 repo 在镜像站上的公开地址：优先使用镜像 repo.js 中的 servers
+def public_base(mirror_dir: str, repo_id: str, site_url=None):
+    try:
+        servers = utils.json_load(os.path.join(mirror_dir, repo_id, 'repo.js')).get('servers')
+        if servers:
+            return format_url(servers[0])
+    except (OSError, ValueError):
+        pass
+    if site_url:
+        return urljoin(format_url(site_url), format_url(quote(repo_id)))
+    return None
+
+
+def changed_urls(changes, mirror_dir: str, site_url=None):
+    """Returns the public URLs touched by the [changes] Changeset as
+    (updated, removed) sorted lists. Regenerated files.js, patch.js and
+    repo.js count as updated. Repos whose public URL is unknown (no
+    servers in the mirrored repo.js and no [site_url]) are skipped."""
+    updated = set()
+    removed = set()
+    for repo_id, patches in changes.patches.items():
+        base = public_base(mirror_dir, repo_id, site_url)
+        if base is None:
+            continue
+        updated.add(base + 'repo.js')
+        for patch, (patch_updated, patch_removed) in patches.items():
+            patch_base = base + quote(patch) + '/'
+            updated.add(patch_base + 'files.js')
+            updated.add(patch_base + 'patch.js')
+            updated.update(patch_base + quote(pfn) for pfn in patch_updated)
+            removed.update(patch_base + quote(pfn) for pfn in patch_removed)
+    return sorted(updated), sorted(removed - updated)
+
+
+def write(path: str, updated: list, removed: list):
+    """Writes the feed to [path], replacing the previous one: a JSON object
+    if [path] ends with `.json`, otherwise one JSON object per line."""
+    generated = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if path.endswith('.json'):
+            json.dump({"generated": generated, "updated": updated, "removed": removed}, f, ensure_ascii=False, indent=4)
+        else:
+            for action, urls in (("updated", updated), ("removed", removed)):
+                for url in urls:
+                    f.write(json.dumps({"action": action, "url": url}, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+# 调用外部命令处理变动列表，文件路径作为最后一个参数传入
+def run_hook(command: str, path: str, log):
+    try:
+        result = subprocess.run(shlex.split(command) + [path])
+    except OSError as e:
+        log.error(f"Feed hook failed to start: {e}")
+        return
+    if result.returncode != 0:
+        log.error(f"Feed hook exited with status {result.returncode}")
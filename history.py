@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# history.py
+# 运行历史记录
+# 功能：
+# 1.同步与添加脚本每次运行结束后向镜像站目录中的历史文件追加一条记录：各阶段耗时、各 patch 的文件数/字节数/耗时、请求数、错误数以及内存峰值
+# 2.命令行输出最近运行的趋势，并标记耗时或每文件字节数明显超出滚动基线（此前若干次运行的中位数）的运行与 patch
+# 用法：
+#   python history.py [-m mirror_dir] [-n runs] [--threshold ratio] [--window runs]
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不记录内存峰值
+    resource = None
+
+from repo_update import sizeof_fmt
+
+HISTORY_FN = '.history.jsonl'
+
+# 计算基线所需的最少记录数，以及判定为退化时允许的最小耗时增加（秒），避免短时间运行的波动被误报
+MIN_SAMPLES = 3
+MIN_SLOWDOWN = 1.0
+
+
+# 本进程及已结束子进程的内存峰值（字节）
+def peak_rss():
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ) * scale
+
+
+def record(run_status, hosts: dict, outcome: str):
+    """Builds the history record of a run from its status.RunStatus and
+    TransferStats counters. [outcome] is "ok", "stopped" or "failed"."""
+    patches = {
+        key: {
+            "files": p.done,
+            "failed": p.failed,
+            "bytes": p.done_bytes,
+            "seconds": round(p.ended - p.started, 3) if p.started is not None else 0,
+        }
+        for key, p in sorted(run_status.patches.items()) if p.done or p.failed
+    }
+    return {
+        "script": run_status.script,
+        "started": run_status.started,
+        "duration": round(time.time() - run_status.started, 3),
+        "outcome": outcome,
+        "phases": {kind: round(seconds, 3) for kind, seconds in run_status.phase_times.items()},
+        "patches": patches,
+        "requests": sum(hs.requests for hs in hosts.values()),
+        "wire_bytes": sum(hs.wire_bytes for hs in hosts.values()),
+        "errors": run_status.retries + sum(p["failed"] for p in patches.values()),
+        "peak_rss": peak_rss(),
+    }
+
+
+# 追加一条记录（每行一个 JSON 对象）
+def append(path: str, entry: dict):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def load(path: str):
+    entries = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # 写入时中断留下的不完整行
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+# 判断 value 是否超出基线 threshold 倍；样本不足时不判断
+def regressed(value, samples: list, threshold: float, min_delta=0.0):
+    if len(samples) < MIN_SAMPLES:
+        return None
+    baseline = statistics.median(samples)
+    if value > baseline * threshold and value - baseline > min_delta:
+        return baseline
+    return None
+
+
+# 运行耗时，不含等待用户输入的时间（add_patch.py 的 "waiting for input" 阶段）
+def active_duration(entry: dict):
+    return entry["duration"] - entry.get("phases", {}).get("waiting", 0)
+
+
+def find_regressions(entries: list, threshold: float, window: int):
+    """Yields (i, message) for every run of [entries] whose active
+    duration, or one of whose patches' seconds or bytes per file, exceeds
+    [threshold] times the median of the [window] previous runs of the same
+    script (of the same patch)."""
+    durations = {}
+    per_file = {}
+    for i, entry in enumerate(entries):
+        history = durations.setdefault(entry["script"], [])
+        if entry.get("outcome") == "ok":
+            duration = active_duration(entry)
+            baseline = regressed(duration, history[-window:], threshold, MIN_SLOWDOWN)
+            if baseline is not None:
+                yield i, f"run took {duration:.1f}s (baseline {baseline:.1f}s)"
+            history.append(duration)
+        for key, p in entry.get("patches", {}).items():
+            if not p["files"]:
+                continue
+            samples = per_file.setdefault(key, ([], []))
+            size, seconds = p["bytes"] / p["files"], p["seconds"] / p["files"]
+            baseline = regressed(size, samples[0][-window:], threshold)
+            if baseline is not None:
+                yield i, f"{key}: {sizeof_fmt(size)} per file (baseline {sizeof_fmt(baseline)})"
+            baseline = regressed(seconds, samples[1][-window:], threshold, MIN_SLOWDOWN / p["files"])
+            if baseline is not None:
+                yield i, f"{key}: {seconds:.2f}s per file (baseline {baseline:.2f}s)"
+            samples[0].append(size)
+            samples[1].append(seconds)
+
+
+# 输出最近 count 次运行及其中的退化，返回最近一次运行是否有退化
+def report(entries: list, count: int, threshold: float, window: int):
+    flags = {}
+    for i, message in find_regressions(entries, threshold, window):
+        flags.setdefault(i, []).append(message)
+    first = max(len(entries) - count, 0)
+    for i in range(first, len(entries)):
+        entry = entries[i]
+        files = sum(p["files"] for p in entry.get("patches", {}).values())
+        size = sum(p["bytes"] for p in entry.get("patches", {}).values())
+        phases = ", ".join(f"{kind} {seconds:.1f}s" for kind, seconds in entry.get("phases", {}).items() if seconds >= 0.1)
+        rss = sizeof_fmt(entry["peak_rss"]) if entry.get("peak_rss") else "unknown"
+        print(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['started']))}  {entry['script']:<15} "
+            f"{entry.get('outcome', 'ok'):<7} {entry['duration']:8.1f}s  {files} files, {sizeof_fmt(size)}, "
+            f"{entry['requests']} requests, {entry['errors']} errors, peak RSS {rss}"
+        )
+        if phases:
+            print(f"    {phases}")
+        for message in flags.get(i, []):
+            print(f"    REGRESSION: {message}")
+    return bool(entries) and len(entries) - 1 in flags
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the history of mirror runs and flag performance regressions.")
+    parser.add_argument('path', metavar='history_file', nargs='?',
+                        help='History file (default: that of the mirror directory)')
+    parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                        help='The mirror directory')
+    parser.add_argument('-n', '--runs', metavar='N', default=20, type=int,
+                        help='Number of runs to show')
+    parser.add_argument('--threshold', metavar='ratio', default=1.5, type=float,
+                        help='Flag values above this multiple of their baseline')
+    parser.add_argument('--window', metavar='N', default=10, type=int,
+                        help='Number of previous runs the baseline is the median of')
+    arg = parser.parse_args()
+    entries = load(arg.path or os.path.join(arg.m, HISTORY_FN))
+    if not entries:
+        print("No run recorded yet.")
+    # 最近一次运行有退化时以非零状态码退出，供监控告警
+    sys.exit(1 if report(entries, arg.runs, arg.threshold, arg.window) else 0)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# locks.py
+# 镜像站文件锁
+# 功能：
+# 1.为每个 repo 提供独立的锁文件，防止多个同步任务同时处理同一 repo
+# 2.不同 repo 可以由不同进程同时同步
+# 3.导入变更集与垃圾清理共用一个锁，清理时不会删除正在暂存的文件
+import os
+import time
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_DIR = '.locks'
+
+
+class LockHeld(Exception):
+    """Raised when a lock is already held by another process."""
+
+
+class FileLock:
+    """Advisory lock on [path], held by this process until released. The
+    PID of the holder is written into the file for diagnostics."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=False, poll=1.0):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            f = open(self.path, 'a+')
+            try:
+                if os.name == 'nt':
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                if not blocking:
+                    raise LockHeld(f"{self.path} is held by another process.")
+                time.sleep(poll)
+                continue
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            self.file = f
+            return self
+
+    def release(self):
+        if self.file is None:
+            return
+        try:
+            if os.name == 'nt':
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# 获取 repo 对应的锁
+def repo_lock(mirror_dir: str, repo_id: str):
+    return FileLock(os.path.join(mirror_dir, LOCK_DIR, f"{repo_id}.lock"))
+
+
+# 获取变更集导入锁
+def changeset_lock(mirror_dir: str):
+    return FileLock(os.path.join(mirror_dir, LOCK_DIR, "changeset.lock"))
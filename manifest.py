@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# manifest.py
+# 紧凑的 patch 文件清单
+# 功能：
+# 1.以排序后的路径表、array('I') 形式的 CRC32 以及删除标记位图保存文件清单
+# 2.用于 patch 的更新列表，避免为每个文件创建字典与列表
+# 3.可与 JSON 互相转换，供更新状态文件保存与恢复
+from array import array
+from heapq import merge
+
+
+class Manifest:
+    """Sorted list of patch files with their CRC32, each of which can be
+    flagged for removal.
+
+    Paths are kept in one sorted list, CRC32s in an `array('I')` and the
+    removal flags in a bitmap, so that a manifest of N files costs N path
+    strings plus 4 bytes and 1 bit per file."""
+
+    __slots__ = ('paths', 'crcs', 'flags')
+
+    def __init__(self, items=()):
+        """Builds the manifest from (path, crc32, removed) [items], which
+        must be sorted by path."""
+        self.paths = []
+        self.crcs = array('I')
+        self.flags = bytearray()
+        for path, crc, removed in items:
+            self.append(path, crc, removed)
+
+    def append(self, path: str, crc: int, removed=False):
+        i = len(self.paths)
+        if i and path <= self.paths[-1]:
+            raise ValueError(f"{path} is not sorted after {self.paths[-1]}.")
+        self.paths.append(path)
+        self.crcs.append(crc)
+        if i % 8 == 0:
+            self.flags.append(0)
+        if removed:
+            self.flags[i // 8] |= 1 << (i % 8)
+
+    @classmethod
+    def from_diff(cls, removed, updated):
+        """Merges the (path, crc32) pairs of [removed] and [updated], both
+        sorted by path, as returned by OriginList.diff()."""
+        return cls(merge(
+            ((path, crc, True) for path, crc in removed),
+            ((path, crc, False) for path, crc in updated),
+        ))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __bool__(self):
+        return bool(self.paths)
+
+    def is_removed(self, i: int):
+        return bool(self.flags[i // 8] & (1 << (i % 8)))
+
+    def items(self):
+        """Yields (path, crc32, removed) for every file."""
+        for i, (path, crc) in enumerate(zip(self.paths, self.crcs)):
+            yield path, crc, self.is_removed(i)
+
+    def updated(self):
+        """Returns [(path, crc32)] for the files that are not removed."""
+        return [(path, crc) for path, crc, removed in self.items() if not removed]
+
+    def removed(self):
+        return [path for path, _, removed in self.items() if removed]
+
+    def filter(self, keep):
+        """Returns a manifest of the files for which keep(path, crc32,
+        removed) is true."""
+        return Manifest(item for item in self.items() if keep(*item))
+
+    def to_json(self):
+        return {
+            "paths": self.paths,
+            "crc32": self.crcs.tolist(),
+            "removed": self.flags.hex(),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict):
+        manifest = cls()
+        manifest.paths = list(data["paths"])
+        manifest.crcs = array('I', data["crc32"])
+        manifest.flags = bytearray.fromhex(data["removed"])
+        if len(manifest.crcs) != len(manifest.paths) or len(manifest.flags) != (len(manifest.paths) + 7) // 8:
+            raise ValueError("Inconsistent manifest.")
+        return manifest
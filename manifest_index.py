@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+# manifest_index.py
+# 镜像站 SQLite 清单索引
+# 功能：
+# 1.集中保存 repo 源地址、patch 版本以及每个文件的 CRC32、大小、修改时间和 ETag
+# 2.以索引查询的方式比较本地与源服务器的文件列表
+# 3.继续生成 .version/<repo>.json，供旧版脚本及人工查看
+# 4.命令行下可直接输出镜像站统计信息，或查询包含指定文件的 patch
+import argparse
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from repo_update import sizeof_fmt
+
+INDEX_FN = '.index.sqlite'
+
+# 各 repo 更新状态文件（同步中断时剩余的更新列表）所在目录
+JOURNAL_DIR = '__update'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    origin TEXT NOT NULL,
+    last_checked REAL
+);
+CREATE TABLE IF NOT EXISTS patches (
+    repo TEXT NOT NULL,
+    patch TEXT NOT NULL,
+    version TEXT,
+    etag TEXT,
+    etag_url TEXT,
+    last_checked REAL,
+    PRIMARY KEY (repo, patch)
+);
+CREATE TABLE IF NOT EXISTS files (
+    repo TEXT NOT NULL,
+    patch TEXT NOT NULL,
+    path TEXT NOT NULL,
+    crc32 INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    etag TEXT,
+    last_checked REAL,
+    PRIMARY KEY (repo, patch, path)
+);
+CREATE INDEX IF NOT EXISTS files_by_path ON files (path);
+CREATE TABLE IF NOT EXISTS servers (
+    repo TEXT NOT NULL,
+    url TEXT NOT NULL,
+    latency REAL,
+    throughput REAL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_probed REAL,
+    PRIMARY KEY (repo, url)
+);
+"""
+
+
+class ManifestIndex:
+    """Index of every mirrored repository, patch and file, stored in
+    [mirror_dir]/.index.sqlite.
+
+    `repos` and `patches` hold what `.version/<repo>.json` used to be the
+    only source of: the origin of each repository and the files.js hash of
+    every patch that is kept in sync. `files` holds one row per file
+    present in a mirrored patch. The `.version` files are imported once
+    and regenerated from the index whenever a version changes."""
+
+    def __init__(self, mirror_dir: str):
+        self.mirror_dir = mirror_dir
+        self.path = os.path.join(mirror_dir, INDEX_FN)
+        self.lock = threading.RLock()
+        os.makedirs(mirror_dir, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.upgrade_schema()
+        self.import_version_files()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock, self.db:
+            yield self.db
+
+    def upgrade_schema(self):
+        """Adds the columns introduced after the index was created."""
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(patches)")}
+        if 'etag_url' not in columns:
+            with self.transaction() as db:
+                db.execute("ALTER TABLE patches ADD COLUMN etag_url TEXT")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # .version 文件的导入与生成
+    def version_path(self, repo: str):
+        return os.path.join(self.mirror_dir, '.version', f'{repo}.json')
+
+    def import_version_files(self):
+        """Imports every `.version/<repo>.json` whose repository is not in
+        the index yet."""
+        version_dir = os.path.join(self.mirror_dir, '.version')
+        if not os.path.isdir(version_dir):
+            return
+        known = set(self.repos())
+        for fn in os.listdir(version_dir):
+            if not fn.endswith('.json') or fn[:-5] in known:
+                continue
+            try:
+                with open(os.path.join(version_dir, fn), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            origin = data.get('origin')
+            patches = data.get('patches')
+            if not origin or not isinstance(patches, dict):
+                continue
+            with self.transaction() as db:
+                db.execute("INSERT OR IGNORE INTO repos (repo, origin) VALUES (?, ?)", (fn[:-5], origin))
+                db.executemany(
+                    "INSERT OR IGNORE INTO patches (repo, patch, version) VALUES (?, ?, ?)",
+                    [(fn[:-5], patch, version) for patch, version in patches.items()]
+                )
+
+    def export_version(self, repo: str):
+        """Regenerates `.version/<repo>.json` from the index, or removes it
+        if the repository has no synced patches left."""
+        fn = self.version_path(repo)
+        origin = self.origin(repo)
+        patches = self.patches(repo)
+        if not origin or not patches:
+            if os.path.exists(fn):
+                os.remove(fn)
+            return
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'w', encoding='utf-8') as f:
+            json.dump({"origin": origin, "patches": patches}, f, indent=4, ensure_ascii=False)
+
+    # repo 与 patch 版本信息
+    def repos(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT repo, origin FROM repos ORDER BY repo"))
+
+    def origin(self, repo: str):
+        return self.repos().get(repo)
+
+    def set_origin(self, repo: str, origin: str):
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO repos (repo, origin) VALUES (?, ?) "
+                "ON CONFLICT (repo) DO UPDATE SET origin = excluded.origin",
+                (repo, origin)
+            )
+
+    def patches(self, repo: str):
+        """Returns {patch: version} for every synced patch of [repo]."""
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT patch, version FROM patches WHERE repo = ? ORDER BY patch", (repo,)
+            ))
+
+    def set_patch_version(self, repo: str, patch: str, version: str, etag=None, etag_url=None):
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO patches (repo, patch, version, etag, etag_url, last_checked) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (repo, patch) DO UPDATE SET version = excluded.version, "
+                "etag = excluded.etag, etag_url = excluded.etag_url, last_checked = excluded.last_checked",
+                (repo, patch, version, etag, etag_url, time.time())
+            )
+
+    def validators(self, repo: str):
+        """Returns {patch: (url, etag)}: the ETag last sent for the files.js
+        of each patch, and the URL it was sent for."""
+        with self.lock:
+            return {
+                patch: (url, etag) for patch, url, etag in self.db.execute(
+                    "SELECT patch, etag_url, etag FROM patches "
+                    "WHERE repo = ? AND etag IS NOT NULL AND etag_url IS NOT NULL",
+                    (repo,)
+                )
+            }
+
+    def set_validator(self, repo: str, patch: str, url: str, etag: str):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE patches SET etag = ?, etag_url = ? WHERE repo = ? AND patch = ?",
+                (etag, url, repo, patch)
+            )
+
+    def mark_checked(self, repo: str, patches):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE repos SET last_checked = ? WHERE repo = ?", (now, repo))
+            db.executemany(
+                "UPDATE patches SET last_checked = ? WHERE repo = ? AND patch = ?",
+                [(now, repo, patch) for patch in patches]
+            )
+
+    def untrack_patch(self, repo: str, patch: str):
+        """Stops syncing [patch]. Its files stay in the index."""
+        with self.transaction() as db:
+            db.execute("DELETE FROM patches WHERE repo = ? AND patch = ?", (repo, patch))
+            if not db.execute("SELECT 1 FROM patches WHERE repo = ?", (repo,)).fetchone():
+                db.execute("DELETE FROM repos WHERE repo = ?", (repo,))
+                db.execute("DELETE FROM servers WHERE repo = ?", (repo,))
+
+    # 上游服务器信息
+    def servers(self, repo: str):
+        """Returns [(url, latency, throughput, failures)] for every known
+        upstream server of [repo]."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT url, latency, throughput, failures FROM servers WHERE repo = ? ORDER BY rowid",
+                (repo,)
+            ).fetchall()
+
+    def stale_servers(self, repo: str, max_age: float):
+        """Returns the URLs of the servers of [repo] that were not probed
+        during the last [max_age] seconds."""
+        with self.lock:
+            return [url for url, in self.db.execute(
+                "SELECT url FROM servers WHERE repo = ? AND (last_probed IS NULL OR last_probed < ?) "
+                "ORDER BY rowid",
+                (repo, time.time() - max_age)
+            )]
+
+    def add_servers(self, repo: str, urls):
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO servers (repo, url) VALUES (?, ?)",
+                [(repo, url) for url in urls]
+            )
+
+    def record_probe(self, repo: str, url: str, latency=None, throughput=None):
+        """Stores the result of a server probe. A probe without [latency]
+        counts as a failure."""
+        with self.transaction() as db:
+            if latency is None:
+                db.execute(
+                    "UPDATE servers SET failures = failures + 1, last_probed = ? WHERE repo = ? AND url = ?",
+                    (time.time(), repo, url)
+                )
+            else:
+                db.execute(
+                    "UPDATE servers SET latency = ?, throughput = ?, failures = 0, last_probed = ? "
+                    "WHERE repo = ? AND url = ?",
+                    (latency, throughput, time.time(), repo, url)
+                )
+
+    # patch 文件信息
+    def has_files(self, repo: str, patch: str):
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM files WHERE repo = ? AND patch = ? LIMIT 1", (repo, patch)
+            ).fetchone() is not None
+
+    def file_stats(self, repo: str, patch: str):
+        """Returns {path: (crc32, size, mtime)} for every file of [patch]."""
+        with self.lock:
+            return {
+                path: (crc, size, mtime) for path, crc, size, mtime in self.db.execute(
+                    "SELECT path, crc32, size, mtime FROM files WHERE repo = ? AND patch = ?",
+                    (repo, patch)
+                )
+            }
+
+    def import_filelist(self, repo: str, patch: str, filelist: dict):
+        """Fills the index from a files.js dictionary, for patches that
+        were mirrored before the index existed."""
+        self.record_files(repo, patch, [
+            (path, crc, None, None, None) for path, crc in filelist.items() if crc is not None
+        ])
+
+    def record_files(self, repo: str, patch: str, rows):
+        """Inserts or updates (path, crc32, size, mtime, etag) rows."""
+        with self.transaction() as db:
+            self._record_files(db, repo, patch, rows)
+
+    def _record_files(self, db, repo: str, patch: str, rows):
+        now = time.time()
+        db.executemany(
+            "INSERT INTO files (repo, patch, path, crc32, size, mtime, etag, last_checked) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (repo, patch, path) DO UPDATE SET crc32 = excluded.crc32, "
+            "size = excluded.size, mtime = excluded.mtime, "
+            "etag = COALESCE(excluded.etag, files.etag), last_checked = excluded.last_checked",
+            [(repo, patch, path, crc, size, mtime, etag, now) for path, crc, size, mtime, etag in rows]
+        )
+
+    def remove_files(self, repo: str, patch: str, paths):
+        with self.transaction() as db:
+            db.executemany(
+                "DELETE FROM files WHERE repo = ? AND patch = ? AND path = ?",
+                [(repo, patch, path) for path in paths]
+            )
+
+    def replace_files(self, repo: str, patch: str, rows):
+        """Makes (path, crc32, size, mtime) [rows] the complete file list of
+        [patch], as found by repo_build."""
+        rows = list(rows)
+        with self.transaction() as db:
+            db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+            db.execute("DELETE FROM seen")
+            db.executemany("INSERT INTO seen (path) VALUES (?)", [(row[0],) for row in rows])
+            db.execute(
+                "DELETE FROM files WHERE repo = ? AND patch = ? AND path NOT IN (SELECT path FROM seen)",
+                (repo, patch)
+            )
+            self._record_files(db, repo, patch, [(*row, None) for row in rows])
+
+    def origin_list(self):
+        """Returns an empty OriginList, to be filled piece by piece while an
+        origin files.js is being received."""
+        return OriginList(self)
+
+    # 统计与查询
+    def summary(self):
+        """Returns [(repo, patches, files, bytes)] for every indexed repo."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT repo, COUNT(DISTINCT patch), COUNT(*), COALESCE(SUM(size), 0) "
+                "FROM files GROUP BY repo ORDER BY repo"
+            ).fetchall()
+
+    def find(self, path: str):
+        """Returns [(repo, patch, crc32, size)] for every patch containing
+        [path]."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT repo, patch, crc32, size FROM files WHERE path = ? ORDER BY repo, patch",
+                (path,)
+            ).fetchall()
+
+
+class OriginList:
+    """Temporary table holding the (path, crc32) pairs of an origin
+    files.js, so that it never has to be kept as a whole in memory."""
+
+    _count = itertools.count()
+
+    def __init__(self, index: ManifestIndex):
+        self.index = index
+        self.table = f"origin_{next(self._count)}"
+        with index.transaction() as db:
+            db.execute(f"CREATE TEMP TABLE {self.table} (path TEXT PRIMARY KEY, crc32 INTEGER)")
+
+    def add(self, pairs):
+        with self.index.transaction() as db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (path, crc32) VALUES (?, ?)",
+                [(path, crc) for path, crc in pairs if crc is not None and path != 'patch.js']
+            )
+
+    def diff(self, repo: str, patch: str):
+        """Compares the indexed files of [patch] with this origin files.js.
+
+        Returns (removed, updated), two lists of (path, crc32) pairs: files
+        that no longer exist on the origin (with their local CRC32) and
+        files that are new or changed (with their origin CRC32). patch.js is
+        rewritten by repo_build for every mirror, so it is never compared."""
+        with self.index.lock:
+            db = self.index.db
+            removed = db.execute(
+                f"SELECT f.path, f.crc32 FROM files f LEFT JOIN {self.table} o ON o.path = f.path "
+                "WHERE f.repo = ? AND f.patch = ? AND f.path != 'patch.js' AND o.path IS NULL ORDER BY f.path",
+                (repo, patch)
+            ).fetchall()
+            updated = db.execute(
+                f"SELECT o.path, o.crc32 FROM {self.table} o LEFT JOIN files f "
+                "ON f.repo = ? AND f.patch = ? AND f.path = o.path "
+                "WHERE f.crc32 IS NULL OR f.crc32 != o.crc32 ORDER BY o.path",
+                (repo, patch)
+            ).fetchall()
+        return removed, updated
+
+    def close(self):
+        with self.index.transaction() as db:
+            db.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+
+_indexes = {}
+
+
+# 获取镜像站目录对应的索引（同一目录共享同一连接）
+def open_index(mirror_dir: str):
+    key = os.path.abspath(mirror_dir)
+    if key not in _indexes:
+        _indexes[key] = ManifestIndex(mirror_dir)
+    return _indexes[key]
+
+
+# 获取 repo 更新状态文件路径
+def journal_path(mirror_dir: str, repo_id: str):
+    return os.path.join(mirror_dir, JOURNAL_DIR, f"{repo_id}.json")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the contents of the mirror index.")
+    parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                        help='The mirror directory')
+    parser.add_argument('--find', metavar='file', type=str,
+                        help='List the patches containing this file (path relative to the patch)')
+    arg = parser.parse_args()
+    index = open_index(arg.m)
+    if arg.find:
+        for repo, patch, crc, size in index.find(arg.find):
+            print(f"{repo}/{patch}: crc32={crc} size={sizeof_fmt(size or 0)}")
+    else:
+        for repo, patches, files, size in index.summary():
+            print(f"{repo}: {patches} patches, {files} files, {sizeof_fmt(size)}")
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# mirror_gc.py
+# 镜像站垃圾清理
+# 功能：
+# 1.一次遍历镜像站目录，找出意外中断遗留的 *.downloading/*.exporting/*.converting 临时文件与空文件夹
+# 2.清理过期的 __files.js、__update.json、已不再同步的 repo 的更新状态文件以及残留的变更集暂存目录
+# 3.列出已从 .version 中移除的 patch 目录；这些 patch 可能仍作为一次性 patch 提供服务，仅在指定 --untracked 时删除
+# 4.与同步脚本使用相同的 repo 锁，正在同步的 repo 会被跳过；正在导入变更集时保留暂存目录
+# 用法：
+#   python mirror_gc.py [-m mirror_dir] [-n] [--untracked]
+import argparse
+import json
+import os
+import shutil
+
+import locks
+from changeset import STAGING_DIR, STATE_FN as CHANGESET_STATE_FN
+from manifest_index import JOURNAL_DIR, open_index
+from repo_update import repo_build, sizeof_fmt
+
+TEMP_SUFFIXES = ('.downloading', '.exporting', '.converting')
+
+CATEGORIES = {
+    'temp': 'temporary files',
+    'empty': 'empty directories',
+    'stale': 'stale state files',
+    'untracked': 'untracked patch directories',
+}
+
+
+class Collector:
+    """Collects what the sweep found, and removes it unless [dry_run]."""
+
+    def __init__(self, mirror_dir: str, dry_run: bool):
+        self.mirror_dir = mirror_dir
+        self.dry_run = dry_run
+        self.found = {category: [] for category in CATEGORIES}
+
+    def add(self, category: str, path: str, size: int):
+        self.found[category].append((path, size))
+        rel = os.path.relpath(path, self.mirror_dir)
+        print(f"{'Would remove' if self.dry_run else 'Removing'} {rel} ({sizeof_fmt(size)})")
+        if self.dry_run:
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            if category == 'empty':
+                os.rmdir(path)
+            else:
+                shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def report(self):
+        for category, name in CATEGORIES.items():
+            items = self.found[category]
+            if items:
+                print(f"{name}: {len(items)}, {sizeof_fmt(sum(size for _, size in items))}")
+        total = sum(size for items in self.found.values() for _, size in items)
+        print(f"{'Reclaimable' if self.dry_run else 'Reclaimed'}: {sizeof_fmt(total)}")
+
+
+# 计算目录树的总大小
+def tree_size(path: str):
+    total = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                total += tree_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+# 遍历目录，清理临时文件；返回清理后该目录是否为空
+def sweep(path: str, collector: Collector, keep=False):
+    empty = True
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if sweep(entry.path, collector):
+                collector.add('empty', entry.path, 0)
+            else:
+                empty = False
+        elif entry.name.endswith(TEMP_SUFFIXES):
+            collector.add('temp', entry.path, entry.stat(follow_symlinks=False).st_size)
+        else:
+            empty = False
+    return empty and not keep
+
+
+# 清理单个 repo：临时文件、空文件夹，以及（可选）不再同步的 patch 目录
+def sweep_repo(repo_dir: str, repo_id: str, tracked: dict, collector: Collector, untracked: bool):
+    removed_patches = False
+    with os.scandir(repo_dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            if entry.name.endswith(TEMP_SUFFIXES):
+                collector.add('temp', entry.path, entry.stat(follow_symlinks=False).st_size)
+            continue
+        if os.path.isfile(os.path.join(entry.path, 'patch.js')) and entry.name not in tracked:
+            if untracked:
+                collector.add('untracked', entry.path, tree_size(entry.path))
+                removed_patches = True
+                continue
+            print(f"Untracked patch (kept, use --untracked to remove): {repo_id}/{entry.name} "
+                  f"({sizeof_fmt(tree_size(entry.path))})")
+        if sweep(entry.path, collector):
+            collector.add('empty', entry.path, 0)
+    return removed_patches
+
+
+# 找出过期的状态文件（staging 为 False 时不检查变更集暂存目录）
+def stale_state_files(mirror_dir: str, repos: dict, staging=True):
+    stale = []
+
+    # add_patch.py 中断恢复只在 __add.json 存在时使用 __files.js
+    if not os.path.exists(os.path.join(mirror_dir, '__add.json')):
+        stale.append(os.path.join(mirror_dir, '__files.js'))
+
+    # 不再同步的 repo 的更新状态文件
+    legacy_path = os.path.join(mirror_dir, '__update.json')
+    if os.path.exists(legacy_path):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get('repo_id') not in repos:
+                    stale.append(legacy_path)
+        except (OSError, ValueError, AttributeError):
+            stale.append(legacy_path)
+    journal_dir = os.path.join(mirror_dir, JOURNAL_DIR)
+    if os.path.isdir(journal_dir):
+        for entry in os.scandir(journal_dir):
+            if entry.name.endswith('.json') and entry.name[:-5] not in repos:
+                stale.append(entry.path)
+
+    # 已完成或被放弃的变更集暂存目录
+    staging_dir = os.path.join(mirror_dir, STAGING_DIR)
+    if staging and os.path.isdir(staging_dir):
+        pending = None
+        try:
+            with open(os.path.join(mirror_dir, CHANGESET_STATE_FN), 'r', encoding='utf-8') as f:
+                pending = json.load(f).get('pending')
+        except (OSError, ValueError):
+            pass
+        for entry in os.scandir(staging_dir):
+            if entry.name != pending:
+                stale.append(entry.path)
+    return [path for path in stale if os.path.exists(path)]
+
+
+def collect_garbage(mirror_dir: str, dry_run=False, untracked=False):
+    """Sweeps [mirror_dir] once and removes (or, with [dry_run], lists)
+    leftover temporary files, empty directories and stale state files.
+    Repositories locked by a running sync are skipped. Patch directories
+    that are no longer synced are only removed if [untracked] is set,
+    since they may still be served as one-time patches."""
+    collector = Collector(mirror_dir, dry_run)
+    index = open_index(mirror_dir)
+    repos = index.repos()
+
+    # 持有变更集锁期间清理状态文件，不会与正在进行的导入同时处理暂存目录
+    try:
+        changeset_lock = locks.changeset_lock(mirror_dir).acquire()
+    except locks.LockHeld:
+        print("A changeset is being applied, keeping its staging directory.")
+        changeset_lock = None
+    try:
+        for path in stale_state_files(mirror_dir, repos, changeset_lock is not None):
+            size = tree_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            collector.add('stale', path, size)
+    finally:
+        if changeset_lock is not None:
+            changeset_lock.release()
+
+    with os.scandir(mirror_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False) or entry.name.startswith(('.', '__')):
+            continue
+        if not os.path.isfile(os.path.join(entry.path, 'repo.js')):
+            continue
+        repo_id = entry.name
+        try:
+            lock = locks.repo_lock(mirror_dir, repo_id).acquire()
+        except locks.LockHeld:
+            print(f"{repo_id} is being synced, skipping.")
+            continue
+        try:
+            tracked = index.patches(repo_id)
+            if sweep_repo(entry.path, repo_id, tracked, collector, untracked) and not dry_run:
+                # 从 repo.js 中移除已删除的 patch
+                repo_build(entry.path, entry.path, index, set())
+        finally:
+            lock.release()
+
+    collector.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Remove leftovers of interrupted runs from the mirror.")
+    parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                        help='The mirror directory')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only list what would be removed')
+    parser.add_argument('--untracked', action='store_true',
+                        help='Also remove patch directories that are no longer synced')
+    arg = parser.parse_args()
+    collect_garbage(arg.m, arg.dry_run, arg.untracked)
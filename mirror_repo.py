@@ -7,18 +7,36 @@
 # 4.自动更新版本信息
 # 5.逐个补丁（patch）更新，并能够实时更新版本信息
 # 6.输出脚本日志信息
+import time
+START_TIME = time.perf_counter()  # 用于统计导入耗时以及发出第一个请求的时间
 import httpx
 import json
 import asyncio
 import os
 import sys
 import argparse
-from repo_update import repo_build
+import multiprocessing
+import locks
+import mirror_roots
+import transfer
+import upstream
+import changeset
+import deadline
+import feed
+import history
+import plan
+import status
+import utils
+from utils import format_url
+from manifest import Manifest
+from manifest_index import journal_path, open_index
+from repo_update import repo_build, sizeof_fmt, sparse_spec
 from color_logger import ColorLogger
 from urllib.parse import urljoin
 from hashlib import sha256
 from enum import Enum
 from zlib import crc32
+IMPORT_TIME = time.perf_counter() - START_TIME
 
 log = ColorLogger(log_to_file=True).logger
 parser = argparse.ArgumentParser()
@@ -30,22 +48,138 @@ parser.add_argument(
     type=str,
     dest='m'
     )
-class UpdateInfo(Enum):
-    checksum = 0
-    upd_mode = 1 
+parser.add_argument(
+    "-w","--workers",
+    metavar="N",
+    help="Sync repos in N worker processes",
+    default=1,
+    type=int
+    )
+parser.add_argument(
+    "--progress",
+    metavar="seconds",
+    help="Print one progress line every N seconds instead of one line per file (the log file keeps every line)",
+    default=None,
+    type=float
+    )
+parser.add_argument(
+    "--log-format",
+    choices=["text", "json"],
+    help="Console output format, 'json' writes one JSON object per line",
+    default="text"
+    )
+parser.add_argument(
+    "--status",
+    metavar="path",
+    help="Where to write the live status of the run (default: <mirror>/.mirror-status.json)",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--history",
+    metavar="path",
+    help="Append a record of the run to this file (default: <mirror>/.history.jsonl)",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--deadline",
+    metavar="time",
+    help="Stop scheduling new files shortly before this time (HH:MM or ISO 8601); what is left is synced by the next run",
+    default=None,
+    type=deadline.parse_deadline
+    )
+parser.add_argument(
+    "--max-duration",
+    metavar="duration",
+    help="Stop scheduling new files shortly before the run has taken this long (e.g. 90, 30m, 1h30m)",
+    default=None,
+    type=deadline.parse_duration
+    )
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="Only check for updates and print what a sync would download and remove, with an estimated duration"
+    )
+parser.add_argument(
+    "--save-plan",
+    metavar="path",
+    help="Like --plan, and save the plan to this file",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--apply-plan",
+    metavar="path",
+    help="Sync exactly what a plan saved by --save-plan lists, without checking for updates again",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--listen",
+    metavar="[host:]port|unix:path",
+    help="Keep running and sync patches as soon as POST /sync/<repo>[/<patch>] is received here",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--spool",
+    metavar="path",
+    help="Keep running and sync the '<repo> [patch]' lines of files dropped into this directory",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--changeset",
+    action="store_true",
+    help="Export the files changed by this run as a changeset for secondary nodes"
+    )
+parser.add_argument(
+    "--changeset-pack",
+    action="store_true",
+    help="Also pack the changed files into a .tar.gz archive"
+    )
+parser.add_argument(
+    "--changeset-dir",
+    metavar="path",
+    help="Where to write changesets (default: <mirror>/.changesets)",
+    default=None,
+    type=str
+    )
+
+parser.add_argument(
+    "--feed",
+    metavar="path",
+    help="Write the public URLs updated or removed by each run to this file (JSON if it ends with .json, JSON lines otherwise)",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--feed-hook",
+    metavar="command",
+    help="Run this command with the path of the feed after it is written",
+    default=None,
+    type=str
+    )
+parser.add_argument(
+    "--site-url",
+    metavar="url",
+    help="Public URL of the mirror, used for repos whose repo.js lists no server",
+    default=None,
+    type=str
+    )
+
+# 本次运行中变动的文件，供导出变更集与变动 URL 列表
+changes = changeset.Changeset()
 
+# fetch_update() 因停止运行而未下载的文件
+DEFERRED = 'deferred'
 
-# 获取 patch 文件更新列表以及更新模式
+# 旧版更新状态文件中的更新模式
 class UpdateMode(Enum):
     REMOVE = "r"
     UPDATE = "u"
 
-# 对 URL 进行格式化
-def format_url(url: str):
-    if not url.endswith('/'):
-        return url + '/'
-    return url
-
 # 获取文件 CRC32 校验和
 def calculate_crc32(file_path: str):
     try:
@@ -102,138 +236,199 @@ def load_custom_dir(user_arg: str):
             json.dump(user_path, mirror_file, indent=4)
         return user_path['mirror_dir']
 
-# 获取镜像 patch 版本数据
-async def fetch_patch_ver(patch_ver: str):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(patch_ver)
-            response.raise_for_status()  # 如果请求失败则抛出异常
-            return sha256(response.content).hexdigest()
-        except Exception as e:
-            log.error(f"Error accessing {patch_ver}: {e}")
-            sys.exit(1)
-
-# 检查 repo 更新
-async def check_update(mirror_dir: str):
-    update_list = {}
-    version_dir = os.path.join(mirror_dir, '.version')
-    if not os.path.exists(version_dir):
-        log.error(f"{version_dir} does not exist.")
-        sys.exit(1)
+# 获取所有镜像根目录：mirror.json 或 config.json 中的 mirror_dirs 列表，未设置时为 load_custom_dir() 的单个目录
+def load_mirror_dirs(user_arg: str):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    for fn in ('mirror.json', 'config.json'):
+        path = os.path.join(current_dir, fn)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                mirror_dirs = json.load(f).get('mirror_dirs')
+            if mirror_dirs:
+                return mirror_dirs
+    return [load_custom_dir(user_arg)]
 
-    for repo_id in os.listdir(version_dir):
-        if not repo_id.endswith('.json'):
-            continue
+# 获取镜像 patch 版本数据（可传入多个服务器上的 URL，依次尝试）
+# 返回 (hash, (url, etag))；上次的 ETag 仍然有效（304）时 hash 为 None；所有服务器均失败时返回 None
+# 本次运行已获取的 files.js（如其他镜像根目录获取的）不再重复请求；contents 不为 None 时记录 {hash: 内容}
+async def fetch_patch_ver(client: httpx.AsyncClient, patch_ver, validator=None, contents=None):
+    urls = patch_ver if isinstance(patch_ver, list) else [patch_ver]
+    shared = mirror_roots.shared
+    if urls[0] in shared.hashes:
+        return shared.hashes[urls[0]]
+    try:
+        url, response = await upstream.get_first(client, urls, validator)  # 所有服务器均失败则抛出异常
+    except Exception as e:
+        log.error(f"Error accessing {patch_ver}: {e}")
+        return None
+    if response.status_code == 304:
+        return None, validator
+    result = sha256(response.content).hexdigest(), (url, response.headers.get('ETag'))
+    shared.hashes[url] = result
+    if contents is not None:
+        contents[result[0]] = response.content
+    return result
 
-        repo_id = repo_id[:-5]  # Remove .json extension
-        file_path = os.path.join(version_dir, f"{repo_id}.json")
+# 检查 repo 更新，返回有新版本的 patch 列表（only 不为空时只检查其中的 patch）
+async def check_update(mirror_dir: str, repo_id: str, only=None):
+    update_list = []
+    index = open_index(mirror_dir)
 
-        try:
-            log.info(f"Checking {repo_id} ...")
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            log.error(f"Invalid JSON in {repo_id}. Skipping.")
-            continue
+    log.info(f"Checking {repo_id} ...")
+    patches = index.patches(repo_id)
+    if only:
+        patches = {patch: version for patch, version in patches.items() if patch in only}
+    validators = index.validators(repo_id)
+    servers = await upstream.rank_servers(index, repo_id, index.origin(repo_id), log)
 
-        origin = data.get('origin')
-        patches = data.get('patches', {})
+    # 并发检查所有 patch，附带上次的 ETag，未变化的 files.js 不再重新下载
+    semaphore = asyncio.Semaphore(10)
+    client = transfer.shared_client()
+    contents = {}
+    async def check(patch):
+        async with semaphore:
+            return await fetch_patch_ver(client, [
+                urljoin(format_url(url), f"{patch}/files.js?=2233") for url in servers
+            ], validators.get(patch), contents)
+    results = await asyncio.gather(*[check(patch) for patch in patches])
 
-        if not origin or not isinstance(patches, dict):
-            log.error(f"Invalid data format in {repo_id}. Skipping.")
+    checked = []
+    for (patch, current_hash), result in zip(patches.items(), results):
+        # 无法访问任何服务器：保留旧版本信息，下次运行重新检查
+        if result is None:
             continue
+        checked.append(patch)
+        new_hash, validator = result
 
-        for patch, current_hash in patches.items():
-            patch_url = urljoin(format_url(origin), patch)
-            patch_file_js_url = f"{patch_url}/files.js?=2233"
-
-            new_hash = await fetch_patch_ver(patch_file_js_url)
-
-            if new_hash is None:
-                log.error(f"Failed to fetch the hash {patch_file_js_url}.")
-                continue
+        # 服务器返回 304，files.js 未变化
+        if new_hash is None:
+            continue
 
-            if current_hash != new_hash:
-                if repo_id not in update_list:
-                    update_list[repo_id] = []
-                update_list[repo_id].append([patch, patch_url, new_hash])
-                log.info(f"{patch} have a new version!")
-        log.info("Check finished.")
+        if current_hash != new_hash:
+            patch_url = urljoin(format_url(servers[0]), patch)
+            update_list.append([patch, patch_url, new_hash])
+            log.info(f"{patch} have a new version!")
+            # 保留新版本的 files.js，本根目录及其他根目录获取更新列表时不再下载
+            if new_hash in contents:
+                mirror_roots.shared.filelists[new_hash] = contents[new_hash]
+        elif validator[1] and validator != validators.get(patch):
+            index.set_validator(repo_id, patch, *validator)
+    index.mark_checked(repo_id, checked)
+    if len(checked) < len(patches):
+        log.warning(f"{repo_id}: {len(patches) - len(checked)} patches could not be checked, retrying next time.")
+    log.info("Check finished.")
 
     return update_list
 
-async def fetch_update_list(patch_dir: str, patch_url: str):
-    update_list = {}
+# 获取 patch 的更新列表（Manifest，删除的文件带有删除标记），出错时返回 None
+# 本次运行已获取过内容的哈希为 new_hash 的 files.js 不再下载
+async def fetch_update_list(mirror_dir: str, repo_id: str, patch: str, patch_url: str, new_hash=None):
+    index = open_index(mirror_dir)
 
-    async with httpx.AsyncClient() as client:
-        # Step 1: Construct patch_dir and read local files.js
-        local_files_path = os.path.join(patch_dir, "files.js")
+    # Step 1: Make sure the local file list is in the index
+    if not index.has_files(repo_id, patch):
+        local_files_path = os.path.join(mirror_dir, repo_id, patch, "files.js")
 
         if not os.path.exists(local_files_path):
             log.warning(f"{local_files_path} does not exist.")
-            return update_list
+            return None
 
         with open(local_files_path, "r") as f:
-            local_filelist = json.load(f)
+            index.import_filelist(repo_id, patch, json.load(f))
 
-        local_filelist.pop("patch.js", None)
+    # Step 2: Stream origin files.js from the server into the index,
+    # without building the whole dictionary in memory
+    patch_filelist_url = f"{format_url(patch_url)}files.js?=2233"
+    origin = index.origin_list()
+    parser = utils.ObjectItemParser()
 
-        # Step 2: Fetch origin files.js from the server
-        patch_filelist_url = f"{format_url(patch_url)}files.js?=2233"
+    try:
+        # 检查更新时已下载的 files.js；只有一个镜像根目录时用后即释放
+        shared = mirror_roots.shared
+        content = shared.filelists.get(new_hash) if shared.enabled else shared.filelists.pop(new_hash, None)
+        if content is not None:
+            origin.add(parser.feed(content.decode('utf-8')))
+        else:
+            async for text in transfer.iter_text(transfer.shared_client(), patch_filelist_url):
+                origin.add(parser.feed(text))
+        origin.add(parser.close())
 
-        try:
-            response = await client.get(patch_filelist_url)
-            response.raise_for_status()
-            origin_filelist = response.json()
-        except httpx.RequestError as e:
-            log.error(f"An error occurred while requesting {e.request.url!r}.")
-            return update_list
-        except httpx.HTTPStatusError as e:
-            log.error(f"Error response {e.response.status_code} while requesting {e.request.url!r}.")
-            return update_list
-
-        origin_filelist.pop("patch.js", None)
-
-        # Step 3: Compare the local and origin file lists
-        for pfn, local_hash in local_filelist.items():
-            origin_hash = origin_filelist.get(pfn)
-            if local_hash is not None and origin_hash is None:
-                # update_list[pfn] = UpdateMode.REMOVE
-                update_list[pfn] = [local_hash, UpdateMode.REMOVE.value]
-            elif origin_hash is not None and local_hash != origin_hash:
-                # update_list[pfn] = UpdateMode.UPDATE
-                update_list[pfn] = [origin_hash, UpdateMode.UPDATE.value]
-        for pfn, origin_hash in origin_filelist.items():
-            if pfn not in local_filelist and origin_hash is not None:
-                # update_list[pfn] = UpdateMode.UPDATE
-                update_list[pfn] = [origin_hash, UpdateMode.UPDATE.value]
+        # Step 3: Compare the indexed and origin file lists
+        removed, updated = origin.diff(repo_id, patch)
+    except httpx.RequestError as e:
+        log.error(f"An error occurred while requesting {e.request.url!r}.")
+        return None
+    except httpx.HTTPStatusError as e:
+        log.error(f"Error response {e.response.status_code} while requesting {e.request.url!r}.")
+        return None
+    except ValueError as e:
+        log.error(f"Invalid file list {patch_filelist_url}: {e}")
+        return None
+    finally:
+        origin.close()
 
-    return update_list
+    return Manifest.from_diff(removed, updated)
+
+# 按稀疏镜像规则（thcrap_sparse.txt）过滤更新列表
+# 被排除的文件不再下载；之前已镜像的副本改为删除
+# 返回 (过滤后的更新列表, 跳过的文件数, 删除副本释放的字节数)
+def apply_sparse(mirror_dir: str, repo_id: str, patch: str, update_list: Manifest):
+    spec = sparse_spec(os.path.join(mirror_dir, repo_id), patch)
+    if spec is None:
+        return update_list, 0, 0
+    items = {}
+    skipped = 0
+    for pfn, checksum, removed in update_list.items():
+        if not removed and spec.match_file(pfn):
+            skipped += 1
+        else:
+            items[pfn] = (checksum, removed)
+    reclaimed = 0
+    for pfn, (checksum, size, _) in open_index(mirror_dir).file_stats(repo_id, patch).items():
+        if spec.match_file(pfn) and not items.get(pfn, (None, False))[1]:
+            items[pfn] = (checksum, True)
+            reclaimed += size or 0
+    return Manifest((pfn, checksum, removed) for pfn, (checksum, removed) in sorted(items.items())), skipped, reclaimed
 
 # 保存当前更新列表，防止脚本意外中断
-def save_update_list(mirror_dir: str, repo_id: str, patch: str, patch_dir: str, patch_url: str, new_hash: str, update_list):
+def save_update_list(mirror_dir: str, repo_id: str, patch: str, patch_dir: str, patch_urls: list, new_hash: str, update_list: Manifest):
     # 构建需要写入的temp_update_info数据结构
     temp_update_info = {
         "repo_id": repo_id,
         "patch": patch,
         "patch_dir": patch_dir,
-        "patch_url": patch_url,
+        "patch_url": patch_urls[0],
+        "patch_urls": patch_urls,
         "new_hash": new_hash,
-        "files": {pfn: [info[UpdateInfo.checksum.value], info[UpdateInfo.upd_mode.value]] for pfn, info in update_list.items()}
+        "manifest": update_list.to_json()
     }
     
-    # 定义文件路径
-    update_file_path = os.path.join(mirror_dir, '__update.json')
+    # 定义文件路径（每个 repo 单独保存）
+    update_file_path = journal_path(mirror_dir, repo_id)
+    os.makedirs(os.path.dirname(update_file_path), exist_ok=True)
     
-    # 将temp_update_info写入到__update.json中，若文件已存在则覆盖
+    # 将temp_update_info写入到该 repo 的更新状态文件中，若文件已存在则覆盖
     with open(update_file_path, 'w', encoding='utf-8') as f:
         json.dump(temp_update_info, f, ensure_ascii=False, indent=4)
 
+# 将旧版的 __update.json 迁移为对应 repo 的更新状态文件
+def migrate_legacy_journal(mirror_dir: str):
+    legacy_path = os.path.join(mirror_dir, "__update.json")
+    if not os.path.exists(legacy_path):
+        return
+    with open(legacy_path, "r") as f:
+        repo_id = json.load(f).get("repo_id", "")
+    if repo_id:
+        update_file_path = journal_path(mirror_dir, repo_id)
+        os.makedirs(os.path.dirname(update_file_path), exist_ok=True)
+        if not os.path.exists(update_file_path):
+            os.replace(legacy_path, update_file_path)
+            return
+    os.remove(legacy_path)
+
 # 载入上次意外中断的更新信息
-def load_last_info(mirror_dir: str):
-    update_file_path = os.path.join(mirror_dir, "__update.json")
-    
-    # Check if the __update.json file exists
+def load_last_info(update_file_path: str):
+    # Check if the journal file exists
     if not os.path.exists(update_file_path):
         return None
     
@@ -245,83 +440,92 @@ def load_last_info(mirror_dir: str):
     patch = update_info.get("patch", "")
     patch_dir = update_info.get("patch_dir", "")
     patch_url = update_info.get("patch_url", "")
+    patch_urls = update_info.get("patch_urls", [patch_url])
     new_hash = update_info.get("new_hash", "")
-    files_info = update_info.get("files", {})
-    
-    update_list = {}
-    
-    for pfn, (checksum, upd_mode) in files_info.items():
+    if "manifest" in update_info:
+        manifest = Manifest.from_json(update_info["manifest"])
+    else:
+        # 旧版更新状态文件：{文件: [CRC32, 更新模式]}
+        manifest = Manifest(
+            (pfn, checksum, upd_mode == UpdateMode.REMOVE.value)
+            for pfn, (checksum, upd_mode) in sorted(update_info.get("files", {}).items())
+        )
+
+    def pending(pfn, checksum, removed):
         file_path = os.path.join(patch_dir, pfn)
-        
-        # Check if the file exists
-        if not os.path.exists(file_path):
-            continue
-        
-        # Calculate the CRC32 checksum of the file
-        file_checksum = calculate_crc32(file_path)
-        
-        # If checksum matches, skip this file
-        if file_checksum == checksum:
-            continue
-        
-        # Otherwise, add it to the update list
-        update_list[pfn] = [checksum, upd_mode]
-    
+
+        # Files to be removed are done once they are gone
+        if removed:
+            return os.path.exists(file_path)
+
+        # Files to be updated are done once their checksum matches
+        return not (os.path.exists(file_path) and calculate_crc32(file_path) == checksum)
+
     # Return the results
-    return repo_id, patch, patch_dir, patch_url, new_hash, update_list
+    return repo_id, patch, patch_dir, patch_urls, new_hash, manifest.filter(pending)
 
-# 完成上次更新
-async def finish_last_update(mirror_dir: str):
+# 完成上次更新，返回 (patch, 更新文件数, 删除文件数, 因停止运行而仍未下载的文件 Manifest)
+async def finish_last_update(mirror_dir: str, update_file_path: str):
     # 载入中断状态
-    repo_id, patch, patch_dir, patch_url, new_hash, lupd = load_last_info(mirror_dir)
-    if lupd:
-        await process_update(patch_dir, patch_url, lupd)
-        remove_old_filelist(patch_dir)
-        update_version_info(mirror_dir, repo_id, patch, new_hash)
-        repo_dir = os.path.join(mirror_dir, repo_id)
-        repo_build(repo_dir, repo_dir)
-
-# 更新 patch 文件
-async def fetch_update(patch_url: str, pfn: str, patch_dir: str, file_semaphore, rate_limit_kbps=1024, max_retries=5):
+    repo_id, patch, patch_dir, patch_urls, new_hash, lupd = await asyncio.to_thread(load_last_info, update_file_path)
+    if not lupd:
+        return patch, 0, 0, Manifest()
+    updated, removed, deferred = await process_update(mirror_dir, repo_id, patch, patch_urls, lupd)
+    if deferred:
+        # 只保存剩余的文件，下次运行无需重新校验已完成的部分
+        await transfer.run_io(save_update_list, mirror_dir, repo_id, patch, patch_dir, patch_urls, new_hash, deferred)
+        return patch, updated, removed, deferred
+    await transfer.run_io(remove_old_filelist, patch_dir)
+    await transfer.run_io(update_version_info, mirror_dir, repo_id, patch, new_hash)
+    repo_dir = os.path.join(mirror_dir, repo_id)
+    await asyncio.to_thread(repo_build, repo_dir, repo_dir, open_index(mirror_dir), {patch})
+    changes.touch(repo_id, patch)
+    return patch, updated, removed, Manifest()
+
+# 更新 patch 文件（patch_urls 为提供相同文件的服务器，出错时依次切换）
+# key 为运行状态中的 patch 名称（repo/patch）；停止运行后未开始的文件返回 DEFERRED
+async def fetch_update(patch_urls: list, pfn: str, patch_dir: str, file_semaphore, checksum=None, rate_limit_kbps=1024, max_retries=5, key=None):
     rate_limit_bps = rate_limit_kbps * 1024
+    file_path = os.path.normpath(os.path.join(patch_dir, pfn))  # 合成文件保存路径
     retry_count = 0
     success = False
     while retry_count < max_retries and not success:
         try:
+            patch_url = patch_urls[retry_count % len(patch_urls)]
+            file_url = urljoin(format_url(patch_url), f"{pfn}?=2233") # 合成文件的完整URL
             async with file_semaphore:
-                file_url = urljoin(format_url(patch_url), f"{pfn}?=2233") # 合成文件的完整URL
-                file_path = os.path.normpath(os.path.join(patch_dir, pfn))  # 合成文件保存路径
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)  # 创建目录
-                file_name = os.path.basename(file_path)
-                file_dir = os.path.dirname(file_path)
-                temp_file_path = os.path.join(file_dir, f"{file_name}.downloading")
-                
-                async with httpx.AsyncClient() as client:
-
-                    async with client.stream("GET", file_url) as response:
-                        response.raise_for_status()
-                        with open(temp_file_path, "wb") as temp_file:
-                            async for chunk in response.aiter_bytes():
-                                temp_file.write(chunk)
-
-                                # Calculate sleep time to enforce rate limit
-                                time_to_sleep = len(chunk) / rate_limit_bps
-                                await asyncio.sleep(time_to_sleep)
-
-                # 如果目标文件已存在，先删除
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-                # 重命名文件为最终名称
-                os.rename(temp_file_path, file_path)
+                # 到达截止时间或收到停止信号后不再开始新的下载（包括重试），留给下次运行
+                if deadline.current.stopping():
+                    status.current.defer(key, active=retry_count > 0)
+                    return DEFERRED
+                if retry_count == 0:
+                    status.current.begin(key)
+                size = None
+                if retry_count == 0 and mirror_roots.shared.enabled:
+                    # 其他镜像根目录已有相同的文件时直接链接过来
+                    source = await transfer.run_io(mirror_roots.shared.find, patch_dir, pfn, checksum)
+                    if source:
+                        size = await transfer.run_io(mirror_roots.shared.link, source, file_path, checksum)
+                    etag = None
+                if size is None:
+                    # 下载并校验解码后的文件内容
+                    size, etag = await transfer.download(transfer.shared_client(), file_url, file_path, checksum, rate_limit_bps)
+                file_stat = await transfer.run_io(os.stat, file_path)
                 log.update(file_path)
                 success = True
         
-        except (httpx.HTTPStatusError, httpx.RequestError, OSError) as e:
+        except (httpx.HTTPStatusError, httpx.RequestError, OSError, transfer.ChecksumMismatch) as e:
             retry_count += 1
+            status.current.retry()
             log.info(f"Error downloading: {file_path}    Retry {retry_count}/{max_retries}")
             if retry_count >= max_retries:
-                log.error(f"Failed to download {file_path} after {max_retries} retries.")
+                log.error(f"Failed to download {file_path} after {max_retries} retries: {e}")
+                status.current.end(key)
+                return None
+    status.current.end(key, size)
+
+    # 返回供索引记录的文件信息
+    return pfn, checksum, size, file_stat.st_mtime, etag
 
 # 清理过时的 patch 文件
 def clean_patch(patch_dir: str, pfn: str):
@@ -345,29 +549,39 @@ def clean_patch(patch_dir: str, pfn: str):
         except OSError:
             break
 
-# 处理 patch 文件更新
-async def process_update(patch_dir: str, patch_url: str, update_list):
-    ld = []
-    lr = []
+# 处理 patch 文件更新，返回 (下载的文件数, 删除的文件数, 因停止运行而未下载的文件)
+async def process_update(mirror_dir: str, repo_id: str, patch: str, patch_urls: list, update_list: Manifest):
+    patch_dir = os.path.join(mirror_dir, repo_id, patch)
+    index = open_index(mirror_dir)
 
-    # 遍历update_list，将键放入对应的列表
-    for pfn, upd_info in update_list.items():
-        if upd_info[UpdateInfo.upd_mode.value] == UpdateMode.UPDATE.value:
-            ld.append(pfn)
-        elif upd_info[UpdateInfo.upd_mode.value] == UpdateMode.REMOVE.value:
-            lr.append(pfn)
+    # 按删除标记将文件分为下载与清理两组
+    ld = update_list.updated()
+    lr = update_list.removed()
 
     # 创建一个信号量，限制最大并发数为5
     file_semaphore = asyncio.Semaphore(5)
 
     # 异步获取更新
-    tasks = [fetch_update(patch_url, pfn, patch_dir, file_semaphore) for pfn in ld]
-    await asyncio.gather(*tasks)
+    # 将文件分摊到各服务器下载
+    key = f"{repo_id}/{patch}"
+    status.current.queue(key, len(ld))
+    tasks = [
+        fetch_update(upstream.stripe(patch_urls, i), pfn, patch_dir, file_semaphore, checksum, key=key)
+        for i, (pfn, checksum) in enumerate(ld)
+    ]
+    results = await asyncio.gather(*tasks)
+    records = [r for r in results if r and r is not DEFERRED]
+    await transfer.run_io(index.record_files, repo_id, patch, records)
+    left = {pfn for (pfn, _), r in zip(ld, results) if r is DEFERRED}
+    deferred = update_list.filter(lambda pfn, checksum, removed: pfn in left and not removed)
 
-    # 清理补丁
+    # 清理补丁（在 I/O 线程中执行）
     for pfn in lr:
-        clean_patch(patch_dir, pfn)
+        await transfer.run_io(clean_patch, patch_dir, pfn)
+    await transfer.run_io(index.remove_files, repo_id, patch, lr)
+    changes.record(repo_id, patch, [r[0] for r in records], lr)
     log.succ("Finished clean!")
+    return len(records), len(lr), deferred
 
 # 删除原有文件列表(files.js)
 def remove_old_filelist(patch_dir: str):
@@ -383,75 +597,511 @@ def remove_old_filelist(patch_dir: str):
 
 # 更新 patch 版本信息
 def update_version_info(mirror_dir: str, repo_id: str, patch: str, new_hash: str):
-    # 构建文件路径
-    file_path = os.path.join(mirror_dir, '.version', f'{repo_id}.json')
-    
-    # 读取JSON文件内容
-    try:
-        with open(file_path, 'r', encoding='utf-8') as json_file:
-            data = json.load(json_file)
-    except FileNotFoundError:
-        log.error(f"The file {file_path} was not found.")
-        return
-    except json.JSONDecodeError:
-        log.error(f"The file {file_path} is not a valid JSON.")
-        return
-    
+    index = open_index(mirror_dir)
+
     # 更新 patch 版本信息
-    if 'patches' in data and patch in data['patches']:
-        data['patches'][patch] = new_hash
+    if patch in index.patches(repo_id):
+        index.set_patch_version(repo_id, patch, new_hash)
     else:
-        log.error(f"Patch '{patch}' not found in the file.")
+        log.error(f"Patch '{patch}' not found in the index.")
         return
     
-    # 将更新后的数据结构写回文件
+    # 由索引重新生成 .version 文件
     try:
-        with open(file_path, 'w', encoding='utf-8') as json_file:
-            json.dump(data, json_file, indent=4, ensure_ascii=False)
+        index.export_version(repo_id)
         log.succ(f"{repo_id}:Patch version updated!")
     except IOError:
-        log.error(f"Could not write to file {file_path}.")
+        log.error(f"Could not write to file {index.version_path(repo_id)}.")
+
+
+# 获取 check_update() 找到的各 patch 的更新列表，返回 ([(patch, patch_urls, new_hash, 更新列表)], 获取失败的 patch)
+async def fetch_updates(mirror_dir: str, repo_id: str, check_list: list, summary: dict):
+    failed = set()
+    updates = []
+    for patch, patch_url, new_hash in check_list:
+        if deadline.current.stopping():
+            break
+
+        # 找出提供相同 files.js 的上游服务器
+        servers = await upstream.rank_servers(open_index(mirror_dir), repo_id)
+        patch_urls = await upstream.patch_sources(servers, patch, new_hash, mirror_roots.shared.hashes)
+        lupd = await fetch_update_list(mirror_dir, repo_id, patch, patch_urls[0], new_hash)
+
+        # 获取文件列表失败，保留旧版本信息以便下次重试
+        if lupd is None:
+            failed.add(patch)
+            continue
+
+        # 跳过稀疏镜像规则排除的文件
+        lupd, sparse_files, sparse_bytes = await transfer.run_io(apply_sparse, mirror_dir, repo_id, patch, lupd)
+        summary["sparse_files"] += sparse_files
+        summary["sparse_bytes"] += sparse_bytes
+        updates.append((patch, patch_urls, new_hash, lupd))
+    return updates, failed
+
+# 取出计划中该 repo 的更新；计划生成后 patch 版本已变化（已被其他运行同步）的跳过
+def planned_updates(mirror_dir: str, repo_id: str, entries: list):
+    versions = open_index(mirror_dir).patches(repo_id)
+    updates = []
+    for entry in entries:
+        # 中断的更新由更新状态文件恢复
+        if entry.get("resume"):
+            continue
+        if versions.get(entry["patch"]) != entry["old_hash"]:
+            log.warning(f"{repo_id}/{entry['patch']} changed since the plan was made, skipping.")
+            continue
+        updates.append((entry["patch"], entry["patch_urls"], entry["new_hash"], Manifest.from_json(entry["manifest"])))
+    return updates
+
+# 同步单个 repo，返回同步结果摘要
+# only 不为空时只同步其中的 patch；wait 为 True 时等待其他同步任务释放 repo 锁
+# planned 为 --save-plan 保存的该 repo 的计划项，给出时不再检查更新，只执行计划中的更新
+async def sync_repo(mirror_dir: str, repo_id: str, only=None, wait=False, planned=None):
+    summary = {"repo": repo_id, "patches": 0, "updated": 0, "removed": 0, "sparse_files": 0, "sparse_bytes": 0, "deferred": 0, "failed": [], "skipped": False, "stopped": False}
+
+    # 获取 repo 锁，防止与其他同步任务同时处理该 repo
+    lock = locks.repo_lock(mirror_dir, repo_id)
+    try:
+        lock.acquire()
+    except locks.LockHeld:
+        if not wait:
+            log.warning(f"{repo_id} is being synced by another run, skipping.")
+            summary["skipped"] = True
+            return summary
+        log.info(f"{repo_id} is being synced by another run, waiting...")
+        await asyncio.to_thread(lock.acquire, True)
+
+    try:
+        # 已停止运行：不再开始新的 repo，上次的更新状态文件留给下次运行
+        if deadline.current.stopping():
+            summary["stopped"] = True
+            return summary
+
+        # 若上次更新发生中断则优先完成（该 patch 最接近完成）
+        update_path = journal_path(mirror_dir, repo_id)
+        if os.path.exists(update_path):
+            log.info(f"Exception interrupt detected in {repo_id}! Recovering...")
+            patch, updated, removed, deferred = await finish_last_update(mirror_dir, update_path)
+            summary["updated"] += updated
+            summary["removed"] += removed
+            if deferred:
+                summary["deferred"] += len(deferred)
+                summary["stopped"] = True
+                return summary
+            if updated or removed:
+                summary["patches"] += 1
+
+        if planned is None:
+            # 检查 patch 更新，并先获取所有 patch 的更新列表
+            status.current.set_phase(f"checking {repo_id}")
+            check_list = await check_update(mirror_dir, repo_id, only)
+            status.current.set_phase(f"syncing {repo_id}")
+            updates, failed = await fetch_updates(mirror_dir, repo_id, check_list, summary)
+            expected = len(check_list)
+        else:
+            status.current.set_phase(f"syncing {repo_id}")
+            updates, failed = await transfer.run_io(planned_updates, mirror_dir, repo_id, planned), set()
+            expected = len(updates)
+
+        # 获取文件列表失败的 patch 不算完成，本次运行记为失败
+        finished = set()
+        summary["failed"] = sorted(failed)
+        for patch in summary["failed"]:
+            status.current.fail(f"{repo_id}/{patch}")
+
+        # 从需要下载的文件最少的 patch 开始更新，使有限的运行时间尽可能多地完成整个 patch
+        updates.sort(key=lambda update: len(update[3].updated()))
+        for patch, patch_urls, new_hash, lupd in updates:
+            if deadline.current.stopping():
+                break
+            patch_dir = os.path.join(mirror_dir, repo_id, patch)
+
+            # 进行 patch 文件更新
+            if lupd:
+                await transfer.run_io(save_update_list, mirror_dir, repo_id, patch, patch_dir, patch_urls, new_hash, lupd)
+                updated, removed, deferred = await process_update(mirror_dir, repo_id, patch, patch_urls, lupd)
+                summary["updated"] += updated
+                summary["removed"] += removed
+                if deferred:
+                    # 只保存剩余的文件；版本信息不更新，下次运行先完成该 patch
+                    await transfer.run_io(save_update_list, mirror_dir, repo_id, patch, patch_dir, patch_urls, new_hash, deferred)
+                    summary["deferred"] += len(deferred)
+                    break
+                await transfer.run_io(remove_old_filelist, patch_dir)
+                summary["patches"] += 1
+
+            # 即使文件没有差异（如仅 patch.js 变化）也记录新版本，避免每次都重新检查
+            await transfer.run_io(update_version_info, mirror_dir, repo_id, patch, new_hash)
+            finished.add(patch)
+
+        # 未完成的 patch 版本信息保持不变，下次运行会重新检查
+        if len(finished) + len(failed) < expected:
+            summary["stopped"] = True
+
+        # 在当前 repo_id 的所有元素处理完之后调用 repo_build()（在工作线程中执行）
+        # 只重新生成有变动且已完成的 patch，其余 patch 沿用 repo.js 中的信息
+        if finished:
+            repo_dir = os.path.join(mirror_dir, repo_id)
+            status.current.set_phase(f"building {repo_id}")
+            await asyncio.to_thread(repo_build, repo_dir, repo_dir, open_index(mirror_dir), finished)
+            for patch in finished:
+                changes.touch(repo_id, patch)
+
+        # 删除更新状态文件（停止运行时保留剩余的文件）
+        if os.path.exists(update_path) and not summary["deferred"]:
+            os.remove(update_path)
+    finally:
+        lock.release()
+    return summary
+
+# 估计 patch 的更新：需要下载的文件大小取自 HEAD 请求，请求失败时取索引中旧版本的大小；删除的文件取索引中的大小
+async def plan_entry(mirror_dir: str, repo_id: str, patch: str, patch_urls: list, manifest: Manifest):
+    known = await transfer.run_io(open_index(mirror_dir).file_stats, repo_id, patch)
+    updated = manifest.updated()
+    sizes = await transfer.head_sizes(transfer.shared_client(), [
+        urljoin(format_url(upstream.stripe(patch_urls, i)[0]), f"{pfn}?=2233") for i, (pfn, _) in enumerate(updated)
+    ])
+    sizes = [size if size is not None else (known.get(pfn) or (None, None))[1] for (pfn, _), size in zip(updated, sizes)]
+    removed = manifest.removed()
+    return {
+        "root": mirror_dir,
+        "repo": repo_id,
+        "patch": patch,
+        "update": len(updated),
+        "remove": len(removed),
+        "bytes": sum(size for size in sizes if size is not None),
+        "unknown": sizes.count(None),
+        "reclaim": sum((known.get(pfn) or (None, 0))[1] or 0 for pfn in removed),
+        "patch_urls": patch_urls,
+    }
+
+# 为 repo 生成同步计划：检查更新并获取更新列表，但不下载也不删除任何文件，返回计划项列表
+# 上次中断的更新列为 resume 项，执行计划时由更新状态文件恢复
+async def plan_repo(mirror_dir: str, repo_id: str):
+    lock = locks.repo_lock(mirror_dir, repo_id)
+    try:
+        lock.acquire()
+    except locks.LockHeld:
+        log.warning(f"{repo_id} is being synced by another run, skipping.")
+        return []
+
+    try:
+        entries = []
+        update_path = journal_path(mirror_dir, repo_id)
+        if os.path.exists(update_path):
+            _, patch, _, patch_urls, _, lupd = await asyncio.to_thread(load_last_info, update_path)
+            if lupd:
+                entry = await plan_entry(mirror_dir, repo_id, patch, patch_urls, lupd)
+                entry["resume"] = True
+                entries.append(entry)
+
+        check_list = await check_update(mirror_dir, repo_id)
+        summary = {"sparse_files": 0, "sparse_bytes": 0}
+        updates, _ = await fetch_updates(mirror_dir, repo_id, check_list, summary)
+        versions = open_index(mirror_dir).patches(repo_id)
+        for patch, patch_urls, new_hash, lupd in updates:
+            entry = await plan_entry(mirror_dir, repo_id, patch, patch_urls, lupd)
+            entry.update(old_hash=versions.get(patch), new_hash=new_hash, manifest=lupd.to_json())
+            entries.append(entry)
+        return entries
+    finally:
+        lock.release()
 
+# 按计划的 repo 分组：{镜像根目录: {repo: [计划项]}}
+def group_plan(entries: list):
+    plans = {}
+    for entry in entries:
+        plans.setdefault(entry["root"], {}).setdefault(entry["repo"], []).append(entry)
+    return plans
+
+# 工作进程入口：同步一个 repo，并返回摘要、传输统计、变动文件与运行状态
+# 各工作进程将运行状态写入 <状态文件>.<repo>，同步完成后删除；stop_at 为主进程停止安排新文件的时间
+# mirror_dirs 为本次同步的所有镜像根目录，用于从其他根目录链接已有的文件；planned 为该 repo 的计划项
+def sync_worker(mirror_dir: str, repo_id: str, log_options=(None, 'text'), status_path=None, stop_at=None, mirror_dirs=(), planned=None):
+    log.configure(*log_options)
+    deadline.current.stop_at = stop_at
+    deadline.install_signal_handlers(worker=True)
+    mirror_roots.shared.set_roots(mirror_dirs)
+    transfer.stats.hosts.clear()
+    changes.patches.clear()
+    status.current = status.RunStatus()
+    status.current.path = f"{status_path}.{repo_id}" if status_path else None
+    summary = asyncio.run(with_status(sync_repo(mirror_dir, repo_id, planned=planned)))
+    if status_path:
+        os.remove(status.current.path)
+    # 工作进程退出时不会执行 atexit，先写出队列中的日志
+    log.drain()
+    return summary, transfer.stats.hosts, changes.patches, status.current
+
+# 将 repo 分配到多个进程中同步（按计划执行时 plans 为 {repo: [计划项]}）
+async def sync_sharded(mirror_dir: str, repo_ids: list, workers: int, log_options=(None, 'text'), plans=None):
+    status.current.set_phase(f"syncing {len(repo_ids)} repos in {workers} worker processes")
+    from concurrent.futures import ProcessPoolExecutor  # 仅在多进程同步时导入
+
+    loop = asyncio.get_running_loop()
+    ctx = multiprocessing.get_context('spawn')
+    slots = asyncio.Semaphore(workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        # 有空闲的工作进程时才提交下一个 repo，停止运行后不再提交
+        async def submit(repo_id):
+            async with slots:
+                if deadline.current.stopping():
+                    return {"repo": repo_id, "stopped": True}, {}, {}, None
+                return await loop.run_in_executor(
+                    pool, sync_worker, mirror_dir, repo_id, log_options, status.current.path,
+                    deadline.current.stop_at, mirror_roots.shared.roots, plans and plans[repo_id]
+                )
+        results = await asyncio.gather(*[submit(repo_id) for repo_id in repo_ids])
+
+    # 合并各进程的结果
+    summaries = []
+    for summary, hosts, patches, worker_status in results:
+        summaries.append(summary)
+        transfer.stats.merge(hosts)
+        if worker_status:
+            # 运行历史记录各 patch 的结果
+            status.current.patches.update(worker_status.patches)
+            status.current.retries += worker_status.retries
+            status.current.failed += worker_status.failed
+        for repo_id, repo_patches in patches.items():
+            for patch, (updated, removed) in repo_patches.items():
+                changes.touch(repo_id, patch)
+                changes.record(repo_id, patch, updated, removed)
+    return summaries
+
+# 运行 coro，同时定期写出运行状态文件；结束时关闭共用的连接池
+async def with_status(coro):
+    writer = asyncio.create_task(status.current.write_loop(transfer.stats.hosts))
+    outcome = "failed"
+    try:
+        result = await coro
+        if status.current.failed:
+            outcome = "failed"
+        else:
+            outcome = "stopped" if deadline.current.reason else "ok"
+        return result
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        outcome = "stopped"
+        raise
+    finally:
+        writer.cancel()
+        status.current.finish(transfer.stats.hosts, outcome)
+        await transfer.close_shared_client()
+
+# 写出变动 URL 列表，供 CDN 清除缓存与预热；urls 为 (更新的 URL, 删除的 URL)
+async def write_feed(args, urls: tuple):
+    updated, removed = sorted(urls[0]), sorted(urls[1] - urls[0])
+    if not (args.feed and (updated or removed)):
+        return
+    await asyncio.to_thread(feed.write, args.feed, updated, removed)
+    log.succ(f"Feed written to {args.feed}: {len(updated)} URLs updated, {len(removed)} removed")
+    if args.feed_hook:
+        await asyncio.to_thread(feed.run_hook, args.feed_hook, args.feed, log)
+
+# 导出变更集，供边缘节点同步（同步多个镜像根目录时，各根目录写入指定目录下的同名子目录）
+async def export_changeset(args, mirror_dir: str):
+    if not (args.changeset and changes):
+        return
+    if args.changeset_dir and mirror_roots.shared.enabled:
+        changeset_dir = os.path.join(args.changeset_dir, os.path.basename(os.path.normpath(mirror_dir)))
+    else:
+        changeset_dir = args.changeset_dir or os.path.join(mirror_dir, '.changesets')
+    manifest_path = await asyncio.to_thread(changeset.export, changes, mirror_dir, changeset_dir, args.changeset_pack)
+    log.succ(f"Changeset written to {manifest_path}")
+
+# 收集一个镜像根目录的变动：将变动 URL 加入 urls 并导出变更集，然后清空记录
+async def collect_changes(args, mirror_dir: str, urls: tuple):
+    if args.feed and changes:
+        updated, removed = await asyncio.to_thread(feed.changed_urls, changes, mirror_dir, args.site_url)
+        urls[0].update(updated)
+        urls[1].update(removed)
+    await export_changeset(args, mirror_dir)
+    changes.patches.clear()
+
+# 常驻运行，收到触发请求时立即同步各镜像根目录中对应的 repo 或 patch
+async def serve_triggers(args, mirror_dirs: list):
+    import trigger  # 仅在常驻模式下导入
+    status.current.set_phase("waiting for triggers")
+
+    def roots_with(repo_id, patch):
+        return [
+            mirror_dir for mirror_dir in mirror_dirs
+            if repo_id in open_index(mirror_dir).repos()
+            and (patch is None or patch in open_index(mirror_dir).patches(repo_id))
+        ]
+
+    def known(repo_id, patch):
+        return bool(roots_with(repo_id, patch))
+
+    async def sync(repo_id, patch):
+        # 每次都重新选择服务器，探测结果仍按 PROBE_TTL 缓存
+        upstream.reset_ranking(repo_id)
+        mirror_roots.shared.reset()
+        summaries = []
+        urls = (set(), set())
+        for mirror_dir in roots_with(repo_id, patch):
+            summaries.append(await sync_repo(mirror_dir, repo_id, {patch} if patch else None, wait=True))
+            await collect_changes(args, mirror_dir, urls)
+        report_summary(summaries)
+        await write_feed(args, urls)
+        status.current.set_phase("waiting for triggers")
+
+    await trigger.serve(sync, known, log, args.listen, args.spool)
+
+# 生成同步计划：检查各镜像根目录的 repo，输出需要下载与删除的文件及预计耗时，并按需保存
+async def make_plan(args, mirror_dirs: list, repo_ids: dict):
+    saved = plan.new_plan()
+    try:
+        for mirror_dir in mirror_dirs:
+            for repo_id in repo_ids[mirror_dir]:
+                saved["patches"] += await plan_repo(mirror_dir, repo_id)
+    finally:
+        await transfer.close_shared_client()
+    history_path = args.history or os.path.join(mirror_dirs[0], history.HISTORY_FN)
+    saved["eta"] = plan.estimate(saved, await asyncio.to_thread(plan.throughput, history_path, saved["script"]))
+    plan.report(saved, log)
+    if args.save_plan:
+        await asyncio.to_thread(plan.save, args.save_plan, saved)
+        log.succ(f"Plan written to {args.save_plan}, sync it with --apply-plan {args.save_plan}")
+
+# 输出同步结果摘要
+def report_summary(summaries: list):
+    total = {"patches": 0, "updated": 0, "removed": 0, "sparse_files": 0, "sparse_bytes": 0, "deferred": 0}
+    stopped = []
+    failed = []
+    for summary in summaries:
+        if summary.get("skipped"):
+            log.warning(f"{summary['repo']}: skipped (locked by another run)")
+            continue
+        if summary["stopped"]:
+            stopped.append(summary["repo"])
+        if "patches" not in summary:
+            # 停止运行后未开始同步的 repo
+            continue
+        log.info(
+            f"{summary['repo']}: {summary['patches']} patches updated, "
+            f"{summary['updated']} files updated, {summary['removed']} files removed"
+        )
+        for key in total:
+            total[key] += summary[key]
+        failed += [f"{summary['repo']}/{patch}" for patch in summary["failed"]]
+    log.succ(
+        f"Sync finished: {total['patches']} patches updated, "
+        f"{total['updated']} files updated, {total['removed']} files removed"
+    )
+    if total["sparse_files"] or total["sparse_bytes"]:
+        log.info(
+            f"Sparse rules: {total['sparse_files']} files not downloaded, "
+            f"{sizeof_fmt(total['sparse_bytes'])} of earlier copies removed"
+        )
+    if failed:
+        log.error(f"Could not get the file list of {', '.join(failed)}, retrying next time.")
+    if stopped:
+        log.warning(
+            f"Stopped early ({deadline.current.reason}), the next run continues with "
+            f"{', '.join(stopped)} ({total['deferred']} files of interrupted patches left)"
+        )
 
 async def main():
 
-    # 载入用户设置的镜像站路径
+    # 载入用户设置的镜像站路径（可以有多个镜像根目录）
     args = parser.parse_args()
-    mirror_dir = load_custom_dir(args.m)
-
-    # 若上次更新发生中断则优先完成
-    update_path = os.path.join(mirror_dir, "__update.json")
-    log.info("Checking if last update interrupt...")
-    if os.path.exists(update_path):
-        log.info("Exception interrupt detected! Recovering...")
-        await finish_last_update(mirror_dir)
+    log.configure(args.progress, args.log_format)
+    args.plan = args.plan or args.save_plan is not None
+    if args.plan and (args.apply_plan or args.listen or args.spool):
+        parser.error("--plan cannot be used with --apply-plan, --listen or --spool")
+    if args.apply_plan and (args.listen or args.spool):
+        parser.error("--apply-plan cannot be used with --listen or --spool")
+
+    # 按计划同步时只处理计划中的镜像根目录与 repo
+    plans = None
+    if args.apply_plan:
+        try:
+            plans = group_plan(plan.load(args.apply_plan)["patches"])
+        except (OSError, ValueError) as e:
+            log.error(f"Could not load the plan: {e}")
+            sys.exit(1)
+        if not plans:
+            log.succ("The plan has nothing to sync.")
+            return
+        mirror_dirs = list(plans)
     else:
-        log.info("Check finished.")
-
-    # 检查 patch 更新
-    check_list = await check_update(mirror_dir)
-
-    if check_list:
-            # 遍历欲更新 patch 列表
-        for repo_id, patch_info in check_list.items():
-            # 遍历 repo 内所包含的 patch 信息
-            for patch, patch_url, new_hash in patch_info:
-                patch_dir = os.path.join(mirror_dir, repo_id, patch)
-                lupd = await fetch_update_list(patch_dir, patch_url)
-
-                # 进行 patch 文件更新
-                if lupd:
-                    save_update_list(mirror_dir, repo_id, patch, patch_dir, patch_url, new_hash, lupd)
-                    await process_update(patch_dir, patch_url, lupd)
-                    remove_old_filelist(patch_dir)
-                    update_version_info(mirror_dir, repo_id, patch, new_hash)
-            
-            # 在当前 repo_id 的所有元素处理完之后调用 repo_build()
-            repo_dir = os.path.join(mirror_dir, repo_id)
-            repo_build(repo_dir, repo_dir)
+        mirror_dirs = load_mirror_dirs(args.m)
+    mirror_roots.shared.set_roots(mirror_dirs)
+
+    # 旧版更新状态文件迁移
+    for mirror_dir in mirror_dirs:
+        migrate_legacy_journal(mirror_dir)
+
+    if plans:
+        repo_ids = {mirror_dir: list(plans[mirror_dir]) for mirror_dir in mirror_dirs}
+    else:
+        repo_ids = {mirror_dir: list(open_index(mirror_dir).repos()) for mirror_dir in mirror_dirs}
+    if not any(repo_ids.values()):
+        log.error(f"No mirrored repo found in {', '.join(os.path.join(mirror_dir, '.version') for mirror_dir in mirror_dirs)}.")
+        sys.exit(1)
+
+    # 只生成计划，不写出运行状态，也不记录运行历史
+    if args.plan:
+        await make_plan(args, mirror_dirs, repo_ids)
+        return
+
+    status.current.path = args.status or os.path.join(mirror_dirs[0], status.MIRROR_STATUS_FN)
+
+    # 常驻模式：等待触发请求
+    if args.listen or args.spool:
+        if args.deadline or args.max_duration:
+            parser.error("--deadline and --max-duration cannot be used with --listen or --spool")
+        await with_status(serve_triggers(args, mirror_dirs))
+        return
+
+    # 限制运行时间：到达截止时间或收到 SIGTERM/SIGINT 后停止安排新的下载
+    if args.max_duration is not None:
+        deadline.current.set(time.time() + args.max_duration)
+    if args.deadline is not None:
+        deadline.current.set(args.deadline)
+    deadline.install_signal_handlers()
+
+    # 依次同步各镜像根目录，每个根目录中逐个或多进程同步 repo
+    # 后同步的根目录可以沿用先同步的根目录获取的 files.js 与文件
+    async def sync_all():
+        summaries = []
+        urls = (set(), set())
+        for mirror_dir in mirror_dirs:
+            if mirror_roots.shared.enabled:
+                log.info(f"Syncing {mirror_dir} ...")
+            root_plans = plans and plans[mirror_dir]
+            if args.workers > 1 and len(repo_ids[mirror_dir]) > 1:
+                root_summaries = await sync_sharded(mirror_dir, repo_ids[mirror_dir], args.workers, (args.progress, args.log_format), root_plans)
+            else:
+                root_summaries = [
+                    await sync_repo(mirror_dir, repo_id, planned=root_plans and root_plans[repo_id])
+                    for repo_id in repo_ids[mirror_dir]
+                ]
+            if mirror_roots.shared.enabled:
+                for summary in root_summaries:
+                    summary["repo"] = os.path.join(mirror_dir, summary["repo"])
+            summaries += root_summaries
+
+            # 导出变更集并收集变动 URL
+            status.current.set_phase("publishing")
+            await collect_changes(args, mirror_dir, urls)
+        report_summary(summaries)
+
+        # 写出所有根目录的变动 URL 列表
+        await write_feed(args, urls)
+
+    # 无论结果如何都记录本次运行（结束方式由 with_status() 记录在运行状态中）
+    try:
+        await with_status(sync_all())
+    finally:
+        history_path = args.history or os.path.join(mirror_dirs[0], history.HISTORY_FN)
+        history.append(history_path, history.record(status.current, transfer.stats.hosts, status.current.outcome))
 
-    # 删除更新状态文件
-    if os.path.exists(update_path):
-        os.remove(update_path)
+    # 输出各主机的传输量与压缩率，以及启动耗时
+    transfer.stats.report(log)
+    transfer.report_timing(log, START_TIME, IMPORT_TIME)
 
-asyncio.run(main())
\ No newline at end of file
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    asyncio.run(main())
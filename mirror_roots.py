@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# mirror_roots.py
+# 多个镜像根目录之间的共享
+# 功能：
+# 1.记录本次运行中获取的 files.js，查找上游服务器与生成更新列表时不再重复下载；同步多个镜像根目录（如正式版与测试版镜像）时其他根目录也不再重复下载
+# 2.下载文件前在其他根目录中查找 CRC32 相同的同一文件，以硬链接（跨文件系统时复制）代替下载
+import os
+import shutil
+
+from changeset import file_crc32
+from manifest_index import open_index
+
+
+class SharedRoots:
+    """What the mirror roots synced by one process share. With a single
+    root, the files.js fetched to check for updates are still reused to
+    find the servers of a patch and to build its update list.
+
+    [hashes] maps the files.js URLs fetched during the run to the SHA-256
+    of their content and their (url, etag) validator, [filelists] keeps the content of the files.js that
+    have a new version, by SHA-256, until the end of the run (with a
+    single root, until its update list is built)."""
+
+    def __init__(self):
+        self.roots = []
+        self.hashes = {}
+        self.filelists = {}
+        self.file_stats = {}
+
+    @property
+    def enabled(self):
+        return len(self.roots) > 1
+
+    def set_roots(self, mirror_dirs: list):
+        self.roots = [os.path.abspath(mirror_dir) for mirror_dir in mirror_dirs]
+
+    def reset(self):
+        """Forgets what was fetched so far (before each sync when running
+        continuously)."""
+        self.hashes.clear()
+        self.filelists.clear()
+        self.file_stats.clear()
+
+    def find(self, patch_dir: str, pfn: str, checksum: int):
+        """Returns the path of [pfn] of the patch in [patch_dir] (a
+        <root>/<repo>/<patch> directory) in another root, if the index of
+        that root lists it with the [checksum] CRC32."""
+        patch_dir = os.path.abspath(patch_dir)
+        mirror_dir, repo_id = os.path.split(os.path.dirname(patch_dir))
+        patch = os.path.basename(patch_dir)
+        for root in self.roots:
+            if root == mirror_dir:
+                continue
+            key = (root, repo_id, patch)
+            if key not in self.file_stats:
+                self.file_stats[key] = open_index(root).file_stats(repo_id, patch)
+            stat = self.file_stats[key].get(pfn)
+            if stat and stat[0] == checksum:
+                return os.path.join(root, repo_id, patch, pfn)
+        return None
+
+    def link(self, source: str, file_path: str, checksum: int):
+        """Hard-links (or, across file systems, copies) [source] to
+        [file_path] through a temporary file, if the content of [source]
+        still matches [checksum]. Returns the size of the file, or None if
+        it has to be downloaded."""
+        try:
+            crc, size = file_crc32(source)
+        except OSError:
+            return None
+        if crc != checksum:
+            return None
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temp_file_path = f"{file_path}.downloading"
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        try:
+            os.link(source, temp_file_path)
+        except OSError:
+            shutil.copy2(source, temp_file_path)
+        os.replace(temp_file_path, file_path)
+        return size
+
+
+shared = SharedRoots()
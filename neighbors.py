@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# neighbors.py
+# thcrap repo 网络的爬取
+# 功能：
+# 1.从种子 repo 出发，沿 repo.js 中的 neighbors 广度优先遍历整个 repo 网络
+# 2.限制同时获取的 repo.js 数量
+# 3.按 repo id 与 URL 去重，并可用允许/拒绝列表（通配符，匹配 id 或 URL）筛选
+import asyncio
+import fnmatch
+import json
+
+import httpx
+
+
+# 判断 repo 是否通过允许/拒绝列表；未给出允许列表时全部允许
+def allowed(repo_id: str, url: str, allow: list, deny: list):
+    def match(rules):
+        return any(fnmatch.fnmatchcase(repo_id, rule) or fnmatch.fnmatchcase(url, rule) for rule in rules)
+    return (not allow or match(allow)) and not match(deny)
+
+
+def normalize(url: str):
+    return url if url.endswith('/') else url + '/'
+
+
+async def crawl(fetch_json, seeds: list, log, allow=(), deny=(), max_depth=None, concurrency=8):
+    """Follows the `neighbors` of the repo.js of every repo reachable from
+    the [seeds] URLs, breadth-first. Each repo.js is fetched through the
+    [fetch_json] coroutine function, at most [concurrency] at the same
+    time, going at most [max_depth] hops away from the seeds (no limit if
+    None). Repos are deduplicated by URL and by id, and
+    those rejected by the [allow]/[deny] patterns are neither returned nor
+    followed; seeds are always kept.
+    Returns [(url, repo_js)] in the order the repos were discovered."""
+    semaphore = asyncio.Semaphore(concurrency)
+    seen_urls = set()
+    seen_ids = set()
+    found = []
+
+    async def fetch(url):
+        async with semaphore:
+            try:
+                return await fetch_json(url + 'repo.js')
+            except (httpx.HTTPError, json.JSONDecodeError) as e:
+                log.warning(f"Skipping {url}: {e}")
+                return None
+
+    level = []
+    for url in map(normalize, seeds):
+        if url not in seen_urls:
+            seen_urls.add(url)
+            level.append(url)
+    depth = 0
+    while level:
+        results = await asyncio.gather(*[fetch(url) for url in level])
+        next_level = []
+        for url, repo_js in zip(level, results):
+            if not isinstance(repo_js, dict) or 'id' not in repo_js:
+                continue
+            repo_id = repo_js['id']
+            if repo_id in seen_ids:
+                # 同一 repo 的另一个服务器
+                continue
+            if depth and not allowed(repo_id, url, allow, deny):
+                log.info(f"Skipping {repo_id} ({url}): filtered out")
+                continue
+            seen_ids.add(repo_id)
+            found.append((url, repo_js))
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for neighbor in map(normalize, repo_js.get('neighbors', [])):
+                if neighbor not in seen_urls:
+                    seen_urls.add(neighbor)
+                    next_level.append(neighbor)
+        level = next_level
+        depth += 1
+    return found
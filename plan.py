@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# plan.py
+# 同步与添加计划
+# 功能：
+# 1.保存与载入 --save-plan 生成的计划（JSON），之后可用 --apply-plan 按计划执行，无需重新检查
+# 2.按运行历史中最近的实际吞吐量估计计划的下载耗时
+# 3.输出各 repo/patch 需要下载与删除的文件数和字节数
+import json
+import os
+import sys
+import time
+
+import history
+from repo_update import sizeof_fmt
+from status import format_duration
+
+PLAN_VERSION = 1
+
+# 估计吞吐量所用的最近成功运行次数
+RATE_RUNS = 10
+
+
+def new_plan():
+    """Returns an empty plan of the running script. Each item of
+    "patches" is a dict with at least "repo", "patch", "update" and
+    "remove" (file counts), "bytes" (known download size) and "unknown"
+    (files whose size could not be found)."""
+    return {
+        "version": PLAN_VERSION,
+        "script": os.path.basename(sys.argv[0]),
+        "created": time.time(),
+        "patches": [],
+    }
+
+
+# 保存计划（先写入临时文件，避免留下不完整的计划）
+def save(path: str, plan: dict):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+# 载入计划；不是本脚本生成的计划时抛出 ValueError
+def load(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} is not a plan of this version.")
+    script = os.path.basename(sys.argv[0])
+    if plan.get("script") != script:
+        raise ValueError(f"{path} is a plan of {plan.get('script')}, not of {script}.")
+    return plan
+
+
+def throughput(history_path: str, script: str):
+    """Returns the (files per second, bytes per second) of the last
+    RATE_RUNS successful runs of [script], measured over the time their
+    patches were downloading, or None if no such run is recorded."""
+    runs = [
+        entry for entry in history.load(history_path)
+        if entry["script"] == script and entry.get("outcome") == "ok"
+        and any(p["files"] for p in entry.get("patches", {}).values())
+    ][-RATE_RUNS:]
+    patches = [p for entry in runs for p in entry["patches"].values() if p["files"]]
+    seconds = sum(p["seconds"] for p in patches)
+    if not seconds:
+        return None
+    return sum(p["files"] for p in patches) / seconds, sum(p["bytes"] for p in patches) / seconds
+
+
+def estimate(plan: dict, rates):
+    """Returns the estimated download time of [plan] in seconds from the
+    (files per second, bytes per second) [rates]: whichever of the file
+    count and the byte count takes longer, as the run is either limited by
+    requests or by bandwidth. None without rates."""
+    if rates is None:
+        return None
+    files = sum(p["update"] for p in plan["patches"])
+    size = sum(p["bytes"] for p in plan["patches"])
+    file_rate, byte_rate = rates
+    return max(files / file_rate if file_rate else 0, size / byte_rate if byte_rate else 0)
+
+
+# 输出计划：每个 patch 一行，多个 patch 时附 repo 合计，最后为总计与预计耗时
+def report(plan: dict, log):
+    repos = {}
+    for p in plan["patches"]:
+        repos.setdefault(p.get("root"), {}).setdefault(p["repo"], []).append(p)
+
+    def describe(patches):
+        unknown = sum(p["unknown"] for p in patches)
+        reclaim = sum(p.get("reclaim", 0) for p in patches)
+        return (
+            f"{sum(p['update'] for p in patches)} files to update, "
+            f"{sum(p['remove'] for p in patches)} to remove" + (f" ({sizeof_fmt(reclaim)})" if reclaim else "")
+            + f", {sizeof_fmt(sum(p['bytes'] for p in patches))} to download"
+            + (f" (size of {unknown} files unknown)" if unknown else "")
+        )
+
+    for root, root_repos in repos.items():
+        if root is not None and len(repos) > 1:
+            log.info(f"{root}:")
+        for repo_id, patches in root_repos.items():
+            for p in patches:
+                log.info(f"{repo_id}/{p['patch']}: {describe([p])}" + (" (resuming)" if p.get("resume") else ""))
+            if len(patches) > 1:
+                log.info(f"{repo_id}: {len(patches)} patches, {describe(patches)}")
+
+    if not plan["patches"]:
+        log.succ("Plan: nothing to do.")
+        return
+    log.succ(f"Plan: {len(plan['patches'])} patches, {describe(plan['patches'])}")
+    if plan.get("eta") is None:
+        log.info("Estimated duration: unknown (no successful run recorded in the history yet)")
+    else:
+        log.info(f"Estimated duration: {format_duration(plan['eta'])} at the throughput of recent runs")
@@ -15,17 +15,15 @@ import zlib
 import sys
 import utils
 try:
-    from pathspec import PathSpec
+    import fcntl
 except ModuleNotFoundError:
-    print("""Please install pathspec from pip:
+    fcntl = None
 
-    $ pip install pathspec
-
-(You might need to change `pip` to `pip3` if Python 2 is the default on your
-system.)""", file=sys.stderr)
-    sys.exit(1)
+IGNORED_BY_DEFAULT = {'files.js', 'Thumbs.db', 'thcrap_ignore.txt', 'thcrap_sparse.txt'}
+SPARSE_FN = 'thcrap_sparse.txt'
 
-IGNORED_BY_DEFAULT = {'files.js', 'Thumbs.db', 'thcrap_ignore.txt'}
+# ioctl request for a reflink copy on Linux (btrfs, XFS...).
+FICLONE = 0x40049409
 
 parser = argparse.ArgumentParser(
     description=__doc__
@@ -50,6 +48,14 @@ parser.add_argument(
     dest='t'
 )
 
+parser.add_argument(
+    '--link',
+    help='When copying patch files to the destination directory, hardlink '
+         'them instead. Only use this if the source files are never '
+         'modified in place.',
+    action='store_true'
+)
+
 
 def str_slash_normalize(string):
     return string.replace('\\', '/')
@@ -68,6 +74,22 @@ def sizeof_fmt(num):
     return "%3.1f %s" % (num, 'TB')
 
 
+def pathspec_get():
+    """Imports pathspec on first use, so that scripts importing this module
+    only pay for it once a repository is actually built."""
+    try:
+        from pathspec import PathSpec
+    except ModuleNotFoundError:
+        print("""Please install pathspec from pip:
+
+    $ pip install pathspec
+
+(You might need to change `pip` to `pip3` if Python 2 is the default on your
+system.)""", file=sys.stderr)
+        sys.exit(1)
+    return PathSpec
+
+
 def thcrap_ignore_get(path):
     try:
         with open(os.path.join(path, 'thcrap_ignore.txt'), 'r') as f:
@@ -76,6 +98,81 @@ def thcrap_ignore_get(path):
         return {}
 
 
+def sparse_spec(repo_dir, patch_id):
+    """Returns a PathSpec matching the files of [patch_id] that are not
+    mirrored, built from the `thcrap_sparse.txt` of [repo_dir] followed by
+    the one of the patch (so that the patch can re-include files with
+    `!pattern`), or None if there is no rule. Patterns use the same
+    wildmatch syntax as `thcrap_ignore.txt`, relative to the patch."""
+    rules = []
+    for path in [repo_dir, os.path.join(repo_dir, patch_id)]:
+        try:
+            with open(os.path.join(path, SPARSE_FN), 'r') as f:
+                rules += [i for i in f.read().splitlines() if i.strip() and not i.startswith('#')]
+        except FileNotFoundError:
+            pass
+    if not rules:
+        return None
+    return pathspec_get().from_lines('gitwildmatch', rules)
+
+
+def copy_data(f_file, t_file):
+    """Copies the contents of [f_file] to [t_file] inside the kernel if
+    possible: as a reflink sharing the same blocks, then through
+    copy_file_range(), and only then through a regular copy."""
+    if fcntl:
+        try:
+            fcntl.ioctl(t_file.fileno(), FICLONE, f_file.fileno())
+            return
+        except OSError:
+            pass
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(f_file.fileno(), t_file.fileno(), 1024 * 1024 * 1024):
+                pass
+            return
+        except OSError:
+            f_file.seek(0)
+            t_file.seek(0)
+            t_file.truncate()
+    shutil.copyfileobj(f_file, t_file)
+
+
+def export_file(f_fn, t_fn, link=False):
+    """Replaces [t_fn] with a copy of [f_fn] (or, if [link] is set, a
+    hardlink to it) through a temporary file, so that the destination
+    never serves a partially written file."""
+    tmp_fn = t_fn + '.exporting'
+    if os.path.lexists(tmp_fn):
+        os.remove(tmp_fn)
+    if link:
+        try:
+            os.link(f_fn, tmp_fn)
+            os.replace(tmp_fn, t_fn)
+            return
+        except OSError:
+            pass
+    with open(f_fn, 'rb') as f_file, open(tmp_fn, 'wb') as t_file:
+        copy_data(f_file, t_file)
+    shutil.copystat(f_fn, tmp_fn)
+    os.replace(tmp_fn, t_fn)
+
+
+def prune_file(t_path, t_fn):
+    """Removes [t_fn] and its parent directories inside [t_path] that
+    are left empty."""
+    if not os.path.isfile(t_fn):
+        return
+    os.remove(t_fn)
+    t_dir = os.path.dirname(t_fn)
+    while os.path.normpath(t_dir) != os.path.normpath(t_path):
+        try:
+            os.rmdir(t_dir)
+        except OSError:
+            break
+        t_dir = os.path.dirname(t_dir)
+
+
 def patch_files_walk(repo_top, path, ignored):
     """Yields string for every valid patch file in [path] whose file name does
     not match the wildmatch patterns in [ignored], treated relative to
@@ -87,7 +184,7 @@ def patch_files_walk(repo_top, path, ignored):
     if len(local_ignore) >= 1:
         ignored = set(ignored).union(local_ignore)
 
-    spec = PathSpec.from_lines('gitwildmatch', ignored)
+    spec = pathspec_get().from_lines('gitwildmatch', ignored)
     for i in os.scandir(path):
         if spec.match_file(os.path.relpath(i.path, repo_top)) == False:
             if i.is_dir():
@@ -96,16 +193,26 @@ def patch_files_walk(repo_top, path, ignored):
                 yield i.path
 
 
-def patch_build(patch_id, servers, f, t, ignored):
+def patch_build(patch_id, servers, f, t, ignored, index=None, link=False, sparse=None):
     """Updates the patch in the [f]/[patch_id] directory, ignoring the files
-    that match [ignored].
+    that match [ignored] or, relative to the patch, the [sparse] PathSpec
+    of files that are not mirrored.
 
     Ensures that patch.js contains all necessary keys and values, then updates
     the checksums in files.js and, if [t] differs from [f], copies all patch
-    files from [f] to [t].
+    files from [f] to [t]. Files whose size and checksum in the files.js of
+    [t] already match are not copied again, and files removed from the patch
+    are removed from [t] as well.
+
+    If a mirror [index] is given, files whose size and modification time
+    match the index are not read again, and the index receives the complete
+    file list of the patch.
 
     Returns the contents of the patch ID key in repo.js."""
     f_path, t_path = [os.path.join(i, patch_id) for i in [f, t]]
+    repo_id = os.path.basename(os.path.normpath(f))
+    known = index.file_stats(repo_id, patch_id) if index else {}
+    records = []
 
     # Prepare patch.js.
     f_patch_fn = os.path.join(f_path, 'patch.js')
@@ -134,32 +241,69 @@ def patch_build(patch_id, servers, f, t, ignored):
     except FileNotFoundError:
         files_js = {}
 
+    # Checksums of the files currently in the destination.
+    exported = {}
+    if f != t:
+        try:
+            exported = utils.json_load(os.path.join(t_path, 'files.js'))
+        except FileNotFoundError:
+            pass
+
     patch_size = 0
     print(patch_id, end='')
     for f_fn in patch_files_walk(f, f_path, ignored):
         print('.', end='')
         patch_fn = f_fn[len(f_path) + 1:]
         t_fn = os.path.join(t_path, patch_fn)
-
-        with open(f_fn, 'rb') as f_file:
-            f_file_data = f_file.read()
-
-        # Ensure Unix line endings for JSON input
-        if f_fn.endswith(('.js', '.jdiff')) and b'\r\n' in f_file_data:
-            f_file_data = f_file_data.replace(b'\r\n', b'\n')
-            with open(f_fn, 'wb') as f_file:
-                f_file.write(f_file_data)
-
-        f_sum = zlib.crc32(f_file_data) & 0xffffffff
-
-        files_js[str_slash_normalize(patch_fn)] = f_sum
-        patch_size += len(f_file_data)
-        del(f_file_data)
+        files_fn = str_slash_normalize(patch_fn)
+        if sparse is not None and sparse.match_file(files_fn):
+            continue
+
+        f_stat = os.stat(f_fn)
+        cached = known.get(files_fn)
+        if cached and cached[1:] == (f_stat.st_size, f_stat.st_mtime):
+            f_sum = cached[0]
+            f_size = f_stat.st_size
+        else:
+            with open(f_fn, 'rb') as f_file:
+                f_file_data = f_file.read()
+
+            # Ensure Unix line endings for JSON input. The file may be
+            # hard-linked from another mirror root or export target, so
+            # write a new file instead of changing the shared one in place.
+            if f_fn.endswith(('.js', '.jdiff')) and b'\r\n' in f_file_data:
+                f_file_data = f_file_data.replace(b'\r\n', b'\n')
+                tmp_fn = f_fn + '.converting'
+                with open(tmp_fn, 'wb') as f_file:
+                    f_file.write(f_file_data)
+                shutil.copymode(f_fn, tmp_fn)
+                os.replace(tmp_fn, f_fn)
+                f_stat = os.stat(f_fn)
+
+            f_sum = zlib.crc32(f_file_data) & 0xffffffff
+            f_size = len(f_file_data)
+            del(f_file_data)
+
+        files_js[files_fn] = f_sum
+        records.append((files_fn, f_sum, f_size, f_stat.st_mtime))
+        patch_size += f_size
         os.makedirs(os.path.dirname(t_fn), exist_ok=True)
         if f != t:
-            shutil.copy2(f_fn, t_fn)
+            try:
+                t_size = os.stat(t_fn).st_size
+            except FileNotFoundError:
+                t_size = None
+            if exported.get(files_fn) != f_sum or t_size != f_size:
+                export_file(f_fn, t_fn, link)
+
+    if f != t:
+        for files_fn in set(exported).union(files_js):
+            if files_js.get(files_fn) is None:
+                prune_file(t_path, os.path.join(t_path, files_fn))
 
     utils.json_store('files.js', files_js, dirs=[f_path, t_path])
+    if index:
+        index.replace_files(repo_id, patch_id, records)
     print(
         '{num} files, {size}'.format(
             num=len({k: v for k, v in files_js.items() if v is not None}),
@@ -169,7 +313,34 @@ def patch_build(patch_id, servers, f, t, ignored):
     return patch_js['title']
 
 
-def repo_build(f, t):
+def patch_unchanged(patch_id, servers, f, t):
+    """Returns whether the patch.js and files.js of the patch in the
+    [f]/[patch_id] directory are already up to date for [servers], so that
+    patch_build would not change them."""
+    f_path, t_path = [os.path.join(i, patch_id) for i in [f, t]]
+    if not os.path.isfile(os.path.join(t_path, 'files.js')):
+        return False
+    try:
+        patch_js = utils.json_load(os.path.join(f_path, 'patch.js'))
+    except (OSError, ValueError):
+        return False
+    expected = [
+        str_slash_normalize(os.path.join(i, patch_id) + '/') for i in servers
+    ]
+    return (
+        patch_js.get('id') == patch_id and
+        patch_js.get('title', '').strip() != '' and
+        patch_js.get('servers') == expected and
+        'files' not in patch_js
+    )
+
+
+def repo_build(f, t, index=None, changed=None, link=False):
+    """Builds repo.js and every patch found in [f].
+
+    If [changed] is a set of patch IDs, the other patches keep their
+    entry from the existing repo.js as long as their patch.js and files.js
+    are already up to date, and are neither read nor written again."""
     try:
         f_repo_fn = os.path.join(f, 'repo.js')
         repo_js = utils.json_load(f_repo_fn)
@@ -190,6 +361,7 @@ def repo_build(f, t):
             'Enter the public URL of your repository '
             '(the path that contains repo.js): '
         )]
+    previous = repo_js.get('patches', {})
     repo_js['patches'] = {}
 
     ignored = set(IGNORED_BY_DEFAULT).union(thcrap_ignore_get(f))
@@ -197,8 +369,16 @@ def repo_build(f, t):
         del(dirs)
         if 'patch.js' in files:
             patch_id = os.path.basename(root)
+            if (
+                changed is not None and patch_id not in changed and
+                patch_id in previous and
+                patch_unchanged(patch_id, repo_js['servers'], f, t)
+            ):
+                repo_js['patches'][patch_id] = previous[patch_id]
+                continue
             repo_js['patches'][patch_id] = patch_build(
-                patch_id, repo_js['servers'], f, t, ignored
+                patch_id, repo_js['servers'], f, t, ignored, index, link,
+                sparse_spec(f, patch_id)
             )
     print('Done.')
     utils.json_store('repo.js', repo_js, dirs=[f, t])
@@ -206,4 +386,4 @@ def repo_build(f, t):
 
 if __name__ == '__main__':
     arg = parser.parse_args()
-    repo_build(arg.f, arg.t)
+    repo_build(arg.f, arg.t, link=arg.link)
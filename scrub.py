@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# scrub.py
+# 镜像站完整性校验
+# 功能：
+# 1.并行校验每个已镜像文件的 CRC32 是否与 files.js 一致
+# 2.限制读取带宽与 IOPS，可在正在提供服务的节点上运行
+# 3.记录校验进度，中断后可继续
+# 4.通过同步脚本的下载流程重新下载损坏或缺失的文件
+# 5.报告未被任何 files.js 列出的多余文件
+# 用法：
+#   python scrub.py [-m mirror_dir] [-j workers] [--bandwidth MiB/s] [--iops N] [--no-repair] [--restart]
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zlib import crc32
+
+import locks
+import transfer
+import upstream
+import utils
+from color_logger import ColorLogger
+from manifest import Manifest
+from manifest_index import open_index
+from repo_update import IGNORED_BY_DEFAULT, sizeof_fmt, str_slash_normalize
+
+STATE_FN = '.scrub.json'
+READ_SIZE = 1024 * 1024
+
+log = ColorLogger('scrub').logger
+
+
+class Throttle:
+    """Limits the rate at which all scrub threads consume a resource
+    (bytes or read operations), by handing out consecutive time slots."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def take(self, amount=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next, now)
+            self.next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+# 计算文件 CRC32，返回 (crc32, size, mtime)；文件不存在时返回 None
+def verify_file(file_path: str, bandwidth: Throttle, iops: Throttle):
+    checksum = 0
+    size = 0
+    try:
+        iops.take()
+        with open(file_path, 'rb') as f:
+            while True:
+                iops.take()
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    break
+                bandwidth.take(len(chunk))
+                checksum = crc32(chunk, checksum)
+                size += len(chunk)
+            mtime = os.fstat(f.fileno()).st_mtime
+    except FileNotFoundError:
+        return None
+    return checksum & 0xFFFFFFFF, size, mtime
+
+
+# 列出 patch 目录中未被 files.js 列出的文件
+def find_orphans(patch_dir: str, files: dict):
+    orphans = []
+    for root, _, names in os.walk(patch_dir):
+        for name in names:
+            if name in IGNORED_BY_DEFAULT:
+                continue
+            pfn = str_slash_normalize(os.path.relpath(os.path.join(root, name), patch_dir))
+            if files.get(pfn) is None:
+                orphans.append(pfn)
+    return sorted(orphans)
+
+
+# 列出镜像站中所有带有 files.js 的 patch
+def mirrored_patches(mirror_dir: str):
+    for repo_id in sorted(open_index(mirror_dir).repos()):
+        repo_dir = os.path.join(mirror_dir, repo_id)
+        if not os.path.isdir(repo_dir):
+            continue
+        for entry in sorted(os.scandir(repo_dir), key=lambda e: e.name):
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, 'files.js')):
+                yield repo_id, entry.name
+
+
+def load_state(mirror_dir: str):
+    try:
+        with open(os.path.join(mirror_dir, STATE_FN), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"done": [], "damaged": {}, "orphans": 0}
+
+
+def save_state(mirror_dir: str, state: dict):
+    path = os.path.join(mirror_dir, STATE_FN)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+# 校验单个 patch，返回 (校验的字节数, 损坏或缺失的文件 {文件: CRC32}, 多余文件列表)
+def scrub_patch(mirror_dir: str, repo_id: str, patch: str, pool, bandwidth: Throttle, iops: Throttle):
+    patch_dir = os.path.join(mirror_dir, repo_id, patch)
+    files = utils.json_load(os.path.join(patch_dir, 'files.js'))
+    listed = {pfn: crc for pfn, crc in files.items() if crc is not None}
+    results = pool.map(
+        lambda pfn: verify_file(os.path.join(patch_dir, pfn), bandwidth, iops), listed
+    )
+
+    damaged = {}
+    verified = []
+    total = 0
+    for (pfn, crc), res in zip(listed.items(), results):
+        if res is None:
+            log.error(f"Missing: {repo_id}/{patch}/{pfn}")
+            damaged[pfn] = crc
+        elif res[0] != crc:
+            log.error(f"CRC32 mismatch: {repo_id}/{patch}/{pfn}")
+            damaged[pfn] = crc
+            total += res[1]
+        else:
+            verified.append((pfn, crc, res[1], res[2], None))
+            total += res[1]
+    open_index(mirror_dir).record_files(repo_id, patch, verified)
+    return total, damaged, find_orphans(patch_dir, files)
+
+
+# 重新下载损坏或缺失的文件；修复完成的 patch 从 damaged 中删除，未能修复的文件保留
+async def repair(mirror_dir: str, damaged: dict):
+    import mirror_repo  # 仅在修复时导入，校验本身不初始化同步脚本
+    index = open_index(mirror_dir)
+    try:
+        for key, files in list(damaged.items()):
+            repo_id, patch = key.split('/', 1)
+            try:
+                lock = locks.repo_lock(mirror_dir, repo_id).acquire()
+            except locks.LockHeld:
+                log.warning(f"{repo_id} is being synced, not repairing {key} now.")
+                continue
+            try:
+                servers = await upstream.rank_servers(index, repo_id, index.origin(repo_id), log)
+                patch_urls = await upstream.patch_sources(servers, patch, index.patches(repo_id).get(patch))
+                manifest = Manifest((pfn, crc, False) for pfn, crc in sorted(files.items()))
+                updated, _, _ = await mirror_repo.process_update(mirror_dir, repo_id, patch, patch_urls, manifest)
+                # 先写出同步脚本日志中的下载记录，避免与本脚本的输出交错
+                mirror_repo.log.drain()
+                log.succ(f"{key}: {updated}/{len(manifest)} files repaired")
+                if updated == len(manifest):
+                    del damaged[key]
+                else:
+                    # 只保留仍未通过校验的文件
+                    patch_dir = os.path.join(mirror_dir, repo_id, patch)
+                    results = [verify_file(os.path.join(patch_dir, pfn), Throttle(None), Throttle(None)) for pfn in files]
+                    damaged[key] = {pfn: crc for (pfn, crc), res in zip(files.items(), results) if res is None or res[0] != crc}
+            finally:
+                lock.release()
+    finally:
+        await transfer.close_shared_client()
+
+
+def scrub(mirror_dir: str, workers=4, bandwidth=None, iops=None, repair_files=True, restart=False):
+    """Verifies every file listed in the files.js of every mirrored patch,
+    reading at most [bandwidth] bytes and [iops] reads per second. Progress
+    is saved after each patch, so that an interrupted scrub continues where
+    it stopped unless [restart] is set."""
+    state = {"done": [], "damaged": {}, "orphans": 0} if restart else load_state(mirror_dir)
+    done = set(state["done"])
+    bandwidth = Throttle(bandwidth)
+    iops = Throttle(iops)
+    total = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scrub') as pool:
+        for repo_id, patch in mirrored_patches(mirror_dir):
+            key = f"{repo_id}/{patch}"
+            if key in done:
+                continue
+            size, damaged, orphans = scrub_patch(mirror_dir, repo_id, patch, pool, bandwidth, iops)
+            total += size
+            for pfn in orphans:
+                log.warning(f"Orphan: {key}/{pfn}")
+            state["damaged"].pop(key, None)
+            if damaged:
+                state["damaged"][key] = damaged
+            state["orphans"] += len(orphans)
+            state["done"].append(key)
+            save_state(mirror_dir, state)
+
+    elapsed = max(time.monotonic() - start, 1e-3)
+    damaged_count = sum(len(files) for files in state["damaged"].values())
+    log.info(
+        f"Scrubbed {len(state['done'])} patches, {sizeof_fmt(total)} read this run "
+        f"({sizeof_fmt(total / elapsed)}/s): {damaged_count} damaged or missing files, "
+        f"{state['orphans']} orphan files"
+    )
+
+    if repair_files and state["damaged"]:
+        asyncio.run(repair(mirror_dir, state["damaged"]))
+
+    # 本轮校验完成：未修复的文件（如 repo 正在同步）保留在状态文件中，下次运行重新校验后再修复
+    if state["damaged"]:
+        save_state(mirror_dir, {"done": [], "damaged": state["damaged"], "orphans": 0})
+    elif os.path.exists(os.path.join(mirror_dir, STATE_FN)):
+        os.remove(os.path.join(mirror_dir, STATE_FN))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify every mirrored file against its files.js.")
+    parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                        help='The mirror directory')
+    parser.add_argument('-j', '--jobs', metavar='N', default=4, type=int,
+                        help='Number of files verified in parallel')
+    parser.add_argument('--bandwidth', metavar='MiB/s', default=None, type=float,
+                        help='Maximum read bandwidth')
+    parser.add_argument('--iops', metavar='N', default=None, type=float,
+                        help='Maximum read operations per second')
+    parser.add_argument('--no-repair', action='store_true',
+                        help='Only report damaged files, do not download them again')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the progress of an interrupted scrub')
+    arg = parser.parse_args()
+    scrub(
+        arg.m, arg.jobs,
+        arg.bandwidth * 1024 * 1024 if arg.bandwidth else None, arg.iops,
+        not arg.no_repair, arg.restart
+    )
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# status.py
+# 运行状态文件
+# 功能：
+# 1.同步与添加脚本运行时每隔数秒以原子方式写出状态快照：当前阶段、各 patch 排队/下载中/完成的文件数与字节数、各主机吞吐量、重试次数以及预计剩余时间
+# 2.命令行打印状态文件；运行停滞、进程已退出或运行失败时以非零状态码退出，供监控告警
+# 用法：
+#   python status.py [status_file ...] [-m mirror_dir]
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+
+from repo_update import sizeof_fmt
+
+# 镜像站目录中的默认状态文件
+MIRROR_STATUS_FN = '.mirror-status.json'
+ADD_STATUS_FN = '.add-status.json'
+
+INTERVAL = 5
+
+# 计算吞吐量与预计剩余时间所用的时间窗口（秒）
+RATE_WINDOW = 60
+
+
+class PatchProgress:
+    __slots__ = ('queued', 'active', 'done', 'failed', 'deferred', 'done_bytes', 'started', 'ended')
+
+    def __init__(self):
+        self.queued = 0
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.deferred = 0
+        self.done_bytes = 0
+        # 第一个文件开始与最后一个文件结束的时间
+        self.started = None
+        self.ended = None
+
+
+class RunStatus:
+    """Progress of the current run, written to [path] as JSON every
+    INTERVAL seconds by write_loop() (through a temporary file, so that
+    readers never see a partial snapshot)."""
+
+    def __init__(self):
+        self.path = None
+        self.script = os.path.basename(sys.argv[0])
+        self.started = time.time()
+        self.phase = 'starting'
+        # 运行结束方式："ok"、"stopped" 或 "failed"，运行期间为 None
+        self.outcome = None
+        self.phase_started = self.started
+        self.phase_times = {}
+        self.patches = {}
+        self.retries = 0
+        # 本次运行中失败的 patch（repo/patch）
+        self.failed = []
+        self.samples = []
+
+    def patch(self, key: str):
+        if key not in self.patches:
+            self.patches[key] = PatchProgress()
+        return self.patches[key]
+
+    def set_phase(self, phase: str):
+        """Starts [phase]. The time spent in the previous phase is added
+        to [phase_times], under the first word of its name ("checking",
+        "syncing", "building"...)."""
+        now = time.time()
+        kind = self.phase.split()[0]
+        self.phase_times[kind] = self.phase_times.get(kind, 0) + now - self.phase_started
+        self.phase = phase
+        self.phase_started = now
+
+    def queue(self, key: str, count: int):
+        self.patch(key).queued += count
+
+    def begin(self, key: str):
+        progress = self.patch(key)
+        progress.queued -= 1
+        progress.active += 1
+        if progress.started is None:
+            progress.started = time.time()
+
+    def end(self, key: str, size=None):
+        """Marks a file of [key] as done, or as failed if [size] is None."""
+        progress = self.patch(key)
+        progress.active -= 1
+        progress.ended = time.time()
+        if size is None:
+            progress.failed += 1
+        else:
+            progress.done += 1
+            progress.done_bytes += size
+
+    def defer(self, key: str, active=False):
+        """Leaves a queued (or, if [active], started) file of [key] for
+        the next run."""
+        progress = self.patch(key)
+        if active:
+            progress.active -= 1
+        else:
+            progress.queued -= 1
+        progress.deferred += 1
+
+    def retry(self):
+        self.retries += 1
+
+    def fail(self, key: str):
+        """Marks the patch [key] as failed as a whole, e.g. when its file
+        list could not be fetched."""
+        self.failed.append(key)
+
+    def snapshot(self, hosts: dict):
+        """Builds the JSON snapshot. [hosts] are the TransferStats counters,
+        from which the throughput over the last RATE_WINDOW seconds is
+        computed."""
+        now = time.time()
+        done = sum(p.done + p.failed for p in self.patches.values())
+        received = {host: hs.decoded_bytes for host, hs in hosts.items()}
+        self.samples.append((now, done, received))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW:
+            self.samples.pop(0)
+        then, done_then, received_then = self.samples[0]
+        elapsed = now - then
+
+        host_rates = {
+            host: (size - received_then.get(host, 0)) / elapsed if elapsed else 0.0
+            for host, size in received.items()
+        }
+        file_rate = (done - done_then) / elapsed if elapsed else 0.0
+        remaining = sum(p.queued + p.active for p in self.patches.values())
+        return {
+            "script": self.script,
+            "pid": os.getpid(),
+            "started": self.started,
+            "updated": now,
+            "interval": INTERVAL,
+            "phase": self.phase,
+            "outcome": self.outcome,
+            "patches": {
+                key: {
+                    "queued": p.queued, "active": p.active, "done": p.done,
+                    "failed": p.failed, "deferred": p.deferred, "done_bytes": p.done_bytes,
+                }
+                for key, p in self.patches.items()
+            },
+            "throughput": {
+                "bytes_per_second": sum(host_rates.values()),
+                "files_per_second": file_rate,
+                "hosts": host_rates,
+            },
+            "retries": self.retries,
+            "eta": remaining / file_rate if file_rate and remaining else (0 if not remaining else None),
+        }
+
+    def dump(self, data: dict):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
+
+    async def write_loop(self, hosts: dict):
+        """Writes the status file every INTERVAL seconds until cancelled,
+        once [path] is set. The snapshot is taken in the event loop, only
+        the write happens in a worker thread."""
+        while True:
+            if self.path:
+                await asyncio.to_thread(self.dump, self.snapshot(hosts))
+            await asyncio.sleep(INTERVAL)
+
+    def finish(self, hosts: dict, outcome: str):
+        """Ends the run with [outcome] ("ok", "stopped" or "failed") and
+        writes the last snapshot."""
+        self.outcome = outcome
+        self.set_phase('finished')
+        if self.path:
+            self.dump(self.snapshot(hosts))
+
+
+current = RunStatus()
+
+
+# 格式化时长
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+# 判断进程是否仍在运行
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+# 打印状态文件，返回运行是否正常
+def show(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            status = json.load(f)
+    except FileNotFoundError:
+        print(f"{path}: no status")
+        return True
+    now = time.time()
+    age = now - status["updated"]
+    healthy = True
+    state = status["phase"]
+    if status["phase"] == 'finished':
+        if status.get("outcome") == 'failed':
+            state += " (failed)"
+            healthy = False
+        elif status.get("outcome") == 'stopped':
+            state += " (stopped early)"
+    else:
+        if not process_alive(status["pid"]):
+            state += " (process exited)"
+            healthy = False
+        elif age > 3 * status["interval"]:
+            state += f" (stalled, no update for {format_duration(age)})"
+            healthy = False
+
+    print(f"{path}: {status['script']} (pid {status['pid']}), {state}")
+    print(f"  running for {format_duration(status['updated'] - status['started'])}, "
+          f"updated {format_duration(age)} ago, ETA {format_duration(status['eta'])}")
+    throughput = status["throughput"]
+    print(f"  {sizeof_fmt(throughput['bytes_per_second'])}/s, "
+          f"{throughput['files_per_second']:.1f} files/s, {status['retries']} retries")
+    for host, rate in sorted(throughput["hosts"].items()):
+        print(f"    {host}: {sizeof_fmt(rate)}/s")
+    for key, p in sorted(status["patches"].items()):
+        print(f"  {key}: {p['done']} done ({sizeof_fmt(p['done_bytes'])}), "
+              f"{p['active']} active, {p['queued']} queued, {p['failed']} failed"
+              + (f", {p['deferred']} left for the next run" if p.get('deferred') else ""))
+    return healthy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the status of running syncs and adds.")
+    parser.add_argument('paths', metavar='status_file', nargs='*',
+                        help='Status files to show (default: those of the mirror directory)')
+    parser.add_argument('-m', '--mirror', metavar='path', default='.', type=str, dest='m',
+                        help='The mirror directory')
+    arg = parser.parse_args()
+    paths = arg.paths or [os.path.join(arg.m, fn) for fn in (MIRROR_STATUS_FN, ADD_STATUS_FN)]
+    healthy = True
+    for path in paths:
+        healthy = show(path) and healthy
+        # 多进程同步时各工作进程的状态文件
+        for worker_path in sorted(glob.glob(glob.escape(path) + '.*')):
+            if not worker_path.endswith('.tmp'):
+                healthy = show(worker_path) and healthy
+    sys.exit(0 if healthy else 1)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# transfer.py
+# 镜像脚本共用的 HTTP 传输模块
+# 功能：
+# 1.与源服务器协商压缩传输（gzip/br/zstd）
+# 2.边下载边解码写入磁盘，并对解码后的数据做 CRC32 校验
+# 3.按主机统计传输字节数与压缩率
+# 4.通过专用 I/O 线程池写入磁盘，避免阻塞事件循环
+import asyncio
+import codecs
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from zlib import crc32
+
+import httpx
+
+from repo_update import sizeof_fmt
+
+
+# 根据本机可用的解码器生成 Accept-Encoding
+def accept_encoding():
+    encodings = ['gzip', 'deflate']
+    if find_spec('brotli') or find_spec('brotlicffi'):
+        encodings.append('br')
+    if find_spec('zstandard'):
+        encodings.append('zstd')
+    return ', '.join(encodings)
+
+
+HEADERS = {'Accept-Encoding': accept_encoding()}
+
+# 磁盘写入缓冲区大小以及 I/O 线程数
+WRITE_BUFFER_SIZE = 1024 * 1024
+IO_WORKERS = 4
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='mirror-io')
+
+
+# 在 I/O 线程池中执行阻塞的文件系统操作
+async def run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+
+class ChecksumMismatch(Exception):
+    """Raised when the decoded body of a download does not match the CRC32
+    listed in files.js."""
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.encodings = set()
+
+    def ratio(self):
+        if not self.decoded_bytes:
+            return 1.0
+        return self.wire_bytes / self.decoded_bytes
+
+
+class TransferStats:
+    """Keeps per-host counters of the bytes received on the wire and the
+    bytes they decoded to."""
+
+    def __init__(self):
+        self.hosts = {}
+        self.first_request = None
+
+    def record(self, response: httpx.Response, decoded_bytes: int):
+        host = response.url.host
+        if host not in self.hosts:
+            self.hosts[host] = HostStats()
+        hs = self.hosts[host]
+        hs.requests += 1
+        hs.wire_bytes += response.num_bytes_downloaded
+        hs.decoded_bytes += decoded_bytes
+        hs.encodings.add(response.headers.get('Content-Encoding', 'identity'))
+
+    def merge(self, hosts: dict):
+        """Adds the counters of another process."""
+        for host, other in hosts.items():
+            if host not in self.hosts:
+                self.hosts[host] = HostStats()
+            hs = self.hosts[host]
+            hs.requests += other.requests
+            hs.wire_bytes += other.wire_bytes
+            hs.decoded_bytes += other.decoded_bytes
+            hs.encodings |= other.encodings
+
+    def report(self, log):
+        for host, hs in sorted(self.hosts.items()):
+            log.info(
+                f"{host}: {hs.requests} requests, "
+                f"{sizeof_fmt(hs.wire_bytes)} received for {sizeof_fmt(hs.decoded_bytes)} "
+                f"({hs.ratio():.1%}, {', '.join(sorted(hs.encodings))})"
+            )
+
+
+stats = TransferStats()
+
+
+# 记录本次运行发出第一个请求的时间
+async def mark_first_request(request: httpx.Request):
+    if stats.first_request is None:
+        stats.first_request = time.perf_counter()
+
+
+_ssl_context = None
+
+
+# 所有客户端共用一个 SSL 上下文，避免每次都重新加载证书
+def ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+# 创建协商压缩的异步客户端
+def new_client(**kwargs):
+    headers = dict(HEADERS)
+    headers.update(kwargs.pop('headers', {}))
+    kwargs.setdefault('verify', ssl_context())
+    return httpx.AsyncClient(headers=headers, event_hooks={'request': [mark_first_request]}, **kwargs)
+
+
+_shared_client = None
+
+
+# 本次运行共用的客户端：所有请求共用一个连接池，首次使用时创建
+def shared_client():
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = new_client()
+    return _shared_client
+
+
+# 关闭共用的客户端（客户端属于创建它的事件循环，每次 asyncio.run() 结束前调用）
+async def close_shared_client():
+    global _shared_client
+    if _shared_client is not None:
+        client, _shared_client = _shared_client, None
+        await client.aclose()
+
+
+# 获取小文件（files.js、repo.js 等）的完整内容
+# 传入 etag 时发送条件请求，未修改则返回 304 响应
+async def get(client: httpx.AsyncClient, url: str, etag=None):
+    response = await client.get(url, headers={'If-None-Match': etag} if etag else None)
+    if etag and response.status_code == 304:
+        stats.record(response, 0)
+        return response
+    response.raise_for_status()
+    stats.record(response, len(response.content))
+    return response
+
+
+# 以有限的并发发送 HEAD 请求，返回各文件未压缩的大小；失败或未提供 Content-Length 时为 None
+async def head_sizes(client: httpx.AsyncClient, urls: list, concurrency=16):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def head(url):
+        async with semaphore:
+            try:
+                response = await client.head(url, headers={'Accept-Encoding': 'identity'})
+                response.raise_for_status()
+            except (httpx.HTTPStatusError, httpx.RequestError):
+                return None
+            stats.record(response, 0)
+            length = response.headers.get('Content-Length')
+            return int(length) if length and length.isdigit() else None
+
+    return await asyncio.gather(*[head(url) for url in urls])
+
+
+# 流式获取 UTF-8 文本（如大型 files.js），逐块返回解码后的内容
+async def iter_text(client: httpx.AsyncClient, url: str):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    size = 0
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+        stats.record(response, size)
+
+
+# 输出启动耗时：模块导入、发出第一个请求以及整个运行所用的时间
+def report_timing(log, start: float, import_time: float):
+    if stats.first_request is None:
+        first_request = "no request sent"
+    else:
+        first_request = f"first request after {stats.first_request - start:.3f}s"
+    log.info(f"Imports took {import_time:.3f}s, {first_request}, finished in {time.perf_counter() - start:.3f}s")
+
+
+# 流式下载文件，边解码边写入临时文件，校验通过后替换目标文件
+async def download(client: httpx.AsyncClient, url: str, file_path: str, checksum=None, rate_limit_bps=None):
+    """Downloads [url] to [file_path] through a `.downloading` temporary
+    file. The CRC32 of the decoded body is compared against [checksum]
+    (if given) before the temporary file replaces [file_path].
+    Returns the decoded size and the ETag sent by the server.
+
+    Decoded chunks are collected into [WRITE_BUFFER_SIZE] blocks, which
+    are written by [io_executor] while the next block is received."""
+    loop = asyncio.get_running_loop()
+    await run_io(os.makedirs, os.path.dirname(file_path), 0o777, True)
+    temp_file_path = f"{file_path}.downloading"
+
+    file_crc = 0
+    size = 0
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        temp_file = await run_io(open, temp_file_path, "wb")
+        pending = None
+        try:
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes():
+                buffer += chunk
+                file_crc = crc32(chunk, file_crc)
+                size += len(chunk)
+
+                # 缓冲区写满后交给 I/O 线程，同时继续接收下一块数据
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    if pending:
+                        await pending
+                    pending = loop.run_in_executor(io_executor, temp_file.write, bytes(buffer))
+                    buffer.clear()
+
+                # Calculate sleep time to enforce rate limit
+                if rate_limit_bps:
+                    await asyncio.sleep(len(chunk) / rate_limit_bps)
+            if pending:
+                await pending
+            if buffer:
+                await run_io(temp_file.write, bytes(buffer))
+        finally:
+            if pending and not pending.done():
+                await asyncio.wait([pending])
+            await run_io(temp_file.close)
+        stats.record(response, size)
+
+    file_crc &= 0xFFFFFFFF
+    if checksum is not None and file_crc != checksum:
+        await run_io(os.remove, temp_file_path)
+        raise ChecksumMismatch(f"CRC32 mismatch for {url}: expected {checksum}, got {file_crc}")
+
+    await run_io(os.replace, temp_file_path, file_path)
+    return size, response.headers.get('ETag')
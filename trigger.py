@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# trigger.py
+# 即时同步触发器
+# 功能：
+# 1.在本地 HTTP 端口或 UNIX 套接字上接收“同步 repo X 的 patch Y”请求（POST /sync/<repo>[/<patch>]）
+# 2.也可以监视 spool 目录，目录中每个文件的每一行为 “<repo> [patch]”
+# 3.将请求放入队列并逐个同步；已在队列中的请求会被合并，同步中的 patch 完成后最多再同步一次
+import asyncio
+import os
+from urllib.parse import unquote, urlsplit
+
+SPOOL_INTERVAL = 2
+
+HTTP_REASONS = {
+    202: 'Accepted',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+# 请求状态：已入队、同步中、同步中且需要再同步一次
+QUEUED = 'queued'
+RUNNING = 'running'
+RERUN = 'rerun'
+
+
+class TriggerQueue:
+    """Queue of (repo, patch) sync requests. [patch] is None for a whole
+    repo. [sync] is the coroutine function syncing one request, [known]
+    tells whether a request names a mirrored repo and patch."""
+
+    def __init__(self, sync, known, log):
+        self.sync = sync
+        self.known = known
+        self.log = log
+        self.queue = asyncio.Queue()
+        self.state = {}
+
+    def submit(self, repo_id: str, patch=None):
+        """Queues a request. Returns the HTTP status to answer with."""
+        if not self.known(repo_id, patch):
+            return 404, f"{repo_id}/{patch or ''} is not mirrored here"
+        key = (repo_id, patch)
+        state = self.state.get(key)
+        if state in (QUEUED, RERUN):
+            return 202, "already queued"
+        if state == RUNNING:
+            # 同步已经开始，可能错过了这次变化：完成后再同步一次
+            self.state[key] = RERUN
+            return 202, "in progress, will check again"
+        self.state[key] = QUEUED
+        self.queue.put_nowait(key)
+        self.log.info(f"Trigger: {repo_id}/{patch or '*'} queued")
+        return 202, "queued"
+
+    async def worker(self):
+        while True:
+            key = await self.queue.get()
+            self.state[key] = RUNNING
+            try:
+                await self.sync(*key)
+            except Exception as e:
+                self.log.error(f"Trigger: sync of {key[0]}/{key[1] or '*'} failed: {e}")
+            if self.state.pop(key) == RERUN:
+                self.state[key] = QUEUED
+                self.queue.put_nowait(key)
+
+    # 处理一个 HTTP 请求
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            method, target, _ = request_line.split(' ', 2)
+            parts = [unquote(p) for p in urlsplit(target).path.strip('/').split('/')]
+            if method != 'POST':
+                status, message = 405, "use POST /sync/<repo>[/<patch>]"
+            elif len(parts) not in (2, 3) or parts[0] != 'sync' or not all(parts):
+                status, message = 400, "use POST /sync/<repo>[/<patch>]"
+            else:
+                status, message = self.submit(*parts[1:])
+        except ValueError:
+            status, message = 400, "malformed request"
+        body = (message + '\n').encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    # 监视 spool 目录，读取并删除其中的请求文件
+    async def watch_spool(self, spool_dir: str):
+        os.makedirs(spool_dir, exist_ok=True)
+        while True:
+            for entry in sorted(os.scandir(spool_dir), key=lambda e: e.name):
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        lines = f.read().splitlines()
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                for line in lines:
+                    words = line.split()
+                    if 1 <= len(words) <= 2:
+                        status, message = self.submit(*words)
+                        if status != 202:
+                            self.log.warning(f"Trigger {entry.name}: {message}")
+            await asyncio.sleep(SPOOL_INTERVAL)
+
+
+async def serve(sync, known, log, listen=None, spool=None):
+    """Accepts sync requests on [listen] ("[host:]port" or "unix:<path>")
+    and/or from the [spool] directory, and syncs them one at a time until
+    cancelled."""
+    triggers = TriggerQueue(sync, known, log)
+    tasks = [asyncio.create_task(triggers.worker())]
+    servers = []
+    if listen and listen.startswith('unix:'):
+        servers.append(await asyncio.start_unix_server(triggers.handle_http, path=listen[5:]))
+        log.info(f"Listening for triggers on {listen}")
+    elif listen:
+        host, _, port = listen.rpartition(':')
+        servers.append(await asyncio.start_server(triggers.handle_http, host or '127.0.0.1', int(port)))
+        log.info(f"Listening for triggers on {host or '127.0.0.1'}:{port}")
+    if spool:
+        tasks.append(asyncio.create_task(triggers.watch_spool(spool)))
+        log.info(f"Watching {spool} for triggers")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for server in servers:
+            server.close()
+        for task in tasks:
+            task.cancel()
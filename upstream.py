@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# upstream.py
+# 上游服务器选择模块
+# 功能：
+# 1.记录每个 repo 的全部上游服务器（源地址、repo.js 与 patch.js 中的 servers）
+# 2.探测各服务器的延迟与吞吐量，按预计下载耗时排序
+# 3.找出提供相同 files.js 的服务器，供 patch 文件分摊下载及故障切换
+import asyncio
+import json
+import time
+from hashlib import sha256
+from urllib.parse import urljoin
+
+import httpx
+
+import transfer
+from utils import format_url
+
+PROBE_TIMEOUT = 10
+
+# 探测结果的有效期，期间内不再重复探测
+PROBE_TTL = 6 * 3600
+
+# 排序时假定的下载量，用于综合延迟与吞吐量
+REFERENCE_SIZE = 256 * 1024
+
+# 每个 repo 的探测结果在一次运行中只计算一次
+_ranked = {}
+
+
+# 由 patch.js 中的 servers 推出 repo 级别的服务器地址
+def patch_js_servers(patch_js_path: str):
+    try:
+        with open(patch_js_path, 'r', encoding='utf-8') as f:
+            servers = json.load(f).get('servers', [])
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return []
+    return [urljoin(format_url(url), '..') for url in servers if isinstance(url, str)]
+
+
+# 记录 repo 的上游服务器
+def record_servers(index, repo_id: str, urls):
+    index.add_servers(repo_id, [format_url(url) for url in urls if url])
+
+
+# 估计从服务器下载 REFERENCE_SIZE 字节所需的时间
+def server_cost(latency, throughput, failures):
+    if latency is None:
+        return float('inf')
+    return latency + REFERENCE_SIZE / max(throughput or 1, 1) + failures * PROBE_TIMEOUT
+
+
+# 探测单个服务器：以获取 repo.js 的首字节时间为延迟，以正文接收速度为吞吐量
+# 传入 fetch（调用方缓存的 GET）时经由它获取 repo.js，此时以整个响应的耗时同时估计延迟与吞吐量
+async def probe_server(client: httpx.AsyncClient, url: str, fetch=None):
+    if fetch is not None:
+        response = await fetch(urljoin(url, "repo.js"))
+        response.raise_for_status()
+        elapsed = max(response.elapsed.total_seconds(), 1e-3)
+        return elapsed, len(response.content) / elapsed, response.json()
+    start = time.monotonic()
+    async with client.stream("GET", urljoin(url, "repo.js?=2233"), timeout=PROBE_TIMEOUT) as response:
+        response.raise_for_status()
+        latency = time.monotonic() - start
+        body = await response.aread()
+    transfer.stats.record(response, len(body))
+    elapsed = max(time.monotonic() - start - latency, 1e-3)
+    return latency, len(body) / elapsed, json.loads(body)
+
+
+# 并发探测 repo 的所有上游服务器，返回按预计耗时排序的服务器列表
+async def rank_servers(index, repo_id: str, origin=None, log=None, fetch=None):
+    """Probes every known server of [repo_id] and returns their URLs, the
+    fastest first. Servers that failed the probe are kept at the end so
+    that they can still serve as a last resort. Servers listed in the
+    probed repo.js files are recorded for the next run. [fetch], if given,
+    is the coroutine function through which repo.js is requested.
+
+    Only servers whose last probe is older than [PROBE_TTL] are probed
+    again; the others are ranked by their stored results."""
+    if repo_id in _ranked:
+        return _ranked[repo_id]
+
+    record_servers(index, repo_id, [origin])
+    urls = index.stale_servers(repo_id, PROBE_TTL)
+    results = []
+    if urls:
+        client = None if fetch else transfer.shared_client()
+        results = await asyncio.gather(*[probe_server(client, url, fetch) for url in urls], return_exceptions=True)
+
+    found = []
+    for url, res in zip(urls, results):
+        if isinstance(res, Exception):
+            index.record_probe(repo_id, url)
+            if log:
+                log.warning(f"Server {url} is not available: {res}")
+        else:
+            latency, throughput, repo_js = res
+            index.record_probe(repo_id, url, latency, throughput)
+            if isinstance(repo_js, dict) and isinstance(repo_js.get('servers'), list):
+                found.extend(repo_js['servers'])
+    record_servers(index, repo_id, found)
+
+    ranked = sorted(index.servers(repo_id), key=lambda row: server_cost(*row[1:]))
+    _ranked[repo_id] = [url for url, *_ in ranked]
+    if log and len(ranked) > 1:
+        log.info(f"{repo_id}: using {_ranked[repo_id][0]} ({len(ranked)} servers known)")
+    return _ranked[repo_id]
+
+
+# 清除本次运行中缓存的排序结果（常驻运行时每次同步前调用）
+def reset_ranking(repo_id: str):
+    _ranked.pop(repo_id, None)
+
+
+# 依次尝试各个 URL，返回第一个成功的响应
+# validator 为上次的 (url, etag)，仅对该 URL 发送条件请求
+async def get_first(client: httpx.AsyncClient, urls, validator=None):
+    error = None
+    if validator:
+        # 先尝试持有 ETag 的服务器，未变化时只需一次 304 响应
+        urls = sorted(urls, key=lambda url: url != validator[0])
+    for url in urls:
+        etag = validator[1] if validator and validator[0] == url else None
+        try:
+            return url, await transfer.get(client, url, etag)
+        except (httpx.HTTPStatusError, httpx.RequestError) as e:
+            error = e
+    raise error or ValueError("No server to fetch from.")
+
+
+# 找出提供相同 files.js 的服务器，返回对应的 patch URL 列表（最快者优先）
+async def patch_sources(servers, patch: str, reference_hash=None, known=None, digest=None):
+    """Returns the patch URLs, among [servers], whose files.js hashes to
+    [reference_hash] (or, if not given, to the files.js of the first
+    reachable server). Files can be striped across all of them.
+    files.js URLs found in [known] ({url: (sha256, validator)}) are not
+    fetched again. [digest], if given, is the coroutine function returning
+    the SHA-256 of a URL, through which files.js is requested."""
+    patch_urls = [urljoin(format_url(url), f"{patch}/") for url in servers]
+    known = known or {}
+
+    async def digest_of(url):
+        if url in known:
+            return known[url][0]
+        if digest is not None:
+            return await digest(url)
+        response = await transfer.get(transfer.shared_client(), url)
+        return sha256(response.content).hexdigest()
+
+    digests = await asyncio.gather(
+        *[digest_of(f"{url}files.js?=2233") for url in patch_urls],
+        return_exceptions=True
+    )
+    sources = []
+    for url, digest in zip(patch_urls, digests):
+        if isinstance(digest, Exception):
+            continue
+        if reference_hash is None:
+            reference_hash = digest
+        if digest == reference_hash:
+            sources.append(url)
+    return sources or patch_urls[:1]
+
+
+# 为第 i 个文件生成下载 URL 顺序：分摊到各服务器，失败时依次切换
+def stripe(patch_urls, i: int):
+    i %= len(patch_urls)
+    return patch_urls[i:] + patch_urls[:i]
@@ -11,6 +11,20 @@ from collections import OrderedDict
 import json
 import os
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+# JSON backend used by json_load and json_store: 'orjson' if it is
+# installed, 'json' (the standard library) otherwise. Set the
+# THCRAP_JSON_BACKEND environment variable to 'json' to force the fallback.
+JSON_BACKEND = os.environ.get(
+    'THCRAP_JSON_BACKEND', 'orjson' if orjson else 'json'
+)
+if JSON_BACKEND == 'orjson' and not orjson:
+    JSON_BACKEND = 'json'
+
 json_load_params = {
     'object_pairs_hook': OrderedDict
 }
@@ -26,19 +40,179 @@ json_dump_params = {
 
 # Default parameters for JSON input and output
 def json_load(fn, json_kwargs=json_load_params):
+    """Loads the JSON file [fn]. With the orjson backend and the default
+    parameters, objects are returned as plain (insertion-ordered) dicts."""
+    if JSON_BACKEND == 'orjson' and json_kwargs is json_load_params:
+        with open(fn, 'rb') as file:
+            return orjson.loads(file.read())
     with open(fn, 'r', encoding='utf-8') as file:
         return json.load(file, **json_kwargs)
 
 
+def has_float(obj):
+    if isinstance(obj, float):
+        return True
+    if isinstance(obj, dict):
+        return any(has_float(i) for i in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(has_float(i) for i in obj)
+    return False
+
+
+def json_dumps(obj, json_kwargs=json_dump_params):
+    """Serializes [obj] to UTF-8 bytes, followed by a newline.
+
+    With the orjson backend and the default parameters, the output is
+    byte-identical to the one of the standard library: orjson indents by
+    two spaces, which are turned into tabs. Floats are formatted
+    differently by both, so objects containing any, as well as objects
+    orjson refuses, are left to the standard library."""
+    if (
+        JSON_BACKEND == 'orjson' and json_kwargs is json_dump_params and
+        not has_float(obj)
+    ):
+        try:
+            data = orjson.dumps(obj, option=(
+                orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS |
+                orjson.OPT_APPEND_NEWLINE
+            ))
+        except orjson.JSONEncodeError:
+            # Non-string keys, integers beyond 64 bits, surrogates...
+            pass
+        else:
+            # Raw newlines and tabs only occur in the indentation, since
+            # both are escaped inside strings.
+            data = data.replace(b'\n  ', b'\n\t')
+            while b'\t  ' in data:
+                data = data.replace(b'\t  ', b'\t\t')
+            return data
+    return (json.dumps(obj, **json_kwargs) + '\n').encode('utf-8')
+
+
 def json_store(fn, obj, dirs=[''], json_kwargs=json_dump_params):
     """Saves the JSON object [obj] to [fn], creating all necessary
     directories in the process. If [dirs] is given, the function is
-    executed for every root directory in the array."""
+    executed for every root directory in the array. Files that already
+    contain the exact same output are left untouched, so that their
+    modification time is kept."""
+    data = json_dumps(obj, json_kwargs)
     for i in dirs:
         full_fn = os.path.join(i, fn)
+        try:
+            with open(full_fn, 'rb') as file:
+                if file.read() == data:
+                    continue
+        except FileNotFoundError:
+            pass
         dir = os.path.dirname(full_fn)
         if dir.strip():
             os.makedirs(dir, exist_ok=True)
-        with open(full_fn, 'w', newline='\n', encoding='utf-8') as file:
-            json.dump(obj, file, **json_kwargs)
-            file.write('\n')
+        with open(full_fn, 'wb') as file:
+            file.write(data)
+
+
+def format_url(url):
+    """Returns [url] with a trailing slash, so that relative paths can be
+    joined to it."""
+    if not url.endswith('/'):
+        return url + '/'
+    return url
+
+
+class ObjectItemParser:
+    """Incremental parser for a JSON document whose top level is an object,
+    such as files.js. Text can be fed in chunks of any size; every
+    (key, value) pair is returned as soon as it is complete, so that the
+    whole document and the whole object never have to be held in memory
+    at once.
+
+    >>> parser = ObjectItemParser()
+    >>> parser.feed('{"a": 1.') + parser.feed('5e') + parser.feed('-1, "b": [1') + parser.feed(']}')
+    [('a', 0.15), ('b', [1])]
+    >>> parser.close()
+    []
+    """
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.state = 'start'
+        self.key = None
+
+    def skip_whitespace(self):
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+            self.pos += 1
+        return self.pos < len(self.buffer)
+
+    def expect(self, chars):
+        c = self.buffer[self.pos]
+        if c not in chars:
+            raise ValueError(
+                'Expected one of {!r} at offset {}, got {!r}'.format(chars, self.pos, c)
+            )
+        self.pos += 1
+        return c
+
+    def decode(self):
+        """Decodes the value at the current position, or returns False if
+        it might continue in the next chunk."""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            return False
+        # A value at the very end of the buffer, or a number followed by
+        # what may be its fraction or exponent, may still be incomplete.
+        if end == len(self.buffer):
+            return False
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and self.buffer[end] in '.eE+-':
+            return False
+        self.pos = end
+        return (value,)
+
+    def feed(self, text):
+        """Parses [text] and returns the list of the pairs it completed."""
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        items = []
+        while self.state != 'end' and self.skip_whitespace():
+            if self.state == 'start':
+                self.expect('{')
+                self.state = 'first_key'
+            elif self.state in ('first_key', 'key'):
+                if self.state == 'first_key' and self.buffer[self.pos] == '}':
+                    self.pos += 1
+                    self.state = 'end'
+                    continue
+                if self.buffer[self.pos] != '"':
+                    self.expect('"')
+                key = self.decode()
+                if not key:
+                    break
+                self.key = key[0]
+                self.state = 'colon'
+            elif self.state == 'colon':
+                self.expect(':')
+                self.state = 'value'
+            elif self.state == 'value':
+                value = self.decode()
+                if not value:
+                    break
+                items.append((self.key, value[0]))
+                self.state = 'next'
+            elif self.state == 'next':
+                if self.expect(',}') == ',':
+                    self.state = 'key'
+                else:
+                    self.state = 'end'
+        return items
+
+    def close(self):
+        """Returns the last pair, which could only be completed at the end
+        of the document, and checks that the document was complete."""
+        items = self.feed(' ')
+        if self.state != 'end' or self.skip_whitespace():
+            raise ValueError('Incomplete or trailing data in JSON object')
+        return items